@@ -6,6 +6,7 @@
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::#
 
 import sys, os, argparse
+import functools
 from pprint import pprint
 import numpy as np
 # add startools.py to your python path:
@@ -51,6 +52,16 @@ def start_parser():
 	parser.add_argument('-o', type=str, default="transformed.star", help='Output filename. Default: [%(default)s]')
 	parser.add_argument('-apix', type=float, default=1.0, help='Pixel size in Angstrom. Important to scale relative to coordinate transformations.')
 	parser.add_argument('-box_center', nargs='+', type=float, help='Box center in PIXEL. Coordinate transformations derived from CCP4 programs refer to rotations around the origin (0,0,0), while the relion origin is in the center of the box. In order to use CCP4 coordinate transformations, provide the coordinates of the box center, e.g. 50.0 50.0 50.0 for a rectangular box with an endge length of 100 pixel.)')
+	parser.add_argument('-optics_groups', '--optics-groups', dest='optics_groups', action='store_const', const=True, default=False, help='Use the pixel size (_rlnImagePixelSize) and box center (_rlnImageSize / 2) of the optics group of each particle (data_optics) instead of -apix and -box_center, e.g. for data sets from several detectors.')
+	parser.add_argument('-ref_pdb', '--ref-pdb', dest='ref_pdb', type=str, help='Reference model (PDB or mmCIF), e.g. transformed.pdb. Together with -mov_pdb, the transformation is calculated by a least-squares superposition of the moving model on the reference model (instead of -e and -t).')
+	parser.add_argument('-mov_pdb', '--mov-pdb', dest='mov_pdb', type=str, help='Moving model (PDB or mmCIF) fitted to the input reconstruction, e.g. original.pdb. See -ref_pdb.')
+	parser.add_argument('-chains', '--chains', nargs='+', type=str, help='Superpose chain pairs instead of all matching atoms: REF_CHAIN[:MOV_CHAIN] (e.g. A or A:B). For more than one pair, every superposition is applied and written to its own star file (OUTPUT_REFCHAIN-MOVCHAIN.star). Default: all chains')
+	parser.add_argument('-sym', '--sym', type=str, help='Symmetry expansion of the (transformed) particles by the operators of a point group: Cn, Dn, T, O, I (= I2) or I1 (RELION orientations). Every particle is written once per operator.')
+	parser.add_argument('-batch', '--batch', type=str, help='Apply many transformations to the input star file, which is only read once. Text file with one transformation per line: alpha beta gamma tx ty tz [box_center (1 or 3 values)] [output.star]. Without box center the -box_center value is used. Transformed copies without an output filename are combined into one expanded star file (-o).')
+	parser.add_argument('-chunk_size', '--chunk-size', dest='chunk_size', type=int, default=None, help='Read, transform and write data_particles in batches of CHUNK_SIZE particles to limit the memory usage for very large star files. The output is identical to the default mode. Default: read the complete file')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes for parsing, transforming and writing data_particles. The output is identical to the serial mode. The particles are processed in batches of CHUNK_SIZE (default 65536) particles, at most 2*JOBS batches are held in memory. Default: [%(default)s]')
+	parser.add_argument('-cache', '--cache', action='store_const', const=True, default=False, help='Keep a binary cache of the parsed input star file (INPUT.npycache) and read it instead of the star file as long as the star file is unchanged. Not used with -chunk_size/-j.')
+	parser.add_argument('-lazy', '--lazy', action='store_const', const=True, default=False, help='Only parse the columns required for the transformation. All other columns are copied as they are in the input star file (values and formatting). Not used with -chunk_size/-j.')
 	parser.add_argument('-v', action='store_const', const=True, default=False, help='Increase output verbosity')
 	
 	return parser.parse_args()
@@ -80,62 +91,191 @@ def main():
 	out_star = variables.o
 	print("out_star = %s" % variables.o)
 	
-	if not os.path.isfile(star_inp): sys.exit("ERROR: %s does not exist!" % star_inp)
-	
+	batch = variables.batch
+	if batch is not None: print("batch = %s" % batch)
 	
+	sym = variables.sym
+	if sym is not None: print("sym = %s" % sym)
 	
+	ref_pdb, mov_pdb = variables.ref_pdb, variables.mov_pdb
+	if (ref_pdb is not None) or (mov_pdb is not None): print("ref_pdb = %s\nmov_pdb = %s" % (ref_pdb, mov_pdb))
 	
 	# preprocessing of input parameters
 	if star_inp is None: sys.exit("ERROR: Input star file must be provided!")
+	if not os.path.isfile(star_inp): sys.exit("ERROR: %s does not exist!" % star_inp)
 	if (t is not None) and (np.array(t).shape != (3,)): sys.exit("ERROR: Incorrect dimension! t must have three elements, e.g. 2.0 1.0 0.0 !")
-	if (t is None) and (euler is None): sys.exit("Missing parameters! Nothing to do! ")
+	if (ref_pdb is None) != (mov_pdb is None): sys.exit("ERROR: -ref_pdb and -mov_pdb must be provided together!")
+	if (ref_pdb is not None) and ((t is not None) or (euler is not None) or (batch is not None)): sys.exit("ERROR: -ref_pdb/-mov_pdb cannot be combined with -e, -t or -batch!")
+	if (variables.chains is not None) and (ref_pdb is None): sys.exit("ERROR: -chains requires -ref_pdb and -mov_pdb!")
+	if (t is None) and (euler is None) and (batch is None) and (sym is None) and (ref_pdb is None): sys.exit("Missing parameters! Nothing to do! ")
 	if (euler is not None) and (np.array(euler).shape != (3,) ): sys.exit("ERROR: Incorrect dimension! Provide three Euler angles, e.g. 2.0 1.0 0.0")
 	if euler is None: euler = np.array([0.0, 0.0, 0.0])
 	else: euler = np.array(euler)
 	if t is None: t = np.array([0.0, 0.0, 0.0])
 	else: t = np.array(t)
 	
+	box_center = check_box_center(box_center)
+	optics = None
+	if variables.optics_groups:
+		if (variables.apix != 1.0) or (box_center is not None): print("WARNING: -apix and -box_center are replaced by the values of the optics groups!")
+		optics = startools.optics_group_table(startools.starfile(None, verbosity=variables.v).read_data_block(star_inp, "data_optics"))
+		for group, group_apix, group_center in zip(*optics): print("Optics group %d: apix = %s, box_center = %s" % (group, group_apix, group_center))
+	transforms = None
+	if batch is not None: transforms = read_transform_file(batch, box_center)
+	if ref_pdb is not None: 
+		if (box_center is None) and (optics is None): print("WARNING: Transformations from a superposition refer to the origin (0,0,0). Provide -box_center!")
+		transforms = superpose_pdb(ref_pdb, mov_pdb, variables.chains, box_center, out_star)
+		if len(transforms) == 1: euler, t, transforms = transforms[0][0], transforms[0][1], None
+	if sym is not None: 
+		operators = startools.symmetry_operators(sym)
+		print("%d symmetry operators (%s)" % (len(operators), sym))
+	
+	print("-------------------------------------------------------------")
+	
+	
+	if (variables.chunk_size is not None) and (variables.chunk_size < 1): sys.exit("ERROR: The chunk size must be a positive number of particles!")
+	if variables.jobs < 1: sys.exit("ERROR: The number of jobs must be at least 1!")
+	
+	
+	if transforms is not None:
+		# read the star file once and apply all transformations of the batch file (or of the chain pairs)
+		if (variables.chunk_size is not None) or (variables.jobs > 1) or (sym is not None): print("WARNING: -chunk_size, -j and -sym are not used in batch mode!")
+		datafile = startools.starfile(star_inp, verbosity=variables.v, cache=variables.cache, lazy=variables.lazy)
+		transform_particles_batch(datafile, transforms, apix, out_star, optics)
+	elif (variables.chunk_size is None) and (variables.jobs == 1):
+		# create star file object:
+		datafile = startools.starfile(star_inp, verbosity=variables.v, cache=variables.cache, lazy=variables.lazy)
+		
+		# apply transformation
+		transform_particles(datafile.data_particles, apix, t, euler, box_center, optics=optics)
+		
+		# save datafile object:
+		if sym is None: datafile.savestar(out_star)
+		else: datafile.savestar_batches(out_star, "data_particles", startools.symmetry_expand_batches(datafile.data_particles, operators)) # expanded in batches
+	else:
+		# read, transform and write data_particles in batches (in parallel for jobs > 1):
+		if variables.cache or variables.lazy: print("WARNING: -cache and -lazy are not used for reading in batches!")
+		if sym is not None: sys.exit("ERROR: -sym cannot be combined with -chunk_size or -j!")
+		datafile = startools.starfile(None, verbosity=variables.v)
+		func = functools.partial(transform_batch, apix=apix, t=t, euler=euler, box_center=box_center, optics=optics)
+		datafile.process_star_file_in_chunks(star_inp, out_star, func, variables.chunk_size, jobs=variables.jobs)
+	
+	
+	
+def check_box_center(box_center):
+	# returns the box center as array with three dimensions (or None)
 	if ( box_center is not None ) and (np.array(box_center).shape != (3,) ):
 		if np.array(box_center).shape == (1,): 
-			box_center = box_center*3
+			box_center = list(box_center)*3
 			print("Only one dimension was provided for the box center! Assuming: ", box_center)
 		elif np.array(box_center).shape == (2,) or np.array(box_center).shape[0] > 3: sys.exit("ERROR: Box center requires three dimensions ")
 		box_center = np.array(box_center)
 	elif (np.array(box_center).shape == (3,) ): box_center = np.array(box_center)
+	return box_center
 	
-	print("-------------------------------------------------------------")
 	
 	
-	# create star file object:
-	datafile = startools.starfile(star_inp, verbosity=variables.v)
+def superpose_pdb(ref_pdb, mov_pdb, chains, box_center, out_star):
+	# superposes the moving model on the reference model, for every chain pair of chains (REF_CHAIN[:MOV_CHAIN]) or all chains
+	# returns a list of (euler, t, box_center, output) tuples (see read_transform_file). With more than one 
+	# chain pair, every transformation gets its own output filename OUTPUT_REFCHAIN-MOVCHAIN.star
+	chain_pairs = None
+	if chains is not None: chain_pairs = [ tuple(pair.split(":", 1)) if ":" in pair else (pair, pair) for pair in chains ]
+	euler, t, rmsd = startools.superpose_models(startools.read_model_atoms(ref_pdb), startools.read_model_atoms(mov_pdb), chain_pairs)
+	if (chain_pairs is None) or (len(chain_pairs) == 1): return [ (euler[0], t[0], box_center, None) ]
+	root, ext = os.path.splitext(out_star)
+	return [ (euler[idx], t[idx], box_center, "%s_%s-%s%s" % (root, ref_chain, mov_chain, ext or ".star")) for idx, (ref_chain, mov_chain) in enumerate(chain_pairs) ]
+	
+	
 	
+def read_transform_file(fname, box_center=None):
+	# reads a batch file with one transformation per line: alpha beta gamma tx ty tz [box_center (1 or 3 values)] [output.star]
+	# empty lines and lines starting with # are ignored
+	# returns a list of (euler, t, box_center, output) tuples, output is None if no filename is given
+	if not os.path.isfile(fname): sys.exit("ERROR: %s does not exist!" % fname)
+	transforms = []
+	for line_idx, line in enumerate(open(fname)):
+		values = line.split("#", 1)[0].split()
+		if len(values) == 0: continue
+		output = None
+		try: float(values[-1])
+		except ValueError: output = values.pop()
+		try: values = [ float(i) for i in values ]
+		except ValueError: sys.exit("ERROR: Line %d of %s: values must be numbers! (%s)" % (line_idx+1, fname, line.strip()))
+		if len(values) not in (6, 7, 9): sys.exit("ERROR: Line %d of %s: provide alpha beta gamma tx ty tz [box center (1 or 3 values)] [output.star]! (%s)" % (line_idx+1, fname, line.strip()))
+		transforms.append(( np.array(values[0:3]), np.array(values[3:6]), check_box_center(values[6:]) if len(values) > 6 else box_center, output ))
+	if len(transforms) == 0: sys.exit("ERROR: %s contains no transformations!" % fname)
+	print("%d transformations read from %s" % (len(transforms), fname))
+	return transforms
 	
-	# apply transformation
+	
+	
+def transform_particles_batch(datafile, transforms, apix, out_star, optics=None):
+	# Applies every transformation of the list (see read_transform_file) to the original alignment parameters of data_particles.
+	# The rotation matrices of the particles are only calculated once. Transformations with an output filename are 
+	# written into their own star file, all others are combined into one expanded star file (out_star) in the order of the list.
+	# optics: optics group table (see startools.optics_group_table), replaces apix and the box centers of the transformations
+	block = datafile.data_particles
+	columns = ["_rlnAngleRot", "_rlnAngleTilt", "_rlnAnglePsi", "_rlnOriginXAngst", "_rlnOriginYAngst"]
+	block.load_columns(*(columns + (["_rlnOpticsGroup"] if optics is not None else []))) # one pass for a lazy data block
+	original = [ np.array(block.data_array[c]) for c in columns ]
+	R_org = startools.dynamo4ccp4_euler2rot_batch(np.radians(original[0]), np.radians(original[1]), np.radians(original[2]))
+	groups = startools.optics_group_index(block.data_array["_rlnOpticsGroup"], optics[0]) if optics is not None else None
+	
+	def transformed(selection):
+		# generator: block with the transformed alignment parameters, for each transformation of selection
+		for euler, t, box_center, output in selection:
+			if optics is not None: new_transf = startools.apply_3D_coord_transform_to_ptcl_aln_params(*original, optics[1], t, euler, optics[2], R_org=R_org, groups=groups)
+			else: new_transf = startools.apply_3D_coord_transform_to_ptcl_aln_params(*original, apix, t, euler, box_center, R_org=R_org)
+			for idx, c in enumerate(columns): block.data_array[c] = new_transf[:,idx]
+			yield block
+	
+	for transform in transforms:
+		if transform[3] is None: continue
+		print("Transformation euler = %s, t = %s, box_center = %s --> %s" % tuple(transform))
+		for b in transformed([transform]): datafile.savestar(transform[3])
+	combined = [ transform for transform in transforms if transform[3] is None ]
+	if len(combined) > 0: 
+		print("%d transformations are combined in %s" % (len(combined), out_star))
+		datafile.savestar_batches(out_star, "data_particles", transformed(combined))
+	for idx, c in enumerate(columns): block.data_array[c] = original[idx] # restore
+	
+	
+	
+def transform_batch(block, batch_idx, apix, t, euler, box_center, optics=None):
+	# transforms one batch of process_star_file_in_chunks; the translation vector is only reported for the first batch
+	transform_particles(block, apix, t, euler, box_center, verbosity=(batch_idx == 0), optics=optics)
+	
+	
+	
+def transform_particles(block, apix, t, euler, box_center, verbosity=True, optics=None):
+	# applies the coordinate transformation to the alignment parameters of a data block (in place)
+	# optics: optics group table (see startools.optics_group_table), replaces apix and box_center
+	block.load_columns("_rlnAngleRot", "_rlnAngleTilt", "_rlnAnglePsi", "_rlnOriginXAngst", "_rlnOriginYAngst", *(["_rlnOpticsGroup"] if optics is not None else [])) # one pass for a lazy data block
+	groups = None
+	if optics is not None:
+		groups = startools.optics_group_index(block.data_array["_rlnOpticsGroup"], optics[0])
+		apix, box_center = optics[1], optics[2]
 	new_transf = startools.apply_3D_coord_transform_to_ptcl_aln_params( \
-		datafile.data_particles.data_array["_rlnAngleRot"] , \
-		datafile.data_particles.data_array["_rlnAngleTilt"] , \
-		datafile.data_particles.data_array["_rlnAnglePsi"] , \
-		datafile.data_particles.data_array["_rlnOriginXAngst"] , \
-		datafile.data_particles.data_array["_rlnOriginYAngst"] , \
+		block.data_array["_rlnAngleRot"] , \
+		block.data_array["_rlnAngleTilt"] , \
+		block.data_array["_rlnAnglePsi"] , \
+		block.data_array["_rlnOriginXAngst"] , \
+		block.data_array["_rlnOriginYAngst"] , \
 		apix, \
 		t , \
 		euler , \
-		box_center)
+		box_center, \
+		verbosity=verbosity, \
+		groups=groups)
 	
 	# update datafile object:
 	# structured array; fields have to be overwritten individually
-	datafile.data_particles.data_array["_rlnAngleRot"  ] = new_transf[:,0]
-	datafile.data_particles.data_array["_rlnAngleTilt" ] = new_transf[:,1]
-	datafile.data_particles.data_array["_rlnAnglePsi"  ] = new_transf[:,2]
-	datafile.data_particles.data_array["_rlnOriginXAngst"   ] = new_transf[:,3]
-	datafile.data_particles.data_array["_rlnOriginYAngst"   ] = new_transf[:,4]
-	
-	
-	
-	
-	
-	# save datafile object:
-	datafile.savestar(out_star)
+	block.data_array["_rlnAngleRot"  ] = new_transf[:,0]
+	block.data_array["_rlnAngleTilt" ] = new_transf[:,1]
+	block.data_array["_rlnAnglePsi"  ] = new_transf[:,2]
+	block.data_array["_rlnOriginXAngst"   ] = new_transf[:,3]
+	block.data_array["_rlnOriginYAngst"   ] = new_transf[:,4]
 	
 	
 	
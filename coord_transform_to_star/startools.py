@@ -6,7 +6,10 @@
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::#
 
 
-import sys, os, copy
+import sys, os, copy, time
+import json, hashlib
+import ast
+import collections
 import numpy as np
 from pprint import pprint
 import relion_metadata_labels as meta
@@ -14,6 +17,15 @@ import re
 import warnings
 from io import StringIO
 import numpy.lib.recfunctions as rf
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+# np.loadtxt is implemented in C since numpy 1.23 (before it was a slow python loop)
+has_c_loadtxt = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
+
+# data type (letter) of string columns. String columns are stored compact (sized to their longest value), 
+# but all string columns share this data type letter in the column/dtype dictionaries
+default_string_dtype = 'U1000'
 
 
 
@@ -24,12 +36,22 @@ import numpy.lib.recfunctions as rf
 
 class starfile():
 	
-	def __init__(self, star_inp, verbosity=False, objname=None):
+	def __init__(self, star_inp, verbosity=False, objname=None, parser="columnar", split_image_name=True, cache=False, lazy=False):
+		# parser			(str) engine for reading the data rows: "columnar" (default, fast) or "genfromtxt" (reference)
+		# split_image_name	(bool) store _rlnImageName as slice number + stack number (see data_block.split_image_name)
+		# cache				(bool or str) read star_inp from a binary cache (see read_star_file_cached). 
+		#					True: cache directory star_inp + ".npycache", str: cache directory
+		# lazy				(bool) only the column headers are read, each column is parsed when it is accessed for the first time.
+		#					Columns that were never accessed are written by savestar as they are in star_inp (raw text).
+		#					_rlnImageName is not split in this mode.
 		
 		self.star_inp = star_inp
 		self.verbosity = verbosity
 		self.objname=objname
-		self.default_string_dtype = 'U1000' 
+		self.parser = parser
+		self.split_image_name = split_image_name
+		self.lazy = lazy
+		self.default_string_dtype = default_string_dtype
 		self.data_len=0
 		self.optics_len=0
 		self.len_screen_header_for_data_blocks = None 
@@ -37,7 +59,9 @@ class starfile():
 		self.assign_dtype = meta.relion3_1(self.default_string_dtype)
 		
 		self.data_block_names = [] # list of all data block names in the star file
-		self.read_star_file(star_inp) # fills self.data_opt and self.data_ptcls
+		if star_inp is None: pass
+		elif cache: self.read_star_file_cached(star_inp, star_inp + ".npycache" if cache is True else cache)
+		else: self.read_star_file(star_inp) # fills self.data_opt and self.data_ptcls
 		
 	
 	def __str__(self):
@@ -59,86 +83,28 @@ class starfile():
 		#last_header_row												last_header_row
 		
 		
-		##### Determine how many loop blocks exist
-		
-		# Determine how many data blocks are in the file
-		starfile_all_lines = self.readfile(fname)
-		data_line_num = self.find_line_in_file_starts_with(starfile_all_lines[:self.len_screen_header_for_data_blocks], "data")
-		loop_line_num = self.find_line_in_file_starts_with(starfile_all_lines[:self.len_screen_header_for_data_blocks], "loop_")
-		column_header_lines = self.find_line_in_file_starts_with(starfile_all_lines[:self.len_screen_header_for_data_blocks], "_")
-		
-		
-		if len(data_line_num) != len(loop_line_num): sys.exit("Cannot read starfile with data blocks containing tables and loops!")
+		##### Stream through the file once:
+		# the data block, loop_ and column label lines are detected while reading and the data rows of each 
+		# block are handed directly to the parser (the file is never held in memory as a list of lines)
+		stream = star_stream(self.openfile(fname))
 		
 		########## READ DATA BLOCKS
 		
-		num_data_block = len(loop_line_num)
-		
-		column_header_lines_idx_count= 0
-		for block_idx,(b_line_num,block_name) in enumerate(data_line_num):
+		block_idx = -1
+		while True:
+			block_name = stream.next_data_block()
+			if block_name is None: break
+			block_idx += 1
 			self.verbose("-------------------------------------------------" )
 			self.verbose("Reading data block %d (%s)" % (block_idx+1, block_name) )
-			first_col_label_line_idx=loop_line_num[block_idx][0]+1
-			
-			############# 
-			# Create dictionary with column name as key and column number as element e.g. --> colum_positions["_rlnBeamTiltX"] : 11
-			# dictionary, which contains the column names as key and the column numer (starting with 1) as element
-			last_line = None # this is last line in the star with a column meta label for the next data block
-			colum_positions = {}
-			for col_idx, (starfile_line_num, col) in enumerate(column_header_lines[column_header_lines_idx_count:]):
-				#print "column_header_lines_idx_count=", column_header_lines_idx_count , "\tcol_idx=", col_idx
-				if col_idx == 0 and first_col_label_line_idx != starfile_line_num: 
-					#print col_idx , first_col_label_line_idx, starfile_line_num
-					sys.exit("Is there an empty line between loop_ and the first column label of data block %s?" % block_name)
-				if isinstance(last_line, int) and last_line+1 != starfile_line_num: #detect a jump in the starfile num ... if it is from the same block you would expect that last_line +1 == starfile_line_num ... in unequal, the block is over!
-					break
-				last_line = starfile_line_num
-				beginning = col.split(" ")[0]
-				colum_positions[beginning] = col_idx+1
-				column_header_lines_idx_count += 1 
-			
-			###########
-			# Create the inverse dictionary e.g. --> colum_positions_inv[11] : "_rlnBeamTiltX"
-			colum_positions_inv = { colum_positions[i] : i  for i in colum_positions} # make second dict - but keys and elements inverted => colnum : "colname"
-			
-			##########
-			# Create dictionary that connects column names with data type
-			dtype_assignment = []
-			for i in range(1, len(colum_positions_inv)+1):
-				try: dtype_assignment.append( (colum_positions_inv[i], self.assign_dtype[colum_positions_inv[i]]) )
-				except KeyError: dtype_assignment.append( (colum_positions_inv[i], self.default_string_dtype ) )
-			
-			self.verbose( "Column headers and data types assigned to columns:")
-			self.verbose( "column     data type     column name")
-			for idx, (colname,dtype) in enumerate(dtype_assignment): self.verbose(  "    %02d     % 9s     %s" % (idx+1, dtype, colname) )
-			
-			
 			
+			colum_positions, colum_positions_inv, dtype_assignment = self.read_loop_header(stream, block_name)
 			
 			#########
 			# Read data arrays
-			# determine skip footer --> get line where next data block starts
-			# if there is no next data block 
-			#try: skip_footer=self.lines_in_data_star-data_line_num[block_idx+1][0] -1 #its over where the next data block starts (=line number in star file where next data block starts)
-			#except IndexError: skip_footer=0
-			
-			
-			
-			try: end_datablock_line=data_line_num[block_idx+1][0]
-			except IndexError: end_datablock_line=None
-			
-			self.verbose( "Reading array...")
-			data_array = np.genfromtxt(StringIO("".join(starfile_all_lines[last_line+1:end_datablock_line])), 
-				dtype=dtype_assignment, 
-				comments='#'
-			) # structured array using the dtype assignment + column names from above
-			#print "Data read in:\n", data_array # structured array = can be called by column names e.g. data_array["_rlnDefocusU"]
-			
-			
-			
-			self.verbose("%i data elements imported." % ( data_array.size ))
-			
-			if data_array.size == 1: data_array = np.atleast_1d(data_array)
+			# the row generator stops at the line where the next data block starts (or at the end of the file)
+			if self.lazy: data_array = self.read_rows_lazy(stream.row_chunks(), dtype_assignment)
+			else: data_array = self.read_rows(stream.row_chunks(), dtype_assignment)
 			
 			
 			#if num_data_block == 1 or (num_data_block > 1 and "particles" in block_name):
@@ -150,15 +116,6 @@ class starfile():
 			##	except TypeError: sys.exit("ERROR: %s must contain at least one optics group!" % fname)
 			
 			
-			##### returns:
-			# data_array
-			# colum_positions
-			# colum_positions_inv
-			# dtype_assignment
-			
-			
-			
-			
 			########################## GENERATE NEW CLASS HERE DON'T USE DICTIONARY !!!! INHERIT CLASS ETC ...
 			###### GENERATE A CLASS with the name of the data block, e.g. data_particles and assign the subclass data_block
 			# it will be accessible via:
@@ -169,24 +126,274 @@ class starfile():
 			# self.data_optics.arr_col_dtype_assignment
 			# ....
 			# self.data_random_data_table.data_array
-			data_block_name = block_name.replace(" ", "") # remove spaces (e.g. "data_optics" or "data_" or "data_particles")
-			if data_block_name in self.data_block_names: 
-				print("WARNING: %s contains data blocks with identical name! %s was renamed to %s" % ( fname, data_block_name, data_block_name + "_block" + str(block_idx+1) ))
-				data_block_name = data_block_name + "_block" + str(block_idx+1)
-			else: print("Data block object created: %s" % data_block_name)
+			data_block_name = self.new_data_block_name(block_name, block_idx, fname)
 			self.data_block_names.append(data_block_name)
-			setattr(self, data_block_name, data_block(data_array, colum_positions_inv, colum_positions, dtype_assignment, objname=data_block_name))
+			block = self.make_data_block(data_array, colum_positions_inv, colum_positions, dtype_assignment, data_block_name)
+			if block.image_name_column is not None: self.verbose("_rlnImageName stored as slice number + stack (%d stack files)" % len(block.image_stacks))
+			setattr(self, data_block_name, block)
 			
 			self.verbose("-------------------------------------------------")
 			#sys.exit()
 			#pprint ( data_array)
 		
+		self.lines_in_data_star = stream.line_count
+		stream.close()
+		
 		
 		#if num_data_block == 1: return data_blocks[data_blocks.keys()[0]]
 		#else: 
 		#return data_blocks
 		#OLD: return colum_positions, colum_positions_inv, dtype_assignment, data_array, last_header_row
+	
+	
+	def read_star_file_cached(self, fname, cache_dir):
+		# Reads fname from the binary cache in cache_dir if it is up to date, otherwise fname is parsed and the cache is (re)written.
+		# The cache contains one .npy file per column of each data block and manifest.json with the block names, column order,
+		# data types and the cache key (path, size, mtime and content hash of fname and the parse options, see cache_key).
+		# Cached columns are memory mapped copy-on-write (data_array is a column_array): a column is only read from disk 
+		# when it is accessed and modifications are never written back to the cache.
+		key = self.cache_key(fname)
+		if self.load_cache(cache_dir, key): return
+		self.read_star_file(fname)
+		self.save_cache(cache_dir, key)
+	
+	
+	def cache_key(self, fname, sample_size=2**20):
+		# returns the cache key of fname: path, size, mtime and a hash of the first and last sample_size bytes
+		# (hashing the complete multi-GB file would take longer than reading the cache) and the options that change 
+		# the cached columns (a cache written with other options is not used, e.g. split _rlnImageName)
+		if not os.path.isfile(fname): sys.exit("ERROR: %s does not exist!" % fname)
+		stat = os.stat(fname)
+		content_hash = hashlib.blake2b(str(stat.st_size).encode(), digest_size=16)
+		with open(fname, "rb") as f:
+			content_hash.update(f.read(sample_size))
+			if stat.st_size > sample_size:
+				f.seek(max(sample_size, stat.st_size - sample_size))
+				content_hash.update(f.read())
+		options = { "parser" : self.parser, "split_image_name" : bool(self.split_image_name), "lazy" : bool(self.lazy) }
+		return { "path" : os.path.realpath(fname), "size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns, "hash" : content_hash.hexdigest(), "options" : options }
+	
+	
+	def load_cache(self, cache_dir, key):
+		# creates the data blocks from the cache in cache_dir, returns False if there is no valid cache for key
+		try:
+			with open(os.path.join(cache_dir, "manifest.json")) as f: manifest = json.load(f)
+		except (OSError, ValueError): return False
+		if manifest.get("version") != 1 or manifest.get("key") != key: 
+			self.verbose("Cache %s is outdated" % cache_dir)
+			return False
 		
+		try:
+			blocks = []
+			for entry in manifest["blocks"]:
+				names = [ colname for colname, column_file in entry["columns"] ]
+				data_array = column_array({ colname : load_npy(os.path.join(cache_dir, column_file)) for colname, column_file in entry["columns"] }, names)
+				colum_positions_inv = { colnum : colname for colnum, colname in entry["dict_colnum_colname"] }
+				colum_positions = { colname : colnum for colnum, colname in entry["dict_colnum_colname"] }
+				block = data_block(data_array, colum_positions_inv, colum_positions, [ tuple(i) for i in entry["dtype_assignment"] ], objname=entry["name"])
+				if entry["image_name_column"] is not None:
+					block.image_name_column = entry["image_name_column"]
+					block.image_stacks = np.load(os.path.join(cache_dir, entry["image_stacks"]))
+					block.image_index_width = entry["image_index_width"]
+				blocks.append(block)
+		except (OSError, ValueError, KeyError) as e: 
+			print("WARNING: Cache %s cannot be read (%s)! The star file is read instead." % (cache_dir, e))
+			return False
+		
+		for block in blocks:
+			print("Data block object created: %s (cache)" % block.objname)
+			self.data_block_names.append(block.objname)
+			setattr(self, block.objname, block)
+		self.lines_in_data_star = manifest["lines_in_data_star"]
+		self.verbose("%d data blocks read from cache %s" % (len(blocks), cache_dir))
+		return True
+	
+	
+	def save_cache(self, cache_dir, key):
+		# writes all data blocks to the cache in cache_dir (see read_star_file_cached)
+		manifest_file = os.path.join(cache_dir, "manifest.json")
+		try:
+			if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+			if os.path.isfile(manifest_file): os.remove(manifest_file) # invalidate the old cache before the columns are overwritten
+			for i in os.listdir(cache_dir): 
+				if i.endswith(".npy"): os.remove(os.path.join(cache_dir, i))
+			
+			blocks = []
+			for block_idx, name in enumerate(self.data_block_names):
+				block = getattr(self, name)
+				entry = {
+					"name" : name,
+					"columns" : [],
+					"dict_colnum_colname" : sorted(block.dict_colnum_colname.items()),
+					"dtype_assignment" : block.arr_col_dtype_assignment,
+					"image_name_column" : block.image_name_column,
+					"image_index_width" : block.image_index_width
+				}
+				for col_idx, colname in enumerate(block.data_array.dtype.names):
+					column_file = "block%03d_col%03d.npy" % (block_idx, col_idx)
+					np.save(os.path.join(cache_dir, column_file), block.data_array[colname])
+					entry["columns"].append([colname, column_file])
+				if block.image_stacks is not None: 
+					entry["image_stacks"] = "block%03d_stacks.npy" % block_idx
+					np.save(os.path.join(cache_dir, entry["image_stacks"]), block.image_stacks)
+				blocks.append(entry)
+			
+			manifest = { "version" : 1, "key" : key, "lines_in_data_star" : self.lines_in_data_star, "blocks" : blocks }
+			with open(manifest_file + ".tmp", "w") as f: json.dump(manifest, f, indent=1)
+			os.replace(manifest_file + ".tmp", manifest_file) # the manifest is written last: an interrupted cache is never used
+			self.verbose("Cache written: %s" % cache_dir)
+		except OSError as e: print("WARNING: Cache %s cannot be written (%s)!" % (cache_dir, e))
+	
+	
+	def read_star_file_rows(self, fname, rows, block_name="data_particles", rebuild_index=False):
+		# Reads only the given rows of the data block block_name and all other data blocks completely, e.g. a few 
+		# thousand particles of a multi-GB star file. The rows are read directly with the persistent row index of fname 
+		# (see row_index), which is built in one pass over the file if it is missing or outdated.
+		# rows				row numbers (starting with 0; list, array, boolean mask or slice) in the requested order
+		# block_name		(str) data block from which only the rows are read
+		# rebuild_index		(bool) rebuild the row index even if it is up to date
+		index = row_index(fname, rebuild=rebuild_index, verbosity=self.verbosity)
+		for block_idx, block in enumerate(index.blocks):
+			self.verbose("-------------------------------------------------" )
+			self.verbose("Reading data block %d (%s)" % (block_idx+1, block["name"]) )
+			colum_positions, colum_positions_inv, dtype_assignment = self.loop_header(block["labels"])
+			text = index.read_rows(block_idx, rows if block["name"] == block_name else slice(None))
+			row_chunks = [ text ] if text != "" else []
+			if self.lazy: data_array = self.read_rows_lazy(row_chunks, dtype_assignment)
+			else: data_array = self.read_rows(row_chunks, dtype_assignment)
+			data_block_name = self.new_data_block_name(block["name"], block_idx, fname)
+			self.data_block_names.append(data_block_name)
+			setattr(self, data_block_name, self.make_data_block(data_array, colum_positions_inv, colum_positions, dtype_assignment, data_block_name))
+	
+	
+	def read_loop_header(self, stream, block_name):
+		# reads the loop_ and column labels of a data block
+		# returns colum_positions, colum_positions_inv, dtype_assignment (see read_star_file)
+		return self.loop_header(stream.loop_labels(block_name))
+	
+	
+	def loop_header(self, labels):
+		# labels: column label lines of a loop (e.g. "_rlnImageName #1")
+		# returns colum_positions, colum_positions_inv, dtype_assignment (see read_star_file)
+		
+		############# 
+		# Create dictionary with column name as key and column number as element e.g. --> colum_positions["_rlnBeamTiltX"] : 11
+		# dictionary, which contains the column names as key and the column numer (starting with 1) as element
+		colum_positions = {}
+		for col_idx, col in enumerate(labels):
+			colum_positions[col.split()[0]] = col_idx+1
+		
+		###########
+		# Create the inverse dictionary e.g. --> colum_positions_inv[11] : "_rlnBeamTiltX"
+		colum_positions_inv = { colum_positions[i] : i  for i in colum_positions} # make second dict - but keys and elements inverted => colnum : "colname"
+		
+		##########
+		# Create dictionary that connects column names with data type
+		dtype_assignment = []
+		for i in range(1, len(colum_positions_inv)+1):
+			try: dtype_assignment.append( (colum_positions_inv[i], self.assign_dtype[colum_positions_inv[i]]) )
+			except KeyError: dtype_assignment.append( (colum_positions_inv[i], self.default_string_dtype ) )
+		
+		self.verbose( "Column headers and data types assigned to columns:")
+		self.verbose( "column     data type     column name")
+		for idx, (colname,dtype) in enumerate(dtype_assignment): self.verbose(  "    %02d     % 9s     %s" % (idx+1, dtype, colname) )
+		return colum_positions, colum_positions_inv, dtype_assignment
+	
+	
+	def read_rows(self, row_chunks, dtype_assignment):
+		# parses the rows of a loop (iterable of text chunks) into a column_array (columnar parser) or structured array
+		self.verbose( "Reading array (%s parser)..." % self.parser)
+		data_array = compact_string_columns(self.parse_rows(row_chunks, dtype_assignment)) # string columns are sized to their longest value
+		#print "Data read in:\n", data_array # structured array = can be called by column names e.g. data_array["_rlnDefocusU"]
+		self.verbose("%i data elements imported." % ( data_array.size ))
+		return data_array
+	
+	
+	def read_rows_lazy(self, row_chunks, dtype_assignment):
+		# keeps the rows of a loop as text, returns a column_array that parses each column on first access
+		raw = raw_rows("".join(row_chunks), dtype_assignment)
+		self.verbose("%i rows imported (columns are parsed on first access)." % len(raw))
+		return column_array({}, [ colname for colname, dtype in dtype_assignment ], raw=raw)
+	
+	
+	def new_data_block_name(self, block_name, block_idx, fname):
+		data_block_name = block_name.replace(" ", "") # remove spaces (e.g. "data_optics" or "data_" or "data_particles")
+		if data_block_name in self.data_block_names: 
+			print("WARNING: %s contains data blocks with identical name! %s was renamed to %s" % ( fname, data_block_name, data_block_name + "_block" + str(block_idx+1) ))
+			data_block_name = data_block_name + "_block" + str(block_idx+1)
+		else: print("Data block object created: %s" % data_block_name)
+		return data_block_name
+	
+	
+	def make_data_block(self, data_array, colum_positions_inv, colum_positions, dtype_assignment, data_block_name):
+		# the dictionaries are copied, data blocks modify them (e.g. add_column)
+		block = data_block(data_array, dict(colum_positions_inv), dict(colum_positions), list(dtype_assignment), objname=data_block_name)
+		if self.split_image_name and not self.lazy and "_rlnImageName" in colum_positions: block.split_image_name("_rlnImageName")
+		return block
+	
+	
+	def parse_rows(self, row_chunks, dtype_assignment):
+		# row_chunks		iterable of text chunks with complete rows, e.g. star_stream.row_chunks()
+		# dtype_assignment	list of (column name, data type) tuples
+		# returns a column_array (columnar) or a structured array (genfromtxt)
+		engines = { 
+			"columnar" : self.parse_rows_columnar,
+			"genfromtxt" : self.parse_rows_genfromtxt
+		}
+		try: engine = engines[self.parser]
+		except KeyError: sys.exit("ERROR: Unknown parser %s! Available parsers: %s" % (self.parser, ", ".join(engines)))
+		return engine(row_chunks, dtype_assignment)
+	
+	
+	def parse_rows_genfromtxt(self, row_chunks, dtype_assignment):
+		# reference parser: converts one row and field at a time
+		return np.atleast_1d(np.genfromtxt(( line for text in row_chunks for line in text.splitlines(True) ), dtype=dtype_assignment, comments='#'))
+	
+	
+	def parse_rows_columnar(self, row_chunks, dtype_assignment):
+		# Converts the text chunks of the stream (several thousand rows each) at once into typed column buffers and 
+		# returns a column_array. With numpy >= 1.23 the C tokenizer of np.loadtxt is used, otherwise the whitespace 
+		# separated tokens of a chunk are split once and each column is converted in one call.
+		# Each string column is parsed with its own width: twice the longest value of the previous chunks (at least 32). 
+		# A chunk with a value that fills this width (may be truncated) is parsed again with the longest line as width.
+		# The columns of each chunk are copied out of the (row-major) chunk, which is released before the next chunk is 
+		# parsed. At the end the parts of each column are combined one column at a time (string columns sized to their 
+		# longest value), i.e. the peak memory is about the final columns plus one column.
+		dtype = np.dtype(dtype_assignment)
+		string_columns = [ name for name in dtype.names if is_string_dtype(dtype.fields[name][0]) ]
+		lengths = { name : 1 for name in string_columns } # longest value so far
+		parts = { name : [] for name in dtype.names }
+		for text in row_chunks:
+			if has_c_loadtxt: 
+				lines = text.splitlines()
+				widths = { name : max(32, 2*lengths[name]) for name in string_columns }
+				chunk = np.loadtxt(lines, dtype=resize_string_columns(dtype, widths), comments='#', ndmin=1)
+				chunk_lengths = { name : int(np.char.str_len(chunk[name]).max(initial=1)) for name in string_columns }
+				if any([ chunk_lengths[name] >= widths[name] for name in string_columns ]): 
+					# no value can be longer than the longest line of the chunk
+					longest_line = max(map(len, lines))
+					chunk = np.loadtxt(lines, dtype=resize_string_columns(dtype, { name : longest_line for name in string_columns }), comments='#', ndmin=1)
+					chunk_lengths = { name : int(np.char.str_len(chunk[name]).max(initial=1)) for name in string_columns }
+				del lines
+			else: 
+				chunk = tokenize_rows(text, dtype)
+				chunk_lengths = { name : string_dtype_width(chunk.dtype.fields[name][0]) for name in string_columns }
+			lengths = { name : max(lengths[name], chunk_lengths[name]) for name in string_columns }
+			for name in dtype.names: 
+				if name in string_columns: parts[name].append(chunk[name].astype("%s%d" % (chunk[name].dtype.kind, chunk_lengths[name])))
+				else: parts[name].append(np.ascontiguousarray(chunk[name]))
+			del chunk
+		
+		columns = {}
+		for name in dtype.names:
+			column_dtype = "%s%d" % (dtype.fields[name][0].kind, lengths[name]) if name in string_columns else dtype.fields[name][0]
+			if len(parts[name]) == 0: columns[name] = np.zeros(0, dtype=column_dtype)
+			elif len(parts[name]) == 1: columns[name] = parts[name][0].astype(column_dtype, copy=False)
+			else: columns[name] = np.concatenate(parts[name], dtype=column_dtype, casting="unsafe")
+			del parts[name]
+		return column_array(columns, dtype.names)
+	
+	
 	def copy_data_block(self, old, new):
 		from copy import deepcopy
 		obj = getattr(self, str(old))
@@ -201,6 +408,13 @@ class starfile():
 		#match_line = []
 		return [ (line_num, line.replace("\n", "")) for line_num,line in enumerate(file_handle) if re.match(r'^%s' % search_str, line) ] 
 	
+	def openfile (self, filename):
+		try:
+			return open(filename,"r")
+		except:
+			print("ERROR: Do you have permission to read %s ?" % filename)
+			sys.exit(0)
+	
 	def readfile (self, filename, length=None):
 		try:
 			handle = open(filename,"r")
@@ -223,6 +437,14 @@ class starfile():
 		return getattr(self, objname)
 	
 	
+	def add_data_block(self, block, block_name=None):
+		# adds a data block (e.g. from data_block.groupby().agg() or pose_distribution_block), savestar writes it as well
+		data_block_name = self.new_data_block_name(block_name or str(block), len(self.data_block_names), "new data blocks")
+		block.objname = data_block_name
+		self.data_block_names.append(data_block_name)
+		setattr(self, data_block_name, block)
+	
+	
 	def savestar(self, fileout, data_blocks_list=None, reset_col=False):
 		# data_blocks_list		(list) names of the data blocks to write. Default: (None type) = all
 		# reset_col				(bool) if set then the column write list will be reset and all available columns will be written. 
@@ -247,49 +469,387 @@ class starfile():
 			
 			block = getattr(self, blockname)
 			self.verbose( "Preparing to write %s " % block )
-			
-			####### generate meta data header for block:
 			columns2write = list(block.make_write_column_list(reset=reset_col)) # list
-			header="%s\n\nloop_\n" % blockname
-			cols = [ "%s #%i" % (colname, idx+1) for idx,colname in enumerate(columns2write) ]
-			header += "\n".join(cols)
-			
-			####### generate dtype string for data:
-			fmt_data_arr = []
-			for name in columns2write: 
-				try: dtype = block.dict_colname_dtype[name]
-				except KeyError:  dtype = self.default_string_dtype
-				fmt_data_arr.append(self.dtype_one_letter_to_formating_str(dtype))
-				#else: fmt_data_arr.append('%s')
-			fmt_data_str = "\t".join(fmt_data_arr)
+			self.write_block_header(f, blockname, columns2write)
+			n = self.write_block_rows(f, block, columns2write)
+			f.write("\n\n")
+			self.verbose("%d elements saved in data block %s" % (n,blockname))
+		f.close()
+		self.verbose("File saved: %s" % fileout)
+	
+	
+	def write_block_header(self, f, blockname, columns2write):
+		####### generate meta data header for block:
+		header="%s\n\nloop_\n" % blockname
+		cols = [ "%s #%i" % (colname, idx+1) for idx,colname in enumerate(columns2write) ]
+		header += "\n".join(cols)
+		f.write(header+"\n")
+	
+	
+	def write_block_rows(self, f, block, columns2write, chunk_rows=2**15):
+		# writes the data rows of a block (without header), returns the number of rows
+		# The rows are formatted in chunks of chunk_rows rows directly from the columns (no repacked copy of the array) 
+		# and each chunk is written to f before the next one is formatted.
+		# Columns of a lazy data block that were never accessed are written as raw text (see starfile(lazy=True)).
+		# The rows of a data_block_view are gathered one chunk at a time.
+		# Each row is formatted with one '%' of the row format (C loop over the python scalars of the row). Formatting 
+		# each column with np.char.mod / np.strings and joining the string columns is 3-8x slower: the fixed width 
+		# string arrays are copied at every join.
+		if isinstance(block, data_block_view) and block.materialized is None:
+			return sum([ self.write_block_rows(f, block.materialize(start, start+chunk_rows), columns2write, chunk_rows) for start in range(0, len(block), chunk_rows) ])
+		if isinstance(block, data_block_view): block = block.materialized
+		raw = getattr(block.data_array, "raw", None)
+		raw_columns = [ name for name in columns2write if raw is not None and name not in block.data_array.columns ]
+		
+		####### generate dtype string for data:
+		fmt_data_arr = []
+		for name in columns2write: 
+			try: dtype = block.dict_colname_dtype[name]
+			except KeyError:  dtype = self.default_string_dtype
+			if name in raw_columns: fmt_data_arr.append('%s')
+			else: fmt_data_arr.append(self.dtype_one_letter_to_formating_str(dtype))
+			#else: fmt_data_arr.append('%s')
+		fmt_row = "\t".join(fmt_data_arr) + "\n"
+		
+		####### column selection to write:
+		self.verbose("Columns to write:")
+		self.verbose(columns2write, pp=True)
+		n = len(block.data_array)
+		nchar = 0
+		start_time = time.time()
+		for start in range(0, n, chunk_rows):
+			stop = min(n, start+chunk_rows)
+			if len(raw_columns) > 0: raw_tokens = dict(zip(raw_columns, raw.token_columns(raw_columns, start, stop)))
+			columns = [ raw_tokens[name] if name in raw_columns else block.export_column(name, start, stop).tolist() for name in columns2write ] # python scalars: same text as numpy scalars, '%r' gives 1 instead of np.int8(1)
+			text = "".join(map(fmt_row.__mod__, zip(*columns)))
+			f.write(text)
+			nchar += len(text)
+		elapsed = time.time() - start_time
+		self.verbose("%d rows (%.1f MB) written in %.2f s (%.1f MB/s)" % (n, nchar/1e6, elapsed, nchar/1e6/max(elapsed, 1e-9)))
+		return n
+	
+	
+	def savestar_batches(self, fileout, block_name, batches, data_blocks_list=None):
+		# Writes the star file like savestar, but the rows of block_name are replaced by the rows of the data blocks 
+		# generated by batches (e.g. one transformed copy of the block per transformation = combined/expanded star file).
+		# The batches are written one after the other, only one batch has to be in memory.
+		# block_name		(str) data block that is replaced
+		# batches			iterable of data_block objects with the same columns (can be the same object modified in place)
+		# data_blocks_list	(list) names of the data blocks to write. Default: (None type) = all
+		if data_blocks_list is None: data_blocks_list = self.data_block_names
+		f = open(fileout, "w")
+		for blockname in data_blocks_list:
+			block = getattr(self, blockname)
+			if blockname != block_name:
+				columns2write = list(block.make_write_column_list())
+				self.write_block_header(f, blockname, columns2write)
+				self.write_block_rows(f, block, columns2write)
+				f.write("\n\n")
+				continue
+			n = 0
+			columns2write = None
+			for batch_idx, batch in enumerate(batches):
+				if columns2write is None: 
+					columns2write = list(batch.make_write_column_list())
+					self.write_block_header(f, blockname, columns2write)
+				elif list(batch.make_write_column_list()) != columns2write: sys.exit("ERROR: All batches of %s must have the same columns!" % blockname)
+				n += self.write_block_rows(f, batch, columns2write)
+				self.verbose("Batch %d: %d rows of %s written" % (batch_idx+1, n, blockname))
+			if columns2write is None: self.write_block_header(f, blockname, list(block.make_write_column_list())) # no batches
+			f.write("\n\n")
+		f.close()
+		self.verbose("File saved: %s" % fileout)
+	
+	
+	def process_star_file_in_chunks(self, fname, fileout, func, chunk_size=None, chunked_blocks=("data_particles",), jobs=1):
+		# Reads fname and writes fileout block by block without keeping the chunked blocks in memory:
+		# the rows of the chunked blocks are parsed in batches of chunk_size rows. Each batch is handed to func as 
+		# data_block, which can modify it in place (e.g. apply a coordinate transformation), and is written before the next batch is read.
+		# With jobs > 1 the batches are parsed, processed and formatted in a pool of worker processes (see process_rows_parallel).
+		# All other blocks (e.g. data_optics) are read completely, written unchanged and are available as attributes afterwards.
+		# The output is identical to reading the whole file, calling func on the chunked blocks and savestar.
+		# fname				(str) input star file
+		# fileout			(str) output star file
+		# func				function(data_block, batch_idx), called for each batch. Must be picklable (module level function or functools.partial) for jobs > 1
+		# chunk_size		(int) number of rows per batch. Default: complete block (jobs = 1) or 2**16 rows (jobs > 1)
+		# chunked_blocks	(list) names of the data blocks that are read in batches
+		# jobs				(int) number of worker processes
+		stream = star_stream(self.openfile(fname))
+		f = open(fileout, "w")
+		block_idx = -1
+		while True:
+			block_name = stream.next_data_block()
+			if block_name is None: break
+			block_idx += 1
+			self.verbose("-------------------------------------------------" )
+			self.verbose("Reading data block %d (%s)" % (block_idx+1, block_name) )
+			colum_positions, colum_positions_inv, dtype_assignment = self.read_loop_header(stream, block_name)
+			data_block_name = self.new_data_block_name(block_name, block_idx, fname)
+			self.data_block_names.append(data_block_name)
 			
-			####### column selection to write:
-			self.verbose("Columns to write:")
-			self.verbose(columns2write, pp=True)
-			s = StringIO()
-			#print(block.data_array[columns2write])
-			write_array = rf.repack_fields(block.data_array[columns2write]) #### In some numpy version there is a problem with views: '1.16.2' ... Indexing works differently ... so repack
-			#print block.data_array[columns2write]
-			#print columns2write
-			#print "list(block.data_array.dtype.names)"
-			#print list(block.data_array.dtype.names)
+			if data_block_name not in chunked_blocks:
+				block = self.make_data_block(self.read_rows(stream.row_chunks(), dtype_assignment), colum_positions_inv, colum_positions, dtype_assignment, data_block_name)
+				setattr(self, data_block_name, block)
+				columns2write = list(block.make_write_column_list())
+				self.write_block_header(f, data_block_name, columns2write)
+				self.write_block_rows(f, block, columns2write)
+				f.write("\n\n")
+				continue
 			
-			#print(fmt_data_str)
-			np.savetxt(s, write_array[columns2write], fmt=fmt_data_str, header=header, comments='')
-			f.write(s.getvalue()+"\n\n")
-			self.verbose("%d elements saved in data block %s" % (len(write_array),blockname))
+			layout = (dtype_assignment, colum_positions_inv, colum_positions, data_block_name)
+			if jobs > 1: batches = self.process_rows_parallel(stream, func, chunk_size, jobs, layout)
+			else: batches = ( self.process_rows(text, func, batch_idx, layout) for batch_idx, text in enumerate(stream.row_batches(chunk_size)) )
+			n = 0
+			columns2write = None
+			for batch_idx, (batch_columns, text, nrows) in enumerate(batches):
+				if batch_columns is None: continue # batch without data rows
+				if columns2write is None: 
+					columns2write = batch_columns
+					self.write_block_header(f, data_block_name, columns2write)
+				elif batch_columns != columns2write: sys.exit("ERROR: All batches of %s must have the same columns!" % data_block_name)
+				f.write(text)
+				n += nrows
+				self.verbose("Batch %d: %d rows of %s written" % (batch_idx+1, n, data_block_name))
+			if columns2write is None: self.write_block_header(f, data_block_name, [ colum_positions_inv[i] for i in sorted(colum_positions_inv) ]) # empty block
+			f.write("\n\n")
+		
+		self.lines_in_data_star = stream.line_count
+		stream.close()
 		f.close()
 		self.verbose("File saved: %s" % fileout)
 	
+	
+	def read_data_block(self, fname, block_name):
+		# reads only the data block block_name of fname (e.g. data_optics of a large particle star file), which is 
+		# available as attribute afterwards and returned. The blocks before it are skipped, the rest of the file is not read.
+		stream = star_stream(self.openfile(fname))
+		block_idx = -1
+		while True:
+			name = stream.next_data_block()
+			if name is None: 
+				stream.close()
+				sys.exit("ERROR: Data block %s does not exist in %s!" % (block_name, fname))
+			block_idx += 1
+			if name.replace(" ", "") != block_name: continue # next_data_block skips the rows
+			colum_positions, colum_positions_inv, dtype_assignment = self.read_loop_header(stream, name)
+			data_block_name = self.new_data_block_name(name, block_idx, fname)
+			self.data_block_names.append(data_block_name)
+			block = self.make_data_block(self.read_rows(stream.row_chunks(), dtype_assignment), colum_positions_inv, colum_positions, dtype_assignment, data_block_name)
+			setattr(self, data_block_name, block)
+			stream.close()
+			return block
+	
+	
+	def process_rows(self, text, func, batch_idx, layout):
+		# parses the data rows in text, applies func and formats the rows for writing
+		# layout = (dtype_assignment, colum_positions_inv, colum_positions, data_block_name)
+		# returns (list of columns to write, formatted rows, number of rows); (None, "", 0) if text contains no data rows
+		dtype_assignment, colum_positions_inv, colum_positions, data_block_name = layout
+		if text.strip() == "": return None, "", 0
+		data_array = compact_string_columns(self.parse_rows([text], dtype_assignment))
+		block = self.make_data_block(data_array, colum_positions_inv, colum_positions, dtype_assignment, data_block_name)
+		func(block, batch_idx)
+		columns2write = list(block.make_write_column_list())
+		s = StringIO()
+		n = self.write_block_rows(s, block, columns2write)
+		return columns2write, s.getvalue(), n
+	
+	
+	def process_rows_parallel(self, stream, func, chunk_size, jobs, layout):
+		# generator over the processed batches (see process_rows) of the current loop, in the order of the rows.
+		# The rows are read in batches of chunk_size rows (default: 2**16), each batch is copied into its own shared memory 
+		# segment. Parsing, func and formatting run in a pool of jobs worker processes, which only receive the segment name
+		# and return the formatted rows (pickled). At most 2*jobs batches are read ahead, i.e. the memory is bounded by 
+		# about 2*jobs input batches and their formatted rows, independent of the size of the loop.
+		if chunk_size is None: chunk_size = 2**16
+		self.verbose("Batches of %d rows are processed by %d worker processes" % (chunk_size, jobs))
+		batches = stream.row_batches(chunk_size)
+		settings = {"verbosity":False, "parser":self.parser, "split_image_name":self.split_image_name}
+		
+		# fork (if available) avoids re-importing the calling script in every worker
+		if "fork" in multiprocessing.get_all_start_methods(): context = multiprocessing.get_context("fork")
+		else: context = multiprocessing.get_context()
+		pending = collections.deque() # (shared memory, result) of the submitted batches, in the order of the rows
+		resource_tracker.ensure_running() # before the fork: the workers share it and do not report the segments as leaked
+		try:
+			with context.Pool(jobs) as pool:
+				for batch_idx, text in enumerate(batches):
+					text = text.encode()
+					shm = shared_memory.SharedMemory(create=True, size=max(1, len(text)))
+					shm.buf[:len(text)] = text
+					pending.append((shm, pool.apply_async(process_rows_worker, ((shm.name, len(text), func, batch_idx, settings, layout),))))
+					del text
+					while len(pending) >= 2*jobs: yield self.finish_batch(*pending.popleft())
+				while len(pending) > 0: yield self.finish_batch(*pending.popleft())
+		finally:
+			for shm, result in pending: 
+				shm.close()
+				shm.unlink()
+	
+	
+	def finish_batch(self, shm, result):
+		# waits for the result of a batch (see process_rows_parallel) and frees its shared memory
+		try: return result.get()
+		finally: 
+			shm.close()
+			shm.unlink()
+	
+	
+	def to_arrow(self, data_blocks_list=None):
+		# returns a dict data block name : pyarrow.Table (requires pyarrow)
+		# Numeric columns are passed to Arrow without copying, string columns (and split image names) are converted to Arrow strings.
+		# The schema metadata ("starfile") stores the block name and position, the column numbers and the relion3_1 data type letters 
+		# so that from_arrow restores the data blocks.
+		# data_blocks_list		(list) names of the data blocks. Default: (None type) = all
+		pa = import_optional("pyarrow")
+		if data_blocks_list is None: data_blocks_list = self.data_block_names
+		tables = {}
+		for block_idx, blockname in enumerate(data_blocks_list):
+			block = getattr(self, blockname)
+			names = list(block.data_array.names)
+			arrays = [ pa.array(block.export_column(n)) for n in names ]
+			meta_data = { 
+				"block" : blockname, 
+				"block_index" : block_idx, 
+				"colnums" : { n : block.dict_colname_colnum[n] for n in names }, 
+				"dtypes" : { n : block.dict_colname_dtype.get(n, self.default_string_dtype) for n in names } 
+			}
+			tables[blockname] = pa.Table.from_arrays(arrays, names=names, metadata={ "starfile" : json.dumps(meta_data) })
+		return tables
+	
+	
+	def from_arrow(self, tables):
+		# adds data blocks from pyarrow Tables (dict data block name : Table or list of Tables written by to_arrow)
+		# Tables from other sources (e.g. pandas or Polars) are accepted as well: the column order is used as column numbers
+		# and the data type letters are taken from relion3_1 or derived from the Arrow types.
+		# Numeric columns without missing values are used without copying (read-only until they are modified, see column_array).
+		if isinstance(tables, dict): tables = list(tables.items())
+		else: tables = [ (None, table) for table in tables ]
+		
+		for name, table in tables:
+			meta_data = {}
+			if table.schema.metadata is not None and b"starfile" in table.schema.metadata: meta_data = json.loads(table.schema.metadata[b"starfile"])
+			if name is None: name = meta_data.get("block", "data_")
+			columns = { n : arrow_to_numpy(table.column(n)) for n in table.column_names }
+			colnums = meta_data.get("colnums", { n : idx+1 for idx, n in enumerate(table.column_names) })
+			colnums = { n : colnums[n] for n in table.column_names } # only the columns read (e.g. read_parquet with columns)
+			dtypes = meta_data.get("dtypes", {})
+			dtype_assignment = [ (n, dtypes.get(n, self.assign_dtype.get(n, dtype_to_string_letter(columns[n].dtype.str)))) for n in table.column_names ]
+			data_block_name = self.new_data_block_name(name, len(self.data_block_names), "Arrow tables")
+			block = data_block(column_array(columns, table.column_names), { colnums[n] : n for n in table.column_names }, colnums, dtype_assignment, objname=data_block_name)
+			if self.split_image_name and "_rlnImageName" in columns: block.split_image_name("_rlnImageName")
+			self.data_block_names.append(data_block_name)
+			setattr(self, data_block_name, block)
+	
+	
+	def save_parquet(self, directory, data_blocks_list=None, compression="zstd"):
+		# writes each data block to directory/<data block name>.parquet (requires pyarrow, see to_arrow)
+		pq = import_optional("pyarrow.parquet")
+		if not os.path.isdir(directory): os.makedirs(directory)
+		for blockname, table in self.to_arrow(data_blocks_list).items():
+			pq.write_table(table, os.path.join(directory, blockname + ".parquet"), compression=compression)
+			self.verbose("%d elements saved in %s" % (table.num_rows, os.path.join(directory, blockname + ".parquet")))
+	
+	
+	def read_parquet(self, directory, columns=None, filters=None):
+		# reads the data blocks written by save_parquet (in their original order)
+		# columns	(dict) data block name : list of columns to read. Default: all columns
+		# filters	(dict) data block name : filter in pyarrow.parquet.read_table syntax, e.g. 
+		#			{ "data_particles" : [("_rlnClassNumber", "=", 3)] }. Only matching rows are read (predicate pushdown).
+		pq = import_optional("pyarrow.parquet")
+		if not os.path.isdir(directory): sys.exit("ERROR: %s does not exist!" % directory)
+		if columns is None: columns = {}
+		if filters is None: filters = {}
+		files = {}
+		for fname in sorted(os.listdir(directory)):
+			if not fname.endswith(".parquet"): continue
+			meta_data = pq.read_schema(os.path.join(directory, fname)).metadata or {}
+			block_index = json.loads(meta_data[b"starfile"])["block_index"] if b"starfile" in meta_data else len(files)
+			files[fname] = block_index
+		tables = []
+		for fname in sorted(files, key=lambda i: files[i]):
+			blockname = self.strip_end(fname, ".parquet")
+			tables.append((blockname, pq.read_table(os.path.join(directory, fname), columns=columns.get(blockname), filters=filters.get(blockname))))
+		self.from_arrow(dict(tables))
+	
+	
+	def save_hdf5(self, fname, data_blocks_list=None, chunk_rows=2**16, compression="gzip"):
+		# writes the data blocks into a chunked, compressed HDF5 container (requires h5py):
+		#	/<data block name>/columns/<column name>	one dataset per column, chunks of chunk_rows rows
+		#	/<data block name>/image_stacks				stack file names of a split image name column
+		# The group attributes store the block position, column order, column numbers, data type letters and the 
+		# split image name attributes. read_hdf5 restores the data blocks, savestar writes the same text as before.
+		# String columns are stored as UTF-8 encoded fixed length byte strings.
+		h5py = import_optional("h5py")
+		if data_blocks_list is None: data_blocks_list = self.data_block_names
+		with h5py.File(fname, "w") as f:
+			for block_idx, blockname in enumerate(data_blocks_list):
+				block = getattr(self, blockname)
+				group = f.create_group(blockname)
+				names = list(block.data_array.names)
+				group.attrs["block_index"] = block_idx
+				group.attrs["starfile"] = json.dumps({ 
+					"columns" : names,
+					"colnums" : { n : block.dict_colname_colnum[n] for n in names }, 
+					"dtypes" : { n : block.dict_colname_dtype.get(n, self.default_string_dtype) for n in names },
+					"image_name_column" : block.image_name_column,
+					"image_index_width" : block.image_index_width
+				})
+				columns = group.create_group("columns")
+				for n in names:
+					col = block.data_array[n]
+					if is_string_dtype(col.dtype): col = np.char.encode(col, "utf-8")
+					chunks = (max(1, min(chunk_rows, len(col))),) if len(col) > 0 else None
+					columns.create_dataset(n, data=col, chunks=chunks, compression=compression if chunks else None)
+				if block.image_stacks is not None: group.create_dataset("image_stacks", data=np.char.encode(block.image_stacks, "utf-8"))
+				self.verbose("%d elements saved in %s:/%s" % (len(block.data_array), fname, blockname))
+	
+	
+	def read_hdf5(self, fname, rows=None, columns=None, data_blocks_list=None):
+		# reads the data blocks of a container written by save_hdf5 (requires h5py). Only the requested rows and 
+		# columns are read from disk (the datasets are chunked).
+		# rows				(dict) data block name : (start, stop) row range. Default: all rows
+		# columns			(dict) data block name : list of columns to read. Default: all columns
+		# data_blocks_list	(list) names of the data blocks to read. Default: all
+		h5py = import_optional("h5py")
+		if not os.path.isfile(fname): sys.exit("ERROR: %s does not exist!" % fname)
+		if rows is None: rows = {}
+		if columns is None: columns = {}
+		with h5py.File(fname, "r") as f:
+			blocknames = sorted(f.keys(), key=lambda i: f[i].attrs["block_index"])
+			if data_blocks_list is not None: blocknames = [ i for i in blocknames if i in data_blocks_list ]
+			for blockname in blocknames:
+				group = f[blockname]
+				meta_data = json.loads(group.attrs["starfile"])
+				names = [ n for n in meta_data["columns"] if n in columns.get(blockname, meta_data["columns"]) ]
+				row_slice = slice(*rows.get(blockname, (None, None)))
+				data = {}
+				for n in names:
+					col = group["columns"][n][row_slice]
+					if col.dtype.kind == "S": col = np.char.decode(col, "utf-8")
+					data[n] = np.atleast_1d(col)
+				colnums = { n : meta_data["colnums"][n] for n in names }
+				dtype_assignment = [ (n, meta_data["dtypes"][n]) for n in names ]
+				data_block_name = self.new_data_block_name(blockname, len(self.data_block_names), fname)
+				block = data_block(column_array(data, names), { colnums[n] : n for n in names }, colnums, dtype_assignment, objname=data_block_name)
+				if meta_data["image_name_column"] in names:
+					block.image_name_column = meta_data["image_name_column"]
+					block.image_stacks = np.char.decode(group["image_stacks"][()], "utf-8")
+					block.image_index_width = meta_data["image_index_width"]
+				self.data_block_names.append(data_block_name)
+				setattr(self, data_block_name, block)
+	
+	
 	def dtype_one_letter_to_formating_str(self, dtype):
 		d = { 
 			'i' : '%d',
 			'f' : '%06f',
-			'b' : '%r',
+			'b' : '%d', # bool columns (e.g. from add_column) as 0/1, as read by relion
 			self.default_string_dtype: '%s'
 		}
 		try: return d[dtype]
 		except KeyError: 
+			if is_string_dtype(dtype): return "%s" # string column of any length
 			print("WARNING: dtype (%s) not identified! Using default: %s " % (dtype, "%s"))
 			return "%s"
 
@@ -298,14 +858,20 @@ class data_block():
 	
 	
 	def __init__(self, data_array, dict_colnum_colname, dict_colname_colnum, arr_col_dtype_assignment, objname=None):
+		# data_array	structured array or column_array. The columns are stored as separate contiguous arrays (column_array), 
+		#				adding, deleting, renaming and reordering columns does not copy the other columns.
 		self.data_array					= data_array
 		self.dict_colnum_colname		= dict_colnum_colname
 		self.dict_colname_colnum		= dict_colname_colnum
 		self.arr_col_dtype_assignment	= arr_col_dtype_assignment
 		self.dict_colname_dtype			= { colname : dtype for colname, dtype in arr_col_dtype_assignment }
 		self.objname					= objname
-		self.default_string_dtype 		= "S1000" #### NOTE: THIS EXISTS TWICE!!! ALSO IN STARFILE CLASS ... inherit didn't work, calling from other class did not work ...
+		self.default_string_dtype 		= default_string_dtype # same as in the starfile class (module level)
 		self.write_column_list			= []
+		# split image name column (see split_image_name)
+		self.image_name_column			= None # name of the split column (usually _rlnImageName)
+		self.image_stacks				= None # array with the stack file names
+		self.image_index_width			= 0 # zero padding of the slice numbers, e.g. 6 for 000001@stack.mrcs
 	
 	
 	def __str__(self):
@@ -313,6 +879,20 @@ class data_block():
 		else: return self.objname
 	
 	
+	@property
+	def data_array(self):
+		# column_array with the interface of a structured array: data_array["_rlnAngleRot"] is the (contiguous) column,
+		# data_array[["_rlnAngleRot", "_rlnAngleTilt"]], data_array[rows] and np.asarray(data_array) return structured arrays (copies)
+		return self.column_store
+	
+	
+	@data_array.setter
+	def data_array(self, value):
+		# a structured array is split into its columns
+		if isinstance(value, column_array): self.column_store = value
+		else: self.column_store = structured_to_columns(value)
+	
+	
 	def write_exclude_column(self, *args):
 		# if the write-out list is empty --> pre-fill it with all columns (sorted by the original column number to preserve the order)
 		if len(self.write_column_list) == 0 : self.write_column_list = [ colname for colname, colnum in sorted(list(self.dict_colname_colnum.items()), key=lambda item: item[1]) ]
@@ -339,7 +919,7 @@ class data_block():
 	
 	
 	def check_colname_exists(self, colname):
-		if colname in self.data_array.dtype.names: return True
+		if colname in self.data_array.names: return True
 		else: False
 	
 	
@@ -362,63 +942,40 @@ class data_block():
 				 raise Exception("ERROR: Either provide a column name or provide a structured array that already has a name!")
 			elif column_name is not None and value.dtype.names is None: 
 				if value.ndim > 1: raise Exception("ERROR: You cannot provide a multidimensional array that is not structured with only one column name! If you want to add several columns you have to add a structured array that has already column names!")
-				value.dtype=[( self.leading_underscore(column_name) , value.dtype[0].str)]
+				new_columns = [ (column_name, np.array(value)) ]
 			else: # A structured array was provided (has already a column name(s))
 				if column_name is not None : # This can be only a structured array with 1 column
 					if len(value.dtype.names) > 1: raise Exception("Sorry, cannot rename several columns with one column name!")
-					verbose("The preexisting column name (%s) will be renamed to %s." % (value.dtype.names[0], self.leading_underscore(column_name)))
-					value.dtype.names = (self.leading_underscore(column_name),) # rename the column if an extra column name was provided
+					verbose("The preexisting column name (%s) will be renamed to %s." % (value.dtype.names[0], column_name))
+					new_columns = [ (column_name, np.array(value[value.dtype.names[0]])) ] # rename the column if an extra column name was provided
 				else: ### This can be a structured array with several columns
-					value.dtype.names = tuple([self.leading_underscore(n) for n in value.dtype.names])
-			
-			if len(value.dtype.names) > 1 : ### adding multidimensional startured array!
-				verbose("You provided a structured array with more than one column: %s " % ",".join(list(value.dtype.names)))
-				
-				for idx,n in enumerate(value.dtype.names): 
-					if self.check_colname_exists(n):  raise Exception("ERROR: The new column name %s already exists!" % n)
-					elif n == '':  raise Exception("ERROR: The new column name %s is empty!" % n)
-					### add column to dict_colname_colnum and dict_colnum_colname
-					self.dict_colname_colnum[str(n)] = max(self.dict_colname_colnum.values())+1
-					self.dict_colnum_colname[self.dict_colname_colnum[str(n)]] = str(n)
-					self.dict_colname_dtype[str(n)] = self.arr_dtype_to_string_letter(value.dtype[idx].str)
-				dtype_descr = value.dtype.descr # e.g. [('LALALA', '<i8')]
-			elif len(value.dtype.names) == 1: # A 1 column structured array was provided (has already a column name)
-				dtype_descr = value.dtype.descr  # e.g. [('LALALA', '<i8'), ('LULULU', '<f4')]]
-				### add column to dict_colname_colnum and dict_colnum_colname
-				self.dict_colname_colnum[column_name] = max(self.dict_colname_colnum.values())+1
-				self.dict_colnum_colname[self.dict_colname_colnum[ column_name ]] = column_name
-				self.dict_colname_dtype[ column_name ] = self.arr_dtype_to_string_letter(value.dtype[0].str)
-			else: raise Exception("Something is weird with the array that you try to add as column!")
-			new_col = value
+					new_columns = [ (self.leading_underscore(n), np.array(value[n])) for n in value.dtype.names ]
+				if len(new_columns) > 1: verbose("You provided a structured array with more than one column: %s " % ",".join([ n for n, new_col in new_columns ]))
 		
 		else: # value is a constant and a column with this constant will be added
 			if column_name is None: raise Exception("You didn't provide a column name!")
-			if type(value) is str: new_col = np.array([value]*len(self.data_array), dtype=[( column_name, self.default_string_dtype )])
-			else: new_col = np.full(self.data_array.shape, value, dtype=[( column_name, type(value) )]) #### This will vail if it is a string (without raising an error!)
-			dtype_descr = new_col.dtype.descr  
-			self.dict_colname_colnum[str(column_name)] = max(self.dict_colname_colnum.values())+1
-			self.dict_colnum_colname[self.dict_colname_colnum[str(column_name)]] = str(column_name)
-			self.dict_colname_dtype[str(column_name)] = self.arr_dtype_to_string_letter(new_col.dtype[0].str)
-		
-		### to add the new column(s) we have to create a new (empty) array with all columns and rows:
-		new_arr = np.zeros(
-			self.data_array.shape, 
-			dtype=self.data_array.dtype.descr+new_col.dtype.descr
-		)
-		# now fill it
-		new_arr[list(self.data_array.dtype.names)][:] = self.data_array # old data
-		new_arr[list(new_col.dtype.names)][:] = new_col # new column
-		self.data_array = new_arr # overwrite old array with new array containing the new column(s)
-		del(new_col) # clean up memory, usefull if new_col is large!
-		del(new_arr) # clean up memory, usefull if new_arr is large!
+			if type(value) is str: new_columns = [ (column_name, np.full(self.data_array.shape, value, dtype='U%d' % max(1, len(value)))) ] # compact string column
+			else: new_columns = [ (column_name, np.full(self.data_array.shape, value, dtype=type(value))) ]
+		
+		for n, new_col in new_columns: 
+			if self.check_colname_exists(n):  raise Exception("ERROR: The new column name %s already exists!" % n)
+			elif n == '_':  raise Exception("ERROR: The new column name %s is empty!" % n)
+		
+		### only the new column(s) are allocated, the existing columns are not copied:
+		for n, new_col in new_columns:
+			### add column to dict_colname_colnum and dict_colnum_colname
+			self.dict_colname_colnum[str(n)] = max(self.dict_colname_colnum.values())+1
+			self.dict_colnum_colname[self.dict_colname_colnum[str(n)]] = str(n)
+			self.dict_colname_dtype[str(n)] = self.arr_dtype_to_string_letter(new_col.dtype.str)
+			self.data_array.add(str(n), new_col)
 		
 	def del_columns(self, *columns):
 		columns = [ self.leading_underscore(c) for c in columns]
+		if self.image_name_column in columns: self.image_name_column, self.image_stacks = None, None
 		#delete from data_array:
 		for c in columns: 
 			if not self.check_colname_exists(c): raise ValueError("Column %s cannot be deleted, because it does not exist!" % c) 
-		new_column_selection = [ c for c in self.data_array.dtype.names if c not in columns ]
-		self.data_array = rf.repack_fields(self.data_array[new_column_selection])
+		self.data_array.delete(columns)
 		#delete from dictionaries:
 		for c in columns: 
 			if c in list(self.dict_colname_colnum.keys()): 
@@ -431,7 +988,8 @@ class data_block():
 		column_name_old=self.leading_underscore(column_name_old)
 		if self.check_colname_exists(column_name_new): raise Exception("ERROR: New colname %s already exists" % column_name_new)
 		if column_name_old not in self.data_array.dtype.names: raise Exception("ERROR: Old colname %s does not exists" % column_name_old)
-		self.data_array.dtype.names = tuple([ column_name_new if n == column_name_old else n for n in self.data_array.dtype.names])
+		self.data_array.rename(column_name_old, column_name_new)
+		if self.image_name_column == column_name_old: self.image_name_column = column_name_new
 		#update other dicts:
 		self.dict_colname_colnum[column_name_new] = self.dict_colname_colnum.pop(column_name_old)
 		self.dict_colnum_colname[self.dict_colname_colnum[column_name_new]] = column_name_new
@@ -444,18 +1002,7 @@ class data_block():
 	#	else: return False
 	
 	def arr_dtype_to_string_letter(self, dtype):
-		d = {
-			'<f4' : 'f',
-			'<f8' : 'f',
-			'|S1000' : self.default_string_dtype,
-			'<i8' : 'i',
-			'<i4' : 'i',
-			'|b1' : 'b'
-		}
-		try: return  d[dtype]
-		except KeyError: 
-			print("WARNING: dtype (%s) not identified! Using default: %s " % (dtype, self.default_string_dtype))
-			return self.default_string_dtype
+		return dtype_to_string_letter(dtype)
 	
 	#def replace_column(self, col):
 	#	# not required!!
@@ -479,25 +1026,185 @@ class data_block():
 		self.dict_colnum_colname[colnum_col1]=colname_col2
 		self.dict_colnum_colname[colnum_col2]=colname_col1
 		
-		dcoln = list(self.data_array.dtype.names)
+		dcoln = list(self.data_array.names)
 		idxc1 = dcoln.index(col1)
 		idxc2 = dcoln.index(col2)
 		dcoln[idxc1], dcoln[idxc2] = dcoln[idxc2], dcoln[idxc1]
-		self.data_array = self.data_array[dcoln]
+		self.data_array.reorder(dcoln)
 		
 	
 	def column_set_constant(self, column, value):
 		column = self.leading_underscore(column)
 		if not self.check_colname_exists(column): raise ValueError("Column %s does not exist!" % column)
 		else:
+			if column == self.image_name_column and type(value) is str: 
+				encoded = encode_image_names(np.array([value]))
+				if encoded is None or encoded[3] != self.image_index_width: self.join_image_name() # does not fit into the split column
+				else:
+					if encoded[2][0] not in self.image_stacks: self.image_stacks = np.append(self.image_stacks, encoded[2])
+					self.data_array[column]["index"] = encoded[0][0]
+					self.data_array[column]["stack"] = np.flatnonzero(self.image_stacks == encoded[2][0])[0]
+					return self.data_array[[column]]
+			
 			dtype = self.data_array.dtype.fields[column][0]
-			col_old = self.data_array[[column]]
+			if type(value) is str and is_string_dtype(dtype) and len(value) > string_dtype_width(dtype): 
+				# compact string column is too short for the new value
+				self.data_array.replace(column, self.data_array[column].astype("U%d" % len(value)))
+				dtype = self.data_array.dtype.fields[column][0]
 			
 			if type(value) is str: new_col = np.array([value]*len(self.data_array), dtype=[( column, dtype )])
 			else: new_col = np.full(self.data_array.shape, value, dtype=[( column, dtype )]) #### This will vail if it is a string (without raising an error!)
 			self.data_array[[column]] = new_col
 			return new_col
 	
+	def split_image_name(self, column="_rlnImageName"):
+		# Replaces a string column with image names (e.g. "000001@Extract/job007/stack.mrcs") by two int32 fields:
+		#	data_array[column]["index"]		slice number in the stack (e.g. 1)
+		#	data_array[column]["stack"]		row of the stack file name in self.image_stacks
+		# Grouping, sorting and joining by stack/slice become integer operations. The strings are only rebuilt 
+		# for writing (see export_array, image_names).
+		# Returns False (and keeps the strings) if the names cannot be rebuilt exactly, e.g. missing "@" or mixed zero padding.
+		column = self.leading_underscore(column)
+		if not self.check_colname_exists(column) or not is_string_dtype(self.data_array.dtype.fields[column][0]): return False
+		encoded = encode_image_names(self.data_array[column])
+		if encoded is None: return False
+		index, stack, self.image_stacks, self.image_index_width = encoded
+		
+		new_col = np.empty(self.data_array.shape, dtype=[("index", "<i4"), ("stack", "<i4")])
+		new_col["index"] = index
+		new_col["stack"] = stack
+		self.data_array.replace(column, new_col)
+		self.image_name_column = column
+		return True
+	
+	
+	def join_image_name(self):
+		# converts a split image name column back into a string column
+		if self.image_name_column is None: return
+		self.data_array.replace(self.image_name_column, self.image_names())
+		self.image_name_column, self.image_stacks = None, None
+	
+	
+	def image_names(self):
+		# returns the image names of a split image name column as string array (e.g. "000001@stack.mrcs")
+		if self.image_name_column is None: raise Exception("ERROR: No split image name column!")
+		col = self.data_array[self.image_name_column]
+		return decode_image_names(col["index"], col["stack"], self.image_stacks, self.image_index_width)
+	
+	
+	def export_column(self, column, start=None, stop=None):
+		# returns the rows start:stop of a column for writing. A split image name column is converted back to strings.
+		if column != self.image_name_column: return self.data_array[column][start:stop]
+		col = self.data_array[column][start:stop]
+		return decode_image_names(col["index"], col["stack"], self.image_stacks, self.image_index_width)
+	
+	
+	def export_array(self, columns):
+		# returns a (packed) structured array with the given columns for writing. A split image name column is converted back to strings.
+		if self.image_name_column not in columns: return rf.repack_fields(self.data_array[columns]) #### In some numpy version there is a problem with views: '1.16.2' ... Indexing works differently ... so repack
+		names = self.image_names()
+		arr = np.empty(self.data_array.shape, dtype=[ (c, names.dtype) if c == self.image_name_column else (c, self.data_array.dtype.fields[c][0]) for c in columns ])
+		for c in columns: arr[c] = names if c == self.image_name_column else self.data_array[c]
+		return arr
+	
+	
+	def load_columns(self, *columns):
+		# parses the given columns of a lazy data block in one pass (see starfile(lazy=True)), no effect otherwise
+		self.data_array.load([ self.leading_underscore(c) for c in columns ])
+	
+	
+	def take(self, rows):
+		# returns a new data block with the given rows (any numpy index, e.g. a boolean mask or np.repeat(np.arange(n), k))
+		new = copy.copy(self)
+		new.data_array = column_array({ n : self.data_array[n][rows] for n in self.data_array.names }, self.data_array.names)
+		new.dict_colnum_colname = dict(self.dict_colnum_colname)
+		new.dict_colname_colnum = dict(self.dict_colname_colnum)
+		new.dict_colname_dtype = dict(self.dict_colname_dtype)
+		new.arr_col_dtype_assignment = list(self.arr_col_dtype_assignment)
+		new.write_column_list = list(self.write_column_list)
+		return new
+	
+	
+	def query_column(self, column, rows=None):
+		# values of a column (for rows, any numpy index) for queries. A split image name column is converted back to strings.
+		if not self.check_colname_exists(column): raise Exception("ERROR: Column %s does not exist!" % column)
+		col = self.data_array[column] if rows is None else self.data_array[column][rows]
+		if column != self.image_name_column: return col
+		return decode_image_names(col["index"], col["stack"], self.image_stacks, self.image_index_width)
+	
+	
+	def query_mask(self, expr, rows=None):
+		# boolean mask of the query expr (see compile_query) for all rows or the given rows (index array)
+		# only the columns referenced in expr are loaded and evaluated
+		func, columns = compile_query(expr)
+		self.load_columns(*columns)
+		mask = func({ c : self.query_column(c, rows) for c in columns })
+		n = len(self.data_array) if rows is None else len(rows)
+		return np.broadcast_to(mask, (n,)) # constant expressions
+	
+	
+	def where(self, expr):
+		# index array of the rows that match the query expr, e.g. "_rlnClassNumber == 3 and _rlnMaxValueProbDistribution > 0.2"
+		return np.flatnonzero(self.query_mask(expr))
+	
+	
+	def select(self, expr):
+		# rows that match the query expr (see where) as data_block_view: the rows are only copied (materialized) when the 
+		# view is saved or its data_array is used. Selections can be chained: block.select(expr1).select(expr2)
+		return data_block_view(self, self.where(expr))
+	
+	
+	def join(self, other, on, how="inner", columns=None):
+		# joins the rows of another data block on the key columns on (str or list), e.g. "_rlnImageName" or 
+		# ["_rlnMicrographName", "_rlnCoordinateX", "_rlnCoordinateY"], and returns a new data block:
+		#	how = "inner"	rows of self with a matching row in other (a row is repeated for every match)
+		#	how = "left"	all rows of self, rows without a match keep their values (new columns: 0 or "")
+		#	how = "anti"	rows of self without a matching row in other (no columns are added)
+		# columns	columns of other that are added to the rows (default: all except the keys). Columns that exist in 
+		#			both blocks are overwritten by the values of other, e.g. the refined angles of a run_data.star.
+		# The keys are converted into integer codes (see key_codes) and matched by sorting (see join_indices). 
+		# The columns are gathered with one index array each.
+		on = [ self.leading_underscore(c) for c in ([on] if isinstance(on, str) else on) ]
+		if how not in ("inner", "left", "anti"): raise Exception("ERROR: Unknown join %s! Use inner, left or anti." % how)
+		for block in (self, other): 
+			for c in on: 
+				if not block.check_colname_exists(c): raise Exception("ERROR: Key column %s does not exist in %s!" % (c, block))
+		if columns is None: columns = [ c for c in other.data_array.names if c not in on ]
+		else: columns = [ self.leading_underscore(c) for c in columns ]
+		
+		self.load_columns(*on)
+		other.load_columns(*(on + columns))
+		left_idx, right_idx = join_indices(*key_codes([self, other], on), how=how)
+		new = self.take(left_idx)
+		if how == "anti": return new
+		
+		matched = right_idx >= 0
+		for c in columns:
+			if c == new.image_name_column: new.join_image_name()
+			values = other.query_column(c, np.where(matched, right_idx, 0))
+			if new.check_colname_exists(c):
+				# overwrite, the data type of other is used (if both are strings, the longer one)
+				old = new.query_column(c)
+				if how == "left": values = np.where(matched, values, old) if len(values) > 0 else values.astype(np.result_type(values, old))
+				new.data_array.replace(c, values)
+				new.dict_colname_dtype[c] = new.arr_dtype_to_string_letter(values.dtype.str)
+			else:
+				if how == "left" and not matched.all(): values = np.where(matched, values, np.zeros(1, dtype=values.dtype))
+				new.add_column(np.asarray(values), c)
+		return new
+	
+	
+	def groupby(self, on):
+		# groups the rows by the key columns on (str or list), e.g. "_rlnMicrographName", "_rlnClassNumber" or 
+		# ["_rlnOpticsGroup", "_rlnClassNumber"]. The rows are grouped once (see data_block_groups), the aggregates are
+		# computed per column: block.groupby("_rlnMicrographName").agg({"_rlnDefocusU": "mean", "_rlnAngleRot": "circstd"})
+		on = [ self.leading_underscore(c) for c in ([on] if isinstance(on, str) else on) ]
+		for c in on: 
+			if not self.check_colname_exists(c): raise Exception("ERROR: Key column %s does not exist in %s!" % (c, self))
+		self.load_columns(*on)
+		return data_block_groups(self, on)
+	
+	
 	def leading_underscore(self, test):
 		test=str(test).replace(" ", "_")
 		if test.startswith("_"): return test
@@ -510,7 +1217,7 @@ class data_block():
 		# overwrite	(bool)	if True the data block will be overwritten with the random sample. If False the funtion solely returns the random array
 		np.random.seed() # important if the function will be called from a parallel instance (--> same time --> same random seed --> same selection)
 		if num is None: num = len(self.data_array)
-		random_sample = np.random.choice(self.data_array, int(num), replace=replace)
+		random_sample = self.data_array[np.random.choice(len(self.data_array), int(num), replace=replace)]
 		if overwrite: self.data_array = random_sample
 		else: return random_sample
 	
@@ -519,14 +1226,949 @@ class data_block():
 
 
 
+class data_block_view():
+	# Rows of a data block selected by a query (data_block.select), stored as an index array into the data block.
+	# Chained selections only gather the columns referenced by the query for the selected rows. 
+	# Only the column metadata (column dictionaries, image name stack table, write lists, see shared) is the one of the 
+	# data block. All other methods (join, groupby, add_column, ...) work on the selected rows: they are copied into a 
+	# new data block once (materialized, e.g. also by data_array) and the methods of that block are used, 
+	# i.e. the data block itself is never modified by a view. savestar writes a view that was not materialized 
+	# in chunks of gathered rows.
+	
+	shared = ("dict_colnum_colname", "dict_colname_colnum", "dict_colname_dtype", "arr_col_dtype_assignment", "objname", 
+			"default_string_dtype", "image_name_column", "image_stacks", "image_index_width", "write_column_list", 
+			"write_exclude_column", "write_include_column", "make_write_column_list", "purge_write_column_list", 
+			"check_colname_exists", "arr_dtype_to_string_letter", "leading_underscore", "load_columns")
+	
+	def __init__(self, block, index):
+		self.block			= block
+		self.index			= np.asarray(index, dtype=np.int64)
+		self.materialized	= None
+	
+	
+	def __getattr__(self, name):
+		if name in ("block", "index", "materialized"): raise AttributeError(name)
+		if self.materialized is None and name in self.shared: return getattr(self.block, name)
+		if self.materialized is None: self.materialized = self.materialize()
+		return getattr(self.materialized, name)
+	
+	
+	def __len__(self):
+		return len(self.index)
+	
+	
+	def __str__(self):
+		return "%s (%d selected rows)" % (self.block, len(self.index))
+	
+	
+	@property
+	def data_array(self):
+		if self.materialized is None: self.materialized = self.materialize()
+		return self.materialized.data_array
+	
+	
+	def query_column(self, column, rows=None):
+		if self.materialized is not None: return self.materialized.query_column(column, rows)
+		return self.block.query_column(column, self.index if rows is None else self.index[rows])
+	
+	
+	def query_mask(self, expr):
+		if self.materialized is not None: return self.materialized.query_mask(expr)
+		return self.block.query_mask(expr, self.index)
+	
+	
+	def where(self, expr):
+		# index array (rows of the data block) of the selected rows that match the query expr
+		return self.index[self.query_mask(expr)]
+	
+	
+	def select(self, expr):
+		# a materialized view (e.g. with added columns) is selected from like a data block
+		if self.materialized is not None: return self.materialized.select(expr)
+		return data_block_view(self.block, self.where(expr))
+	
+	
+	def column(self, column):
+		# values of a column for the selected rows
+		if self.materialized is not None: return self.materialized.data_array[column]
+		return self.block.data_array[column][self.index]
+	
+	
+	def take(self, rows):
+		# new data block with the given rows of the view (any numpy index)
+		if self.materialized is not None: return self.materialized.take(rows)
+		return self.block.take(self.index[rows])
+	
+	
+	def materialize(self, start=None, stop=None):
+		# new data block with the selected rows start:stop
+		return self.block.take(self.index[start:stop])
+	
+	
+	
+	
+	
+	
+class data_block_groups():
+	# Rows of a data block grouped by key columns (data_block.groupby). The keys are interned into integer codes
+	# (see key_codes) and numbered 0..k-1 in sorted key order (split image names: by stack, then slice number), i.e. 
+	# string keys are compared only once. 
+	# The aggregates are computed with one np.bincount (count, sum, mean, var, std, circmean, circstd) or one 
+	# ufunc.reduceat over the rows sorted by group (min, max, median; the sort order is computed once on first use).
+	# var and std are population values (ddof=0, as np.var), circmean and circstd are for angles in degrees.
+	
+	functions = ("count", "sum", "mean", "var", "std", "min", "max", "median", "first", "last", "circmean", "circstd")
+	
+	def __init__(self, block, on):
+		self.block	= block
+		self.on		= on
+		codes = key_codes([block], on)[0]
+		n = len(codes)
+		if n > 0 and codes.max() - codes.min() <= 4*n + 1024: 
+			# dense codes (e.g. class numbers, optics groups): numbered with a lookup table instead of sorting
+			codes = codes - codes.min()
+			present = np.bincount(codes) > 0
+			self.inverse = (np.cumsum(present) - 1)[codes]
+			self.n_groups = int(present.sum())
+			self.first_rows = np.full(self.n_groups, n, dtype=np.int64)
+			np.minimum.at(self.first_rows, self.inverse, np.arange(n))
+		else: 
+			unique, self.first_rows, self.inverse = np.unique(codes, return_index=True, return_inverse=True)
+			self.inverse = self.inverse.reshape(-1)
+			self.n_groups = len(unique)
+		self.counts	= np.bincount(self.inverse, minlength=self.n_groups)
+		self.order	= None
+	
+	
+	def __len__(self):
+		return self.n_groups
+	
+	
+	def sort_order(self):
+		# rows sorted by group (stable, i.e. in the original order within a group) and the first position of each group
+		if self.order is None: self.order = np.argsort(self.inverse, kind="stable")
+		return self.order, np.cumsum(self.counts) - self.counts
+	
+	
+	def keys(self):
+		# key values of the groups (structured array, one row per group)
+		return self.block.take(self.first_rows).data_array[self.on]
+	
+	
+	def group_rows(self, group):
+		# rows of the data block that belong to a group (0..k-1)
+		order, starts = self.sort_order()
+		return order[starts[group]:starts[group] + self.counts[group]]
+	
+	
+	def aggregate(self, column, func):
+		# aggregate func (see functions) of a column for all groups, array with one value per group
+		if func not in self.functions: raise Exception("ERROR: Unknown aggregate %s! Use %s." % (func, ", ".join(self.functions)))
+		if func == "count": return self.counts
+		if func == "first": return self.block.query_column(column, self.first_rows)
+		if func == "last":
+			order, starts = self.sort_order()
+			return self.block.query_column(column, order[starts + self.counts - 1])
+		values = self.block.data_array[column]
+		if values.dtype.kind not in "iufb": raise Exception("ERROR: Cannot compute the %s of the non-numeric column %s!" % (func, column))
+		with np.errstate(invalid="ignore", divide="ignore"): 
+			if func in ("sum", "mean", "var", "std"):
+				total = np.bincount(self.inverse, weights=values, minlength=self.n_groups)
+				if func == "sum": return total.astype(np.int64) if values.dtype.kind in "iub" else total
+				mean = total / self.counts
+				if func == "mean": return mean
+				var = np.bincount(self.inverse, weights=(values - mean[self.inverse])**2, minlength=self.n_groups) / self.counts
+				return var if func == "var" else np.sqrt(var)
+			if func in ("circmean", "circstd"):
+				angles = np.radians(values, dtype=np.float64)
+				c = np.bincount(self.inverse, weights=np.cos(angles), minlength=self.n_groups) / self.counts
+				s = np.bincount(self.inverse, weights=np.sin(angles), minlength=self.n_groups) / self.counts
+				if func == "circmean": return np.degrees(np.arctan2(s, c))
+				return np.degrees(np.sqrt(-2 * np.log(np.minimum(np.hypot(c, s), 1.0))))
+		order, starts = self.sort_order()
+		if len(values) == 0: return np.zeros(0, dtype=values.dtype)
+		if func == "min": return np.minimum.reduceat(values[order], starts)
+		if func == "max": return np.maximum.reduceat(values[order], starts)
+		# median: sorted by group and value
+		order = np.lexsort((values, self.inverse))
+		lower, upper = starts + (self.counts - 1) // 2, starts + self.counts // 2
+		return (values[order[lower]].astype(np.float64) + values[order[upper]]) / 2
+	
+	
+	def agg(self, funcs=None, count_column="_rlnGroupNrParticles"):
+		# new data block with one row per group: the key columns, the number of rows (count_column, None: no count) and
+		# the aggregates funcs {column : func or list of funcs} in columns named column_func, e.g. _rlnDefocusU_mean 
+		# funcs = {"_rlnDefocusU" : ["mean", "std"], "_rlnAngleRot" : "circstd", "_rlnClassNumber" : "first"}
+		funcs = {} if funcs is None else funcs
+		funcs = { self.block.leading_underscore(c) : ([f] if isinstance(f, str) else list(f)) for c, f in funcs.items() }
+		for c in funcs: 
+			if not self.block.check_colname_exists(c): raise Exception("ERROR: Column %s does not exist in %s!" % (c, self.block))
+		self.block.load_columns(*funcs.keys())
+		new = self.block.take(self.first_rows)
+		new.del_columns(*[ c for c in new.data_array.names if c not in self.on ])
+		new.write_column_list = []
+		if count_column is not None: new.add_column(self.counts.astype(np.int64), count_column)
+		for c, fs in funcs.items():
+			for f in fs: new.add_column(np.asarray(self.aggregate(c, f)), "%s_%s" % (c, f))
+		return new
+	
+	
+	
+	
+	
+	
+	
+	
+	
+class column_array():
+	# Columns of a data block stored as separate 1D arrays (e.g. memory mapped .npy files from the cache) with the 
+	# interface of a structured array: data_array["_rlnAngleRot"] returns the column, a list of column names or a 
+	# row index returns a structured array with these columns/rows, dtype/shape/len as for the structured array. 
+	# np.asarray(data_array) returns the complete structured array.
+	# With raw (raw_rows), columns missing in columns are parsed from the raw text when they are accessed for the first time.
+	
+	def __init__(self, columns, names=None, raw=None):
+		# columns	(dict) column name : 1D array (all with the same length)
+		# names		(list) column order. Default: order of columns
+		# raw		(raw_rows) unparsed rows for the columns that are not in columns
+		self.columns = dict(columns)
+		self.names = list(columns) if names is None else list(names)
+		self.raw = raw
+		self.ndim = 1
+	
+	
+	def column(self, name):
+		# returns a column, a raw column is parsed on first access
+		if name not in self.columns and self.raw is not None and name in self.names: self.columns[name] = self.raw.parse_column(name)
+		return self.columns[name]
+	
+	
+	def add(self, name, values):
+		# appends a column (values is stored as it is, no copy)
+		if name in self.columns: raise Exception("ERROR: Column %s already exists!" % name)
+		if len(self.names) > 0 and len(values) != len(self): raise Exception("ERROR: Array must have the same length!")
+		self.columns[name] = values
+		self.names.append(name)
+	
+	
+	def replace(self, name, values):
+		# replaces a column by a new array (e.g. with a different data type)
+		if len(values) != len(self): raise Exception("ERROR: Array must have the same length!")
+		self.columns[name] = values
+	
+	
+	def delete(self, names):
+		for n in names: 
+			self.columns.pop(n, None)
+			self.names.remove(n)
+	
+	
+	def rename(self, old, new):
+		self.column(old) # a raw column is parsed under its old name
+		self.columns[new] = self.columns.pop(old)
+		self.names[self.names.index(old)] = new
+	
+	
+	def reorder(self, names):
+		if sorted(names) != sorted(self.names): raise Exception("ERROR: The new column order must contain all columns!")
+		self.names = list(names)
+	
+	
+	def load(self, names):
+		# parses several raw columns at once (one pass over the text instead of one per column)
+		names = [ n for n in names if n not in self.columns and n in self.names ]
+		if self.raw is not None and len(names) > 0: self.columns.update(self.raw.parse_columns(names))
+	
+	
+	@property
+	def dtype(self):
+		# not yet parsed columns have the data type of the dtype assignment (strings: default_string_dtype)
+		return np.dtype([ (n, self.columns[n].dtype if n in self.columns else self.raw.dtypes[n]) for n in self.names ])
+	
+	
+	@property
+	def shape(self):
+		return (len(self),)
+	
+	
+	@property
+	def size(self):
+		return len(self)
+	
+	
+	def __len__(self):
+		if self.raw is not None: return len(self.raw)
+		if len(self.names) == 0: return 0
+		return len(self.columns[self.names[0]])
+	
+	
+	def __repr__(self):
+		return "column_array(%d rows, columns: %s)" % (len(self), ", ".join(self.names))
+	
+	
+	def structured(self, names=None, index=slice(None)):
+		# returns a (packed) structured array with the columns names (default: all) and the rows index
+		if names is None: names = self.names
+		columns = [ self.column(n)[index] for n in names ]
+		arr = np.empty(np.shape(columns[0]) if len(columns) > 0 else (len(self),), dtype=[ (n, col.dtype) for n, col in zip(names, columns) ])
+		for n, col in zip(names, columns): arr[n] = col
+		return arr
+	
+	
+	def __array__(self, dtype=None, copy=None):
+		if dtype is None: return self.structured()
+		return self.structured().astype(dtype)
+	
+	
+	def astype(self, dtype):
+		return self.structured().astype(dtype)
+	
+	
+	def __iter__(self):
+		return iter(self.structured())
+	
+	
+	def __getitem__(self, key):
+		if isinstance(key, str): return self.column(key)
+		if isinstance(key, list) and all( isinstance(i, str) for i in key ): return self.structured(key)
+		return self.structured(index=key) # rows
+	
+	
+	def writable_column(self, name):
+		# returns a column that can be modified in place, read-only columns (e.g. zero-copy from Arrow) are copied first
+		col = self.column(name)
+		if not col.flags.writeable: 
+			col = np.array(col)
+			self.columns[name] = col
+		return col
+	
+	
+	def __setitem__(self, key, value):
+		if isinstance(key, str): 
+			self.writable_column(key)[...] = value
+		elif isinstance(key, list) and all( isinstance(i, str) for i in key ): 
+			for n in key: self.writable_column(n)[...] = value[n]
+		else: 
+			for n in self.names: self.writable_column(n)[key] = value[n]
+	
+	
+	
+	
+	
+	
+class raw_rows():
+	# Unparsed data rows of a loop (lazy data blocks, see starfile(lazy=True)). Columns are parsed one at a time.
+	
+	def __init__(self, text, dtype_assignment):
+		# text				(str) data rows of the loop
+		# dtype_assignment	list of (column name, data type) tuples
+		self.lines = [ line for line in text.splitlines() if line.strip() != "" and not line.lstrip().startswith("#") ]
+		self.positions = { colname : idx for idx, (colname, dtype) in enumerate(dtype_assignment) }
+		self.dtypes = { colname : np.dtype(dtype) for colname, dtype in dtype_assignment }
+	
+	
+	def __len__(self):
+		return len(self.lines)
+	
+	
+	def token_columns(self, names, start=None, stop=None):
+		# returns the raw text values of the columns names (list of sequences) for the rows start:stop
+		text = "\n".join(self.lines[start:stop])
+		if "#" in text: text = "\n".join([ line.split("#", 1)[0] for line in text.splitlines() ]) # remove comments
+		tokens = text.split()
+		ncol = len(self.positions)
+		if len(tokens) % ncol != 0: raise ValueError("Number of values (%d) is not a multiple of the number of columns (%d)!" % (len(tokens), ncol))
+		return [ tokens[self.positions[n]::ncol] for n in names ]
+	
+	
+	def parse_column(self, name):
+		# parses one column with its assigned data type, string columns are sized to their longest value
+		return self.parse_columns([name])[name]
+	
+	
+	def parse_columns(self, names):
+		# parses the columns names with their assigned data types, returns a dict column name : array
+		numeric = [ n for n in names if not is_string_dtype(self.dtypes[n]) ]
+		columns = {}
+		if has_c_loadtxt and len(numeric) > 0: 
+			arr = np.loadtxt(self.lines, dtype=[ (n, self.dtypes[n]) for n in numeric ], usecols=[ self.positions[n] for n in numeric ], comments='#', ndmin=1)
+			columns.update({ n : arr[n].copy() for n in numeric })
+		todo = [ n for n in names if n not in columns ]
+		if len(todo) == 0: return columns
+		for n, tokens in zip(todo, self.token_columns(todo)): 
+			if is_string_dtype(self.dtypes[n]): columns[n] = np.array(tokens, dtype=self.dtypes[n].kind)
+			else: columns[n] = np.array(tokens).astype(self.dtypes[n])
+		return columns
+	
+	
+	
+	
+	
+	
+class row_index():
+	# Persistent index of the byte offsets of all data rows of a star file, stored next to it:
+	#	fname.rowidx.npy	offsets of the data rows of all loops (int64, memory mapped)
+	#	fname.rowidx.json	data block names, column labels, position of the rows of each block in the offsets 
+	#						and the key (size, mtime) of the star file. An outdated index is rebuilt.
+	# Rows can be read directly (read_rows).
+	
+	def __init__(self, fname, rebuild=False, verbosity=False):
+		self.fname = fname
+		self.verbosity = verbosity
+		if not os.path.isfile(fname): sys.exit("ERROR: %s does not exist!" % fname)
+		if rebuild or not self.load(): 
+			self.build()
+			self.save()
+	
+	
+	def key(self):
+		stat = os.stat(self.fname)
+		return { "size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns }
+	
+	
+	def load(self):
+		# returns False if there is no valid index
+		try:
+			with open(self.fname + ".rowidx.json") as f: meta_data = json.load(f)
+			if meta_data.get("version") != 1 or meta_data.get("key") != self.key(): return False
+			self.blocks = meta_data["blocks"]
+			self.offsets = np.load(self.fname + ".rowidx.npy", mmap_mode="r")
+		except (OSError, ValueError, KeyError): return False
+		verbose("Row index read: %s.rowidx.npy" % self.fname, self.verbosity)
+		return True
+	
+	
+	def save(self):
+		try:
+			np.save(self.fname + ".rowidx.npy", self.offsets)
+			with open(self.fname + ".rowidx.json.tmp", "w") as f: json.dump({ "version" : 1, "key" : self.key(), "blocks" : self.blocks }, f, indent=1)
+			os.replace(self.fname + ".rowidx.json.tmp", self.fname + ".rowidx.json")
+			verbose("Row index saved: %s.rowidx.npy" % self.fname, self.verbosity)
+		except OSError as e: print("WARNING: Row index %s.rowidx.npy cannot be written (%s)!" % (self.fname, e))
+	
+	
+	def build(self, chunk_size=2**24):
+		# one pass over the file in binary chunks. The line starts and the first non-blank character of each line are 
+		# found with numpy, only lines whose first non-blank character can start a header, label, comment or empty line 
+		# are inspected in python. The offsets are collected as runs of consecutive data rows (slices of the line starts).
+		special = np.frombuffer(b"dl_#\r\n", dtype=np.uint8)
+		blank = np.frombuffer(b" \t", dtype=np.uint8)
+		self.blocks = []
+		offsets = []
+		state = None # None, "header" (after data_), "loop", "labels", "rows"
+		carry, carry_offset = b"", 0
+		with open(self.fname, "rb") as f:
+			while True:
+				data = f.read(chunk_size)
+				buf, base = carry + data, carry_offset
+				buf_end = len(buf) if len(data) == 0 else buf.rfind(b"\n")+1 # only complete lines (and the last line of the file)
+				if buf_end == 0 and len(data) > 0: 
+					carry = buf
+					continue
+				arr = np.frombuffer(buf, dtype=np.uint8, count=buf_end)
+				starts = np.flatnonzero(arr == ord("\n")) + 1
+				starts = np.concatenate(([0], starts[starts < buf_end])) if buf_end > 0 else np.zeros(0, dtype=np.int64)
+				# first non-blank character of each line (a line of blanks at the end of the file counts as empty line)
+				first = starts.copy()
+				todo = np.flatnonzero(np.isin(arr[starts], blank))
+				while len(todo) > 0:
+					first[todo] += 1
+					todo = todo[first[todo] < buf_end]
+					todo = todo[np.isin(arr[first[todo]], blank)]
+				lead = np.full(len(starts), ord("\n"), dtype=np.uint8)
+				lead[first < buf_end] = arr[first[first < buf_end]]
+				
+				prev, run = 0, None # run: first line of the current run of data rows
+				for i in np.flatnonzero(np.isin(lead, special)).tolist() + [len(starts)]:
+					if i > prev and state in ("labels", "rows"): # data rows
+						state = "rows"
+						if run is None: run = prev
+					if i == len(starts): break
+					prev = i+1
+					line = buf[starts[i]:starts[i+1] if i+1 < len(starts) else buf_end]
+					token = line.strip()
+					if token != b"" and not token.startswith(b"#") and not line.startswith(b"data_") and not token.startswith(b"_") \
+						and not (token.startswith(b"loop_") and state == "header") and state in ("labels", "rows"): 
+						# data row starting with d/l
+						state = "rows"
+						if run is None: run = i
+						continue
+					if run is not None: 
+						offsets.append(starts[run:i] + base)
+						self.blocks[-1]["nrows"] += i-run
+						run = None
+					if token == b"" or token.startswith(b"#"): continue
+					elif line.startswith(b"data_"): 
+						self.blocks.append({ "name" : token.decode(), "labels" : [], "nrows" : 0 })
+						state = "header"
+					elif token.startswith(b"loop_") and state == "header": state = "loop"
+					elif token.startswith(b"_"): 
+						if state in ("loop", "labels"): 
+							self.blocks[-1]["labels"].append(token.split()[0].decode())
+							state = "labels"
+				if run is not None: 
+					offsets.append(starts[run:] + base)
+					self.blocks[-1]["nrows"] += len(starts)-run
+				carry, carry_offset = buf[buf_end:], base + buf_end
+				if len(data) == 0: break
+		
+		first = 0
+		for block in self.blocks: 
+			block["first"] = first
+			first += block["nrows"]
+		self.offsets = np.concatenate(offsets).astype(np.int64) if len(offsets) > 0 else np.zeros(0, dtype=np.int64)
+		verbose("Row index built: %d rows in %d data blocks" % (len(self.offsets), len(self.blocks)), self.verbosity)
+	
+	
+	def block_offsets(self, block_idx):
+		block = self.blocks[block_idx]
+		return self.offsets[block["first"]:block["first"]+block["nrows"]]
+	
+	
+	def read_rows(self, block_idx, rows):
+		# returns the text of the rows (row numbers of the block, any numpy index) in the requested order
+		offsets = self.block_offsets(block_idx)
+		rows = np.arange(len(offsets))[rows]
+		if len(rows) == 0: return ""
+		with open(self.fname, "rb") as f:
+			if np.all(np.diff(rows) == 1): # contiguous rows: one read
+				f.seek(offsets[rows[0]])
+				text = f.read(int(offsets[rows[-1]] - offsets[rows[0]])) + f.readline()
+				lines = [ text ]
+				positions = (offsets[rows] - offsets[rows[0]]).tolist()
+				if text.count(b"\n", 0, positions[-1]) != len(rows)-1: # comments or empty lines between the rows
+					lines = [ text[p:text.find(b"\n", p)+1 or len(text)] for p in positions ]
+			else:
+				lines = [ None ] * len(rows)
+				for i in np.argsort(offsets[rows], kind="stable"): # read in file order
+					f.seek(offsets[rows[i]])
+					lines[i] = f.readline()
+		# the last line of the file can end without newline
+		return b"".join([ line if line.endswith(b"\n") else line + b"\n" for line in lines ]).decode()
+	
+	
+	
+	
+	
+	
+class star_stream():
+	# Single pass reader for star files.
+	# The file is read in blocks of chunk_size characters. Header lines are returned one at a time, while the data rows 
+	# of a loop are handed out as large text chunks (complete lines only), which end where the next data block starts. 
+	# Nothing that has been handed out is kept in memory.
+	
+	def __init__(self, handle, chunk_size=2**22):
+		self.handle		= handle
+		self.chunk_size	= chunk_size
+		self.line_count	= 0 # number of lines read so far
+		self.buf		= "" # current block of the file
+		self.pos		= 0 # position of the first character in buf that has not been consumed yet (always the beginning of a line)
+		self.eof		= False
+	
+	
+	def fill(self):
+		# appends the next block of the file to the unconsumed part of the buffer. Returns False at the end of the file
+		if self.eof: return False
+		new = self.handle.read(self.chunk_size)
+		if not new: 
+			self.eof = True
+			return False
+		self.buf = self.buf[self.pos:] + new
+		self.pos = 0
+		return True
+	
+	
+	def readline(self):
+		end = self.buf.find("\n", self.pos)
+		while end < 0:
+			if not self.fill(): 
+				end = len(self.buf)-1 # last line without line break (or empty string at the end of the file)
+				break
+			end = self.buf.find("\n", self.pos)
+		line = self.buf[self.pos:end+1]
+		self.pos = end+1
+		if line: self.line_count += 1
+		return line
+	
+	
+	def pushback(self, line):
+		# the last line returned by readline is still in the buffer --> move back
+		self.pos -= len(line)
+		self.line_count -= 1
+	
+	
+	def next_data_block(self):
+		# skips everything until the next line that starts with "data_" and returns the block name (None at the end of the file)
+		while True:
+			line = self.readline()
+			if not line: return None
+			if line.startswith("data_"): return line.strip()
+	
+	
+	def loop_labels(self, block_name):
+		# returns the column label lines of the loop of the current data block
+		line = self.readline()
+		while line and not line.startswith("loop_"):
+			if line.startswith("data_") or line.startswith("_"): sys.exit("Cannot read starfile with data blocks containing tables and loops!")
+			line = self.readline()
+		if not line: sys.exit("Cannot read starfile with data blocks containing tables and loops!")
+		
+		labels = []
+		line = self.readline()
+		if not line.startswith("_"): sys.exit("Is there an empty line between loop_ and the first column label of data block %s?" % block_name)
+		while line.startswith("_"):
+			labels.append(line.strip())
+			line = self.readline()
+		if line: self.pushback(line) # first data row (or the start of the next block)
+		return labels
+	
+	
+	def row_chunks(self):
+		# generator over the data rows of the current loop as text chunks of complete lines
+		# stops at the beginning of the next data block
+		while True:
+			if self.pos >= len(self.buf) and not self.fill(): return
+			if self.buf.startswith("data_", self.pos): return
+			next_block = self.buf.find("\ndata_", self.pos)
+			if next_block >= 0: end = next_block+1
+			else: 
+				end = self.buf.rfind("\n", self.pos)+1
+				if end <= self.pos: # no complete line left in the buffer
+					if self.fill(): continue
+					end = len(self.buf)
+			chunk = self.buf[self.pos:end]
+			self.pos = end
+			self.line_count += chunk.count("\n")
+			yield chunk
+	
+	
+	def row_batches(self, nrows=None):
+		# generator over the data rows of the current loop as text chunks of nrows lines each (the last one can be shorter)
+		# nrows = None: all rows in one chunk
+		if nrows is None:
+			yield "".join(self.row_chunks())
+			return
+		lines = []
+		for chunk in self.row_chunks():
+			lines.extend(chunk.splitlines(True))
+			while len(lines) >= nrows:
+				yield "".join(lines[:nrows])
+				del lines[:nrows]
+		if len(lines) > 0: yield "".join(lines)
+	
+	
+	def close(self):
+		self.handle.close()
+
+
+
 ############################### STARFILE CLASS END ###############################
 ##################################################################################
 
+def process_rows_worker(task):
+	# worker process of starfile.process_rows_parallel: reads the rows of a batch from shared memory and processes them
+	shm_name, size, func, batch_idx, settings, layout = task
+	shm = shared_memory.SharedMemory(name=shm_name)
+	try: text = bytes(shm.buf[:size]).decode()
+	finally: shm.close()
+	return starfile(None, **settings).process_rows(text, func, batch_idx, layout)
+
+
+
+def structured_to_columns(arr):
+	# splits a structured array into a column_array with contiguous columns
+	arr = np.atleast_1d(arr)
+	return column_array({ n : np.ascontiguousarray(arr[n]) for n in arr.dtype.names }, arr.dtype.names)
+
+
+
+def dtype_to_string_letter(dtype):
+	# data type letter (as in relion_metadata_labels) of a numpy dtype string, e.g. '<f4' --> 'f'
+	# string columns of any length (e.g. '<U37', '|S1000') share the data type letter default_string_dtype
+	if is_string_dtype(dtype): return default_string_dtype
+	d = {
+		'<f4' : 'f',
+		'<f8' : 'f',
+		'<i8' : 'i',
+		'<i4' : 'i',
+		'|i1' : 'b',
+		'|b1' : 'b'
+	}
+	try: return  d[dtype]
+	except KeyError: 
+		print("WARNING: dtype (%s) not identified! Using default: %s " % (dtype, default_string_dtype))
+		return default_string_dtype
+
+
+
+def import_optional(module):
+	# imports an optional dependency (e.g. pyarrow), which is only required by a few functions
+	import importlib
+	try: return importlib.import_module(module)
+	except ImportError: sys.exit("ERROR: %s is required for this function (pip install %s)!" % (module, module.split(".")[0]))
+
+
+
+def arrow_to_numpy(column):
+	# converts a pyarrow (Chunked)Array into a numpy array; numeric columns without missing values are not copied (read-only)
+	if hasattr(column, "combine_chunks"): column = column.combine_chunks() if column.num_chunks != 1 else column.chunk(0)
+	try: return column.to_numpy(zero_copy_only=True)
+	except Exception: pass
+	arr = column.to_numpy(zero_copy_only=False)
+	if arr.dtype == object: return np.array(arr.tolist(), dtype="U") # strings are sized to their longest value
+	return arr
+
+
+
+def load_npy(fname):
+	# memory maps a .npy file copy-on-write (empty arrays cannot be memory mapped)
+	try: return np.load(fname, mmap_mode="c")
+	except ValueError: return np.load(fname)
+
+
+
 def fields_view(arr, fields):
     dtype2 = np.dtype({name:arr.dtype.fields[name] for name in fields})
     return np.ndarray(arr.shape, dtype2, arr, 0, arr.strides)
 
 
+def tokenize_rows(text, dtype):
+	# converts whitespace separated text rows into a structured array with the given (structured) dtype
+	# string columns are sized to their longest value
+	if "#" in text: text = "\n".join([ line.split("#", 1)[0] for line in text.splitlines() ]) # remove comments
+	tokens = text.split()
+	ncol = len(dtype.names)
+	if len(tokens) % ncol != 0: raise ValueError("Number of values (%d) is not a multiple of the number of columns (%d)!" % (len(tokens), ncol))
+	cols = []
+	for idx, name in enumerate(dtype.names): 
+		col_dtype = dtype.fields[name][0]
+		if is_string_dtype(col_dtype): col_dtype = col_dtype.kind # unsized --> longest value
+		cols.append(np.array(tokens[idx::ncol], dtype=col_dtype))
+	arr = np.empty(len(tokens)//ncol, dtype=[ (name, col.dtype) for name, col in zip(dtype.names, cols) ])
+	for name, col in zip(dtype.names, cols): arr[name] = col
+	return arr
+
+
+def is_string_dtype(dtype):
+	# True for string data types of any length, e.g. 'U1000', '<U37', '|S1000'
+	try: return np.dtype(dtype).kind in "US"
+	except TypeError: return False
+
+
+def string_dtype_width(dtype):
+	# maximum number of characters of a string data type
+	dtype = np.dtype(dtype)
+	return dtype.itemsize // np.dtype(dtype.kind+"1").itemsize
+
+
+def resize_string_columns(dtype, widths):
+	# returns the structured dtype with the string columns listed in widths (dict[col_name] = number of characters) resized
+	return np.dtype([ (name, "%s%d" % (dtype.fields[name][0].kind, widths[name])) 
+		if name in widths and is_string_dtype(dtype.fields[name][0]) else (name, dtype.fields[name][0]) for name in dtype.names ])
+
+
+def compact_string_columns(arr):
+	# returns the structured array with all string columns sized to their longest value (at least 1 character)
+	# a column_array (parse_rows_columnar) is returned as it is, its string columns are already sized
+	if isinstance(arr, column_array): return arr
+	widths = {}
+	for name in arr.dtype.names:
+		if not is_string_dtype(arr.dtype.fields[name][0]): continue
+		if arr.size == 0: widths[name] = 1
+		else: widths[name] = max(1, int(np.char.str_len(arr[name]).max()))
+	new_dtype = resize_string_columns(arr.dtype, widths)
+	if new_dtype == arr.dtype: return arr
+	return arr.astype(new_dtype)
+
+
+def encode_image_names(names):
+	# splits image names (e.g. "000001@stack.mrcs") into 
+	#	index	int32 slice numbers
+	#	stack	int32 row in the table of stack names
+	#	stacks	table of the stack names
+	#	width	zero padding of the slice numbers (0 = no padding)
+	# returns None if the names cannot be rebuilt exactly from these parts
+	names = np.atleast_1d(names)
+	if names.size == 0: return None
+	parts = np.char.partition(names, "@")
+	if not (parts[:,1] == "@").all(): return None
+	prefix, stacks = parts[:,0], parts[:,2]
+	if not np.char.isdigit(prefix).all(): return None # also catches empty slice numbers
+	lengths = np.char.str_len(prefix)
+	if lengths.max() > 9: return None # does not fit into int32
+	if (lengths == lengths[0]).all(): 
+		width = int(lengths[0])
+		# fixed width digits --> integer without converting every string separately
+		digits = np.ascontiguousarray(prefix, dtype="U%d" % width).view(np.uint32).reshape(-1, width) - ord("0")
+		index = np.dot(digits.astype(np.int64), 10**np.arange(width-1, -1, -1)).astype(np.int32)
+	elif ((lengths > 1) & np.char.startswith(prefix, "0")).any(): return None # mixed zero padding
+	else: 
+		width = 0
+		index = prefix.astype(np.int32)
+	
+	# stack names usually come in long runs --> only the first name of each run has to be sorted
+	run_starts = np.concatenate(([0], np.flatnonzero(stacks[1:] != stacks[:-1])+1))
+	table, run_stack = np.unique(stacks[run_starts], return_inverse=True)
+	stack = np.repeat(run_stack.reshape(-1).astype(np.int32), np.diff(np.append(run_starts, len(stacks))))
+	table = table.astype("U%d" % max(1, int(np.char.str_len(table).max())))
+	return index, stack, table, width
+
+
+def decode_image_names(index, stack, stacks, width):
+	# inverse of encode_image_names
+	numbers = np.asarray(index).astype("U")
+	if width > 0: numbers = np.char.zfill(numbers, width)
+	return np.char.add(np.char.add(numbers, "@"), stacks[stack])
+
+
+class query_transformer(ast.NodeTransformer):
+	# rewrites a query expression (see compile_query) into numpy mask operations:
+	#	a and b --> a & b,  a or b --> a | b,  not a --> ~a,  a < b < c --> (a < b) & (b < c),  a in [..] --> np.isin(a, [..])
+	allowed = (ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Constant, ast.List, ast.Tuple, 
+		ast.Load, ast.And, ast.Or, ast.Not, ast.USub, ast.UAdd, ast.Invert, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, 
+		ast.Mod, ast.Pow, ast.BitAnd, ast.BitOr, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn)
+	
+	def generic_visit(self, node):
+		if not isinstance(node, self.allowed): raise Exception("ERROR: %s is not supported in queries!" % type(node).__name__)
+		return super().generic_visit(node)
+	
+	def visit_BoolOp(self, node):
+		self.generic_visit(node)
+		op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+		result = node.values[0]
+		for value in node.values[1:]: result = ast.BinOp(left=result, op=op, right=value)
+		return result
+	
+	def visit_UnaryOp(self, node):
+		self.generic_visit(node)
+		if isinstance(node.op, ast.Not): return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+		return node
+	
+	def visit_Compare(self, node):
+		self.generic_visit(node)
+		result = None
+		left = node.left
+		for op, right in zip(node.ops, node.comparators):
+			if isinstance(op, (ast.In, ast.NotIn)): 
+				term = ast.Call(func=ast.Attribute(value=ast.Name(id="np", ctx=ast.Load()), attr="isin", ctx=ast.Load()), args=[left, right], keywords=[])
+				if isinstance(op, ast.NotIn): term = ast.UnaryOp(op=ast.Invert(), operand=term)
+			else: term = ast.Compare(left=left, ops=[op], comparators=[right])
+			result = term if result is None else ast.BinOp(left=result, op=ast.BitAnd(), right=term)
+			left = right
+		return result
+
+
+query_cache = {} # compiled queries: expr : (function, columns)
+
+
+def compile_query(expr):
+	# compiles a query expression on the columns of a data block, e.g. 
+	#	"_rlnClassNumber == 3 and _rlnMaxValueProbDistribution > 0.2"
+	#	"_rlnDefocusU > 1e4 and not _rlnClassNumber in [1, 4]"
+	#	"(_rlnAngleTilt > 80) & (_rlnAngleTilt < 100) or _rlnRandomSubset == 2"
+	# Column names are used as variables. Supported: comparisons (also chained), and, or, not, &, |, ~, in, not in, 
+	# arithmetic operators and constants (numbers, strings, lists).
+	# returns a function (dict column name : array --> boolean mask) and the list of the referenced columns
+	if expr in query_cache: return query_cache[expr]
+	try: tree = ast.parse(expr.strip(), mode="eval")
+	except SyntaxError as e: raise Exception("ERROR: Invalid query %s! (%s)" % (expr, e))
+	columns = sorted({ node.id for node in ast.walk(tree) if isinstance(node, ast.Name) })
+	code = compile(ast.fix_missing_locations(query_transformer().visit(tree)), "<query>", "eval")
+	func = lambda values: np.asarray(eval(code, {"__builtins__": {}, "np": np}, values), dtype=bool)
+	query_cache[expr] = (func, columns)
+	return func, columns
+
+
+def key_codes(blocks, on):
+	# converts the key columns on of data blocks (list) into int64 codes (one array per block): same key <--> same code 
+	# in all blocks (interned keys, see data_block.join and data_block.groupby)
+	#	one integer column		the values themselves
+	#	split image names		stack * (largest slice number + 1) + slice number, with a common stack table
+	#	otherwise				np.unique of all blocks per column, the codes of the columns are combined
+	lengths = [ len(block.data_array) for block in blocks ]
+	splits = np.cumsum(lengths)[:-1]
+	codes = np.zeros(sum(lengths), dtype=np.int64)
+	n_codes = 1
+	for c in on:
+		if all([ c == block.image_name_column for block in blocks ]):
+			cols = [ block.data_array[c] for block in blocks ]
+			stacks, inverse = np.unique(np.concatenate([ block.image_stacks for block in blocks ]), return_inverse=True)
+			inverse = inverse.reshape(-1)
+			stack_offsets = np.cumsum([0] + [ len(block.image_stacks) for block in blocks ])[:-1]
+			n_index = int(max([ col["index"].max(initial=0) for col in cols ])) + 1
+			values = np.concatenate([ inverse[offset + col["stack"]].astype(np.int64) * n_index + col["index"] for offset, col in zip(stack_offsets, cols) ])
+			size = len(stacks) * n_index
+		elif len(on) == 1 and all([ block.data_array[c].dtype.kind in "iub" for block in blocks ]):
+			return np.split(np.concatenate([ block.data_array[c] for block in blocks ]).astype(np.int64), splits)
+		else:
+			cols = [ block.query_column(c) for block in blocks ]
+			if len(set([ is_string_dtype(col.dtype) for col in cols ])) > 1: raise Exception("ERROR: Key column %s has different data types (%s)!" % (c, ", ".join([ str(col.dtype) for col in cols ])))
+			values = np.concatenate(cols)
+			# e.g. micrograph names come in long runs --> only the first value of each run has to be sorted
+			run_starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1])+1)) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+			if len(run_starts) < len(values) // 2:
+				unique, run_inverse = np.unique(values[run_starts], return_inverse=True)
+				values = np.repeat(run_inverse.reshape(-1), np.diff(np.append(run_starts, len(values))))
+			else: 
+				unique, values = np.unique(values, return_inverse=True)
+				values = values.reshape(-1)
+			size = len(unique)
+		if n_codes * size >= 2**62: # would overflow: renumber the combined codes
+			unique, codes = np.unique(codes, return_inverse=True)
+			codes, n_codes = codes.reshape(-1).astype(np.int64), len(unique)
+		codes = codes * size + values
+		n_codes *= size
+	return np.split(codes, splits)
+
+
+def join_indices(left_codes, right_codes, how="inner"):
+	# matches the key codes of two tables, returns the row indices (left_idx, right_idx) of the joined rows 
+	# (see data_block.join), right_idx = -1 without match
+	#	dense codes (e.g. split image names), unique on the right: lookup table indexed by the code (no sorting)
+	#	otherwise: the codes of both tables are sorted and the left codes are searched in the right codes 
+	#	(a binary search of sorted values is several times faster than of unsorted values)
+	if len(left_codes) > 0 and len(right_codes) > 0:
+		low = min(left_codes.min(), right_codes.min())
+		span = max(left_codes.max(), right_codes.max()) - low + 1
+		if span <= 4*(len(left_codes) + len(right_codes)) + 1024:
+			table = np.full(span, -1, dtype=np.int64)
+			table[right_codes - low] = np.arange(len(right_codes))
+			if np.count_nonzero(table >= 0) == len(right_codes): # unique right codes
+				right_idx = table[left_codes - low]
+				if how == "left": return np.arange(len(left_codes)), right_idx
+				left_idx = np.flatnonzero(right_idx < 0) if how == "anti" else np.flatnonzero(right_idx >= 0)
+				return left_idx, right_idx[left_idx] if how == "inner" else np.full(len(left_idx), -1, dtype=np.int64)
+	
+	order = np.argsort(right_codes, kind="stable")
+	sorted_codes = right_codes[order]
+	left_order = np.argsort(left_codes)
+	sorted_left = left_codes[left_order]
+	first = np.empty(len(left_codes), dtype=np.int64)
+	counts = np.empty(len(left_codes), dtype=np.int64)
+	first[left_order] = np.searchsorted(sorted_codes, sorted_left, side="left")
+	counts[left_order] = np.searchsorted(sorted_codes, sorted_left, side="right")
+	counts -= first
+	if how == "anti": 
+		left_idx = np.flatnonzero(counts == 0)
+		return left_idx, np.full(len(left_idx), -1, dtype=np.int64)
+	first = np.minimum(first, max(len(order)-1, 0))
+	if len(order) == 0: order = np.full(1, -1, dtype=np.int64)
+	
+	if counts.max(initial=0) <= 1: # usual case: at most one match per row
+		if how == "inner": 
+			left_idx = np.flatnonzero(counts)
+			return left_idx, order[first[left_idx]]
+		return np.arange(len(left_codes)), np.where(counts > 0, order[first], -1)
+	
+	# several matches: one row per match (left join: at least one row), right rows in their original order
+	counts_out = np.maximum(counts, 1) if how == "left" else counts
+	left_idx = np.repeat(np.arange(len(left_codes)), counts_out)
+	offset = np.arange(len(left_idx)) - np.repeat(np.cumsum(counts_out) - counts_out, counts_out) # position within the matches
+	right_idx = order[np.minimum(first[left_idx] + offset, len(order)-1)]
+	right_idx[counts[left_idx] == 0] = -1
+	return left_idx, right_idx
+
+
 def verbose(message, verbosity=True, pp=False):
 	if verbosity: 
 		if pp: pprint(message)
@@ -616,6 +2258,66 @@ def dynamo4ccp4_euler2rot(alpha,beta,gamma):
 				)
 	return R
 
+
+def euler_batch_buffer(alpha, beta, gamma, out, dtype):
+	# helper for the batched euler2rot functions: returns the angles as 1D arrays of the requested dtype and the (n,3,3) output buffer
+	if dtype is None: dtype = np.result_type(alpha, beta, gamma, np.float32) # at least float32, ints are promoted to float64
+	alpha, beta, gamma = [ np.atleast_1d(np.asarray(i, dtype=dtype)) for i in (alpha, beta, gamma) ]
+	if out is None: out = np.empty((alpha.shape[0], 3, 3), dtype=dtype)
+	elif out.shape != (alpha.shape[0], 3, 3): raise ValueError("out must have the shape (%d, 3, 3)!" % alpha.shape[0])
+	return alpha, beta, gamma, out
+
+
+def euler2rot_ccp4_batch(alpha, beta, gamma, out=None, dtype=None):
+	# same as euler2rot_ccp4, but for arrays of angles (n,): returns a contiguous (n,3,3) stack of matrices
+	# out		(nd-array, shape = (n,3,3)) preallocated buffer that is filled and returned
+	# dtype		np.float32 or np.float64 (default: dtype of the angles)
+	alpha, beta, gamma, R = euler_batch_buffer(alpha, beta, gamma, out, dtype)
+	ca = np.cos(alpha)
+	cb = np.cos(beta)
+	cg = np.cos(gamma)
+	sa = np.sin(alpha)
+	sb = np.sin(beta)
+	sg = np.sin(gamma)
+	R[:,0,0] = ca*cb*cg-sa*sg
+	R[:,0,1] = -ca*cb*sg-sa*cg
+	R[:,0,2] = ca*sb
+	R[:,1,0] = sa*cb*cg+ca*sg
+	R[:,1,1] = -sa*cb*sg+ca*cg
+	R[:,1,2] = sa*sb
+	R[:,2,0] = -sb*cg
+	R[:,2,1] = sb*sg
+	R[:,2,2] = cb
+	return R
+
+
+def dynamo4ccp4_euler2rot_batch(alpha, beta, gamma, out=None, dtype=None):
+	# same as dynamo4ccp4_euler2rot, but for arrays of angles (n,): returns a contiguous (n,3,3) stack of matrices
+	# (dynamo4ccp4_euler2rot returns (3,3,n), which has to be transposed)
+	# out		(nd-array, shape = (n,3,3)) preallocated buffer that is filled and returned
+	# dtype		np.float32 or np.float64 (default: dtype of the angles)
+	alpha, beta, gamma, R = euler_batch_buffer(alpha, beta, gamma, out, dtype)
+	ca = np.cos(alpha)
+	cb = np.cos(beta)
+	cg = np.cos(gamma)
+	sa = np.sin(alpha)
+	sb = np.sin(beta)
+	sg = np.sin(gamma)
+	
+	cc = cb*ca
+	cs = cb*sa
+	
+	R[:,0,0] = cg*cc-sg*sa
+	R[:,0,1] = cg*cs+sg*ca
+	R[:,0,2] = -cg*sb
+	R[:,1,0] = -sg*cc-cg*sa
+	R[:,1,1] = -sg*cs+cg*ca
+	R[:,1,2] = sg*sb
+	R[:,2,0] = sb*ca
+	R[:,2,1] = sb*sa
+	R[:,2,2] = cb
+	return R
+
 #
 #def dynamo_rot2euler_old(R):
 #	"""Decompose rotation matrix into Euler angles"""
@@ -643,23 +2345,181 @@ def dynamo_rot2euler(R):
 	"""Decompose rotation matrix into Euler angles"""
 	### radian as input
 	### return as radian
+	### R can be a single matrix (3,3) or a stack of matrices (n,3,3). For a stack ALPHA, BETA and GAMMA are arrays of shape (n,)
+	
+	R = np.asarray(R)
+	if R.ndim == 2:
+		if R[2,2] < 1:
+			BETA=np.arccos(R[2,2])
+			ALPHA=np.arctan2(R[2, 1], R[2, 0])
+			GAMMA=np.arctan2(R[1,2], -R[0,2])
+		else:
+			ALPHA = 0
+			BETA = 0
+			GAMMA = np.arctan2(R[0,1],R[1,1])
+		return ALPHA, BETA, GAMMA
 	
-	if R[2,2] < 1:
-		BETA=np.arccos(R[2,2])
-		ALPHA=np.arctan2(R[2, 1], R[2, 0])
-		GAMMA=np.arctan2(R[1,2], -R[0,2])
-	else:
-		ALPHA = 0
-		BETA = 0
-		GAMMA = np.arctan2(R[0,1],R[1,1])
+	# all matrices at once, the gimbal lock (R[2,2] >= 1) is selected by a mask
+	regular = R[:,2,2] < 1
+	BETA = np.where(regular, np.arccos(np.clip(R[:,2,2], -1, 1)), 0) # clip: no warnings for the masked matrices
+	ALPHA = np.where(regular, np.arctan2(R[:,2,1], R[:,2,0]), 0)
+	GAMMA = np.where(regular, np.arctan2(R[:,1,2], -R[:,0,2]), np.arctan2(R[:,0,1], R[:,1,1]))
 	
 	return ALPHA, BETA, GAMMA
 
 
+def rot2euler_ccp4(R):
+	"""Decompose rotation matrix into Euler angles according to CCP4 convention (inverse of euler2rot_ccp4)"""
+	### radian as input
+	### return as radian
+	### R can be a single matrix (3,3) or a stack of matrices (n,3,3). For a stack ALPHA, BETA and GAMMA are arrays of shape (n,)
+	
+	R = np.asarray(R)
+	if R.ndim == 2:
+		if R[2,2] < 1:
+			BETA=np.arccos(R[2,2])
+			ALPHA=np.arctan2(R[1,2], R[0,2])
+			GAMMA=np.arctan2(R[2,1], -R[2,0])
+		else:
+			ALPHA = np.arctan2(R[1,0], R[0,0])
+			BETA = 0
+			GAMMA = 0
+		return ALPHA, BETA, GAMMA
+	
+	regular = R[:,2,2] < 1
+	BETA = np.where(regular, np.arccos(np.clip(R[:,2,2], -1, 1)), 0)
+	ALPHA = np.where(regular, np.arctan2(R[:,1,2], R[:,0,2]), np.arctan2(R[:,1,0], R[:,0,0]))
+	GAMMA = np.where(regular, np.arctan2(R[:,2,1], -R[:,2,0]), 0)
+	
+	return ALPHA, BETA, GAMMA
+
 
 
 
-def apply_3D_coord_transform_to_ptcl_aln_params(AngleRot, AngleTilt, AnglePsi, OriginX, OriginY, apix, t_shift, eul, box_center=None):
+
+########################### QUATERNION POSES ###########################
+# Quaternions are stored as arrays (..., 4) = (w, x, y, z) with w = cos(angle/2). All functions work on single 
+# quaternions (4,) and on stacks (n,4). A unit quaternion q corresponds to the rotation matrix quat2rot(q), 
+# i.e. composition and inversion follow the matrix product and the transpose:
+#	quat2rot(quat_multiply(q1, q2))	= np.dot(quat2rot(q1), quat2rot(q2))
+#	quat2rot(quat_inverse(q))		= quat2rot(q).T
+# Compared to the Euler -> matrix -> np.dot -> Euler round trip, a pose needs 4 instead of 9 numbers, a composition
+# 16 instead of 27 multiplications, and quat_normalize removes the drift of chained transformations.
+
+def quat_multiply(q1, q2):
+	# Hamilton product q1*q2 (rotation q2 first, then q1), batched and broadcasted over the leading axes
+	q1 = np.asarray(q1)
+	q2 = np.asarray(q2)
+	w1, x1, y1, z1 = q1[...,0], q1[...,1], q1[...,2], q1[...,3]
+	w2, x2, y2, z2 = q2[...,0], q2[...,1], q2[...,2], q2[...,3]
+	return np.stack((
+		w1*w2 - x1*x2 - y1*y2 - z1*z2,
+		w1*x2 + x1*w2 + y1*z2 - z1*y2,
+		w1*y2 - x1*z2 + y1*w2 + z1*x2,
+		w1*z2 + x1*y2 - y1*x2 + z1*w2
+	), axis=-1)
+
+
+def quat_inverse(q):
+	# inverse rotation of a unit quaternion (= conjugate)
+	q = np.array(q, copy=True)
+	q[...,1:] *= -1
+	return q
+
+
+def quat_normalize(q):
+	# scales quaternions to unit length (removes accumulated rounding errors after many compositions)
+	q = np.asarray(q)
+	return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def quat_rotate_vector(q, v):
+	# applies the rotation q to the vector(s) v (shape (3,) or (n,3)), same as np.dot(quat2rot(q), v)
+	q = np.asarray(q)
+	v = np.asarray(v)
+	u = q[...,1:]
+	uv = np.cross(u, v)
+	return v + 2*(q[...,:1]*uv + np.cross(u, uv))
+
+
+def quat2rot(q):
+	# unit quaternion(s) --> rotation matrix (3,3) or stack of matrices (n,3,3)
+	q = np.asarray(q)
+	w, x, y, z = q[...,0], q[...,1], q[...,2], q[...,3]
+	R = np.empty(q.shape[:-1]+(3,3), dtype=q.dtype)
+	R[...,0,0] = 1 - 2*(y*y + z*z)
+	R[...,0,1] = 2*(x*y - w*z)
+	R[...,0,2] = 2*(x*z + w*y)
+	R[...,1,0] = 2*(x*y + w*z)
+	R[...,1,1] = 1 - 2*(x*x + z*z)
+	R[...,1,2] = 2*(y*z - w*x)
+	R[...,2,0] = 2*(x*z - w*y)
+	R[...,2,1] = 2*(y*z + w*x)
+	R[...,2,2] = 1 - 2*(x*x + y*y)
+	return R
+
+
+def rot2quat(R):
+	# rotation matrix (3,3) or stack of matrices (n,3,3) --> unit quaternion(s) with w >= 0
+	# for each matrix the numerically most stable of the four solutions (largest denominator) is selected by a mask
+	R = np.asarray(R)
+	m00, m11, m22 = R[...,0,0], R[...,1,1], R[...,2,2]
+	q = np.empty(R.shape[:-2]+(4,), dtype=np.result_type(R, np.float32))
+	diag = np.stack((m00+m11+m22, m00, m11, m22), axis=-1)
+	case = np.argmax(diag, axis=-1)
+	
+	c = case == 0
+	t = np.sqrt(np.maximum(1 + m00[c] + m11[c] + m22[c], 0)) * 2
+	q[c] = np.stack((t/4, (R[c][:,2,1]-R[c][:,1,2])/t, (R[c][:,0,2]-R[c][:,2,0])/t, (R[c][:,1,0]-R[c][:,0,1])/t), axis=-1)
+	c = case == 1
+	t = np.sqrt(np.maximum(1 + m00[c] - m11[c] - m22[c], 0)) * 2
+	q[c] = np.stack(((R[c][:,2,1]-R[c][:,1,2])/t, t/4, (R[c][:,0,1]+R[c][:,1,0])/t, (R[c][:,0,2]+R[c][:,2,0])/t), axis=-1)
+	c = case == 2
+	t = np.sqrt(np.maximum(1 - m00[c] + m11[c] - m22[c], 0)) * 2
+	q[c] = np.stack(((R[c][:,0,2]-R[c][:,2,0])/t, (R[c][:,0,1]+R[c][:,1,0])/t, t/4, (R[c][:,1,2]+R[c][:,2,1])/t), axis=-1)
+	c = case == 3
+	t = np.sqrt(np.maximum(1 - m00[c] - m11[c] + m22[c], 0)) * 2
+	q[c] = np.stack(((R[c][:,1,0]-R[c][:,0,1])/t, (R[c][:,0,2]+R[c][:,2,0])/t, (R[c][:,1,2]+R[c][:,2,1])/t, t/4), axis=-1)
+	
+	q[q[...,0] < 0] *= -1
+	return q
+
+
+def euler2quat_ccp4(alpha, beta, gamma):
+	# same rotation as euler2rot_ccp4 (rotations around ZYZ), radian as input
+	# q = qz(alpha) * qy(beta) * qz(gamma)
+	alpha, beta, gamma = [ np.asarray(i) for i in (alpha, beta, gamma) ]
+	cb = np.cos(beta/2)
+	sb = np.sin(beta/2)
+	return np.stack((
+		cb*np.cos((alpha+gamma)/2),
+		sb*np.sin((gamma-alpha)/2),
+		sb*np.cos((gamma-alpha)/2),
+		cb*np.sin((alpha+gamma)/2)
+	), axis=-1)
+
+
+def dynamo4ccp4_euler2quat(alpha, beta, gamma):
+	# same rotation as dynamo4ccp4_euler2rot (Relion _rlnAngleRot, _rlnAngleTilt, _rlnAnglePsi), radian as input
+	# dynamo4ccp4_euler2rot(alpha, beta, gamma) = euler2rot_ccp4(alpha, beta, gamma).T
+	return quat_inverse(euler2quat_ccp4(alpha, beta, gamma))
+
+
+def dynamo_quat2euler(q):
+	# same as dynamo_rot2euler(quat2rot(q)), but without building the matrices
+	# radian as return, for a stack of quaternions ALPHA, BETA and GAMMA are arrays of shape (n,)
+	q = np.asarray(q)
+	w, x, y, z = q[...,0], q[...,1], q[...,2], q[...,3]
+	xy2 = x*x + y*y # R[2,2] = 1 - 2*xy2
+	regular = xy2 > 0 # R[2,2] < 1; xy2 == 0 --> gimbal lock
+	BETA = np.where(regular, 2*np.arctan2(np.sqrt(xy2), np.sqrt(w*w + z*z)), 0) # = arccos(R[2,2]), but accurate for small angles
+	ALPHA = np.where(regular, np.arctan2(y*z + w*x, x*z - w*y), 0) # arctan2(R[2,1], R[2,0])
+	GAMMA = np.where(regular, np.arctan2(y*z - w*x, -(x*z + w*y)), np.arctan2(x*y - w*z, 0.5 - (x*x + z*z))) # arctan2(R[1,2], -R[0,2]) / arctan2(R[0,1], R[1,1])
+	return ALPHA, BETA, GAMMA
+
+
+
+def apply_3D_coord_transform_to_ptcl_aln_params(AngleRot, AngleTilt, AnglePsi, OriginX, OriginY, apix, t_shift, eul, box_center=None, dtype=None, engine="matrix", verbosity=True, R_org=None, groups=None):
 	"""
 	this version was upodated tu work with _rlnOriginXAngst and _rlnOriginYAngst, however, the variable still refer to the old 3.0 implementation with values in pixels!
 	povide the column that refers to the shifts in angstroem
@@ -686,6 +2546,14 @@ def apply_3D_coord_transform_to_ptcl_aln_params(AngleRot, AngleTilt, AnglePsi, O
 																center of the box.
 	box_center 	(nd-array float32, shape = (3,) )	= Coordinates in pixel for the center of the box. This parameter is required for calculating a corrected translation
 														vector, if a transformation (rotation + translation) was derived from coordinate transformations (see above).
+	dtype		(np.float32 or np.float64)			= Precision of the particle rotation matrices. Default: precision of the input angles
+	engine		(str)								= "matrix" (Euler -> 3x3 matrices -> Euler) or "quaternion" (Euler -> quaternions -> Euler)
+	verbosity	(bool)								= Print the box center adjusted translation vector. Default: True
+	R_org		(nd-array, shape = (n,3,3) )		= Precomputed rotation matrices of the particles (dynamo4ccp4_euler2rot_batch of AngleRot, AngleTilt, AnglePsi in rad),
+														e.g. if several transformations are applied to the same particles (matrix engine only)
+	groups		(nd-array int, shape = (n,) )		= Optics group of every particle as row in the tables apix (shape = (k,)) and box_center (shape = (k,3)), 
+														see optics_group_table and optics_group_index. The translation vector is adjusted once per
+														optics group and looked up for every particle.
 	"""
 	
 	if AngleRot.shape != AngleTilt.shape != AnglePsi.shape != OriginX.shape != OriginY.shape: sys.exit("Input alignment parameters must have the same shape!")
@@ -704,10 +2572,17 @@ def apply_3D_coord_transform_to_ptcl_aln_params(AngleRot, AngleTilt, AnglePsi, O
 	# Calculate Rotation_matrix from euler according to ccp4
 	R_update=euler2rot_ccp4( *np.radians(eul) ) # unpack
 	
-	if box_center is not None:
+	if (groups is not None) and (box_center is not None):
+		# one translation vector per optics group (rows: np.dot(R_update.T, v) = np.dot(v, R_update)), looked up for every particle
+		center = np.asarray(box_center, dtype=np.float64).reshape(-1,3) * np.asarray(apix, dtype=np.float64).reshape(-1,1)
+		shift_table = np.dot(R_update.T,t_shift) + center - np.dot(center, R_update)
+		if verbosity: 
+			for idx in range(len(shift_table)): print("New translation vector for rotations around the box center in Angstrom (optics group table row %d, box center = [%0.1f, %0.1f, %0.1f]): %5.3f, %5.3f, %5.3f" % ((idx+1,) + tuple(center[idx]) + tuple(shift_table[idx])))
+		shift_box_adjusted = shift_table[groups] # shape = (n_ptcl, 3)
+	elif box_center is not None:
 		shift_box_adjusted = np.dot(R_update.T,t_shift) + box_center*apix - np.dot(R_update.T,box_center*apix)
 		#print "New translation vector for rotations around the box center in voxels (box center = [%0.1f, %0.1f, %0.1f]): %5.3f, %5.3f, %5.3f" % (box_center[0],box_center[1],box_center[2], shift_box_adjusted[0], shift_box_adjusted[1], shift_box_adjusted[2])
-		print("New translation vector for rotations around the box center in Angstrom (box center = [%0.1f, %0.1f, %0.1f]): %5.3f, %5.3f, %5.3f" % (box_center[0]*apix,box_center[1]*apix,box_center[2]*apix, shift_box_adjusted[0], shift_box_adjusted[1], shift_box_adjusted[2]))
+		if verbosity: print("New translation vector for rotations around the box center in Angstrom (box center = [%0.1f, %0.1f, %0.1f]): %5.3f, %5.3f, %5.3f" % (box_center[0]*apix,box_center[1]*apix,box_center[2]*apix, shift_box_adjusted[0], shift_box_adjusted[1], shift_box_adjusted[2]))
 	else: shift_box_adjusted = t_shift
 	
 	
@@ -718,16 +2593,27 @@ def apply_3D_coord_transform_to_ptcl_aln_params(AngleRot, AngleTilt, AnglePsi, O
 	#### IMPORTANT - PARAMETERZATION
 	# dynamo_euler2rot required for correct parameterzation
 	
-	# get the rotation functions of all ptcls
-	# sort the fucking axes:
-	R_org = np.swapaxes ( dynamo4ccp4_euler2rot(np.radians( AngleRot ),np.radians( AngleTilt ),np.radians( AnglePsi )), 0, 1 ).T
-	
-	# outdated: # R_update = dynamo_euler2rot( *np.radians(eul) ) # unpack
-	R_new = np.dot(R_org,R_update.T) # element wise multiplication = np.dot
-	
-	# convert angles back:
-	if R_new.shape == (3,3): new_euler = np.array([ np.degrees( dynamo_rot2euler(R_new)) for i in np.arange(n_ptcl) ])
-	else: new_euler = np.array([ np.degrees( dynamo_rot2euler(R_new[i])) for i in np.arange(n_ptcl) ])
+	if engine == "quaternion": 
+		# same as below with quaternions: R_org --> q_org, R_update --> q_update, R_update.T --> quat_inverse(q_update)
+		q_org = dynamo4ccp4_euler2quat(*[ np.atleast_1d(np.radians(np.asarray(i, dtype=dtype))) for i in (AngleRot, AngleTilt, AnglePsi) ])
+		q_new = quat_multiply(q_org, quat_inverse(euler2quat_ccp4( *np.radians(eul) )))
+		new_euler = np.degrees( np.stack( dynamo_quat2euler(q_new), axis=-1 ) ) # shape = (n_ptcl, 3)
+		del(q_new)
+		t_new = quat_rotate_vector(q_org, shift_box_adjusted) # shape = (n_ptcl, 3)
+	elif engine == "matrix":
+		# get the rotation functions of all ptcls
+		# contiguous stack of matrices, shape = (n_ptcl, 3, 3)
+		if R_org is None: R_org = dynamo4ccp4_euler2rot_batch(*[ np.radians(np.asarray(a, dtype=dtype)) for a in (AngleRot, AngleTilt, AnglePsi) ], dtype=dtype)
+		
+		# outdated: # R_update = dynamo_euler2rot( *np.radians(eul) ) # unpack
+		R_new = np.matmul(R_org,R_update.T) # matrix product of every ptcl matrix with R_update.T
+		
+		# convert angles back:
+		new_euler = np.degrees( np.stack( dynamo_rot2euler(R_new), axis=-1 ) ) # shape = (n_ptcl, 3)
+		del(R_new)
+		if shift_box_adjusted.ndim == 2: t_new = np.matmul(R_org,shift_box_adjusted[:,:,None])[:,:,0] # one vector per ptcl (optics groups)
+		else: t_new = np.matmul(R_org,shift_box_adjusted)		# shape = (n_ptcl, 3); shift_box_adjusted.T = shift_box_adjusted (shape (3,))
+	else: sys.exit("ERROR: Unknown engine %s! Use matrix or quaternion." % engine)
 	
 	new_AngleRot  = new_euler[:,0]
 	new_AngleTilt = new_euler[:,1]
@@ -735,8 +2621,8 @@ def apply_3D_coord_transform_to_ptcl_aln_params(AngleRot, AngleTilt, AnglePsi, O
 	
 	
 	# apply shift
-	t_org = np.array([OriginX, OriginY, np.zeros((n_ptcl))]).T # shape = (n_ptcl, 3) 
-	t_new = t_org + ( np.dot(R_org,shift_box_adjusted) )		# shift_box_adjusted.T = shift_box_adjusted (shape (3,)), not transposed, because t_org is transposed	
+	t_new[:,0] += OriginX # t_org = (OriginX, OriginY, 0)
+	t_new[:,1] += OriginY
 	
 	new_OriginX = t_new[:,0]
 	new_OriginY = t_new[:,1]
@@ -756,4 +2642,481 @@ def apply_3D_coord_transform_to_ptcl_aln_params(AngleRot, AngleTilt, AnglePsi, O
 
 
 
+
+
+def optics_group_table(optics_block):
+	# lookup table of the optics groups (data_optics block): group numbers (k,), pixel sizes (k,) in Angstrom and
+	# box centers (k,3) in pixel (_rlnImageSize // 2, the RELION box center)
+	for c in ("_rlnOpticsGroup", "_rlnImagePixelSize", "_rlnImageSize"):
+		if not optics_block.check_colname_exists(c): sys.exit("ERROR: %s requires the column %s for optics group dependent transformations!" % (optics_block, c))
+	groups = np.asarray(optics_block.data_array["_rlnOpticsGroup"], dtype=np.int64)
+	if len(np.unique(groups)) != len(groups): sys.exit("ERROR: %s contains optics groups with the same number!" % optics_block)
+	apix = np.asarray(optics_block.data_array["_rlnImagePixelSize"], dtype=np.float64)
+	box_center = np.repeat((np.asarray(optics_block.data_array["_rlnImageSize"], dtype=np.int64) // 2)[:,None], 3, axis=1).astype(np.float64)
+	return groups, apix, box_center
+
+
+
+def optics_group_index(group_column, groups):
+	# row in the optics group table (groups = group numbers, see optics_group_table) of every particle (_rlnOpticsGroup (n,))
+	values = np.asarray(group_column, dtype=np.int64)
+	lookup = np.full(max(groups.max(initial=0), values.max(initial=0)) + 1, -1, dtype=np.int64)
+	lookup[groups] = np.arange(len(groups))
+	if values.min(initial=0) < 0: sys.exit("ERROR: Negative optics group numbers!")
+	index = lookup[values]
+	if np.any(index < 0): sys.exit("ERROR: Optics groups %s are not defined in data_optics!" % ", ".join(map(str, np.unique(values[index < 0]))))
+	return index
+
+
+
+########################### SYMMETRY EXPANSION ###########################
+# Point group operators as (k,3,3) stacks of rotation matrices (identity first) in the RELION orientations:
+#	Cn	n-fold axis along z
+#	Dn	n-fold axis along z, 2-fold axis along x
+#	T	3-fold axis along z, 2-fold axis along (0, 0.816496, 0.577350) = (0, sqrt(2/3), sqrt(1/3))
+#	O	4-fold axes along x, y, z, 3-fold axis along (1,1,1)
+#	I	= I2, 2-fold axes along x, y, z (Crowther 222 setting), 5-fold axis along (1,0,golden ratio) in the xz plane
+#	I1	2-fold axes along x, y, z, 5-fold axis along (0,1,golden ratio) in the yz plane (I2 rotated by 90 deg around z)
+# The particles are expanded with the transformation machinery of apply_3D_coord_transform_to_ptcl_aln_params 
+# (rotation around the box center, R_new = R_org * S.T), the origin shifts stay unchanged.
+
+def axis_angle2rot(axis, angle):
+	# rotation matrix for a rotation by angle (rad) around axis (3,)
+	axis = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+	K = np.array([	[0.0,		-axis[2],	axis[1]],
+					[axis[2],	0.0,		-axis[0]],
+					[-axis[1],	axis[0],	0.0]])
+	return np.eye(3) + np.sin(angle)*K + (1.0-np.cos(angle))*np.dot(K, K)
+
+
+
+def symmetry_group_closure(generators):
+	# all products of the generators (3,3), returns a (k,3,3) stack starting with the identity
+	group = [ np.eye(3) ]
+	keys = { tuple(np.round(np.eye(3), 6).ravel()) }
+	idx = 0
+	while idx < len(group):
+		for g in generators:
+			R = np.dot(group[idx], g)
+			key = tuple(np.round(R, 6).ravel() + 0.0) # + 0.0: no -0.0 keys
+			if key not in keys:
+				keys.add(key)
+				group.append(R)
+		if len(group) > 1000: raise Exception("ERROR: The symmetry generators do not form a finite point group!")
+		idx += 1
+	return np.array(group)
+
+
+
+def symmetry_operators(symmetry):
+	# returns the rotation matrices (k,3,3) of a point group: C1, Cn, Dn, T, O, I, I1, I2 (see above)
+	sym = symmetry.strip().upper()
+	golden = (1.0 + np.sqrt(5.0)) / 2.0
+	z, x = (0, 0, 1), (1, 0, 0)
+	try: 
+		if sym[0] in "CD": n = int(sym[1:])
+	except ValueError: sys.exit("ERROR: Unknown symmetry %s! Use Cn, Dn, T, O, I, I1 or I2." % symmetry)
+	if sym[0] == "C" and n >= 1: generators, order = [ axis_angle2rot(z, 2*np.pi/n) ], n
+	elif sym[0] == "D" and n >= 1: generators, order = [ axis_angle2rot(z, 2*np.pi/n), axis_angle2rot(x, np.pi) ], 2*n
+	# generator axes of T, O and I as in relion (src/symmetries.cpp, exact values of the rounded axes)
+	elif sym == "T": generators, order = [ axis_angle2rot(z, 2*np.pi/3), axis_angle2rot((0, np.sqrt(2/3), np.sqrt(1/3)), np.pi) ], 12
+	elif sym == "O": generators, order = [ axis_angle2rot((1,1,1), 2*np.pi/3), axis_angle2rot(z, np.pi/2) ], 24
+	elif sym in ("I", "I2"): generators, order = [ axis_angle2rot(z, np.pi), axis_angle2rot((1,0,golden), 2*np.pi/5), axis_angle2rot((0,1,golden**2), 2*np.pi/3) ], 60
+	elif sym == "I1": generators, order = [ axis_angle2rot(x, np.pi), axis_angle2rot((golden,0,-1), 2*np.pi/5), axis_angle2rot((golden**2,1,0), 2*np.pi/3) ], 60
+	else: sys.exit("ERROR: Unknown symmetry %s! Use Cn, Dn, T, O, I, I1 or I2." % symmetry)
+	operators = symmetry_group_closure(generators)
+	if len(operators) != order: raise Exception("ERROR: Symmetry %s has %d instead of %d operators!" % (symmetry, len(operators), order))
+	return operators
+
+
+
+def symmetry_expand_ptcl_aln_params(AngleRot, AngleTilt, AnglePsi, operators, dtype=None, R_org=None):
+	# Expands the particle orientations (deg, shape = (n,)) by the rotation operators (k,3,3) with one (n,k,3,3) matmul.
+	# returns the Euler angles (deg) of the expanded particles, shape = (n*k, 3): row i*k+j = particle i, operator j
+	# dtype		np.float32 or np.float64 (default: dtype of the angles)
+	# R_org		precomputed dynamo4ccp4_euler2rot_batch matrices of the particles (n,3,3)
+	if R_org is None: R_org = dynamo4ccp4_euler2rot_batch(*[ np.radians(np.asarray(a, dtype=dtype)) for a in (AngleRot, AngleTilt, AnglePsi) ], dtype=dtype)
+	S_T = np.ascontiguousarray(np.transpose(operators, (0,2,1)), dtype=R_org.dtype)
+	R_new = np.matmul(R_org[:,None,:,:], S_T[None,:,:,:]) # shape = (n, k, 3, 3)
+	return np.degrees( np.stack( dynamo_rot2euler(R_new.reshape(-1,3,3)), axis=-1 ) )
+
+
+
+def symmetry_expand_batches(block, operators, chunk_size=2**14):
+	# Generator over the symmetry expanded data block (see symmetry_expand_ptcl_aln_params) in batches of chunk_size 
+	# particles (chunk_size*k rows). All columns are repeated k times, the Euler angles are replaced.
+	# Use with starfile.savestar_batches, e.g. a 60-fold expansion of 1M particles is written without keeping 60M rows in memory.
+	columns = ["_rlnAngleRot", "_rlnAngleTilt", "_rlnAnglePsi"]
+	block.load_columns(*columns)
+	k = len(operators)
+	for start in range(0, len(block.data_array), chunk_size):
+		stop = min(len(block.data_array), start+chunk_size)
+		expanded = block.take(np.repeat(np.arange(start, stop), k))
+		new_euler = symmetry_expand_ptcl_aln_params(*[ block.data_array[c][start:stop] for c in columns ], operators, dtype=np.float64) # float64: the identity operator returns the stored angles
+		for idx, c in enumerate(columns): expanded.data_array[c] = new_euler[:,idx]
+		yield expanded
+
+
+
+########################### ATOMIC MODELS ###########################
+# Atoms of PDB and mmCIF models are returned as structured arrays (one row per atom) with the fields:
+#	record (ATOM/HETATM), name, altloc, resname, chain, resseq (int), icode, xyz (3,) in Angstrom, occupancy, bfactor, element
+# Only the first model of multi-model files is read. Selections are boolean masks (atom_mask), e.g. the center of 
+# mass of a domain:	center_of_mass(atoms, atom_mask(atoms, chains="A", residues=(10, 150)))
+
+atom_dtype = np.dtype([("record", "U6"), ("name", "U4"), ("altloc", "U1"), ("resname", "U4"), ("chain", "U4"), ("resseq", np.int32), 
+	("icode", "U1"), ("xyz", np.float64, (3,)), ("occupancy", np.float32), ("bfactor", np.float32), ("element", "U2")])
+
+# atomic masses (Da) for center_of_mass, other elements: 12.011
+atomic_masses = {"H": 1.008, "D": 2.014, "C": 12.011, "N": 14.007, "O": 15.999, "P": 30.974, "S": 32.06, "SE": 78.971, 
+	"NA": 22.990, "MG": 24.305, "K": 39.098, "CA": 40.078, "MN": 54.938, "FE": 55.845, "CO": 58.933, "NI": 58.693, 
+	"CU": 63.546, "ZN": 65.38, "CL": 35.45, "BR": 79.904, "I": 126.904, "F": 18.998}
+
+
+
+def read_model_atoms(fname):
+	# reads the atoms of a PDB (read_pdb_atoms) or mmCIF (read_mmcif_atoms, file extension .cif or .mmcif) model
+	if os.path.splitext(fname)[1].lower() in (".cif", ".mmcif"): return read_mmcif_atoms(fname)
+	return read_pdb_atoms(fname)
+
+
+
+def read_pdb_atoms(fname):
+	# reads the ATOM/HETATM records of a PDB file (see atom_dtype)
+	# The records are padded to 80 characters and stacked into a (n,80) character array. Every field is sliced from 
+	# its fixed columns and converted for all atoms at once, i.e. there is no parsing per line.
+	if not os.path.isfile(fname): sys.exit("ERROR: %s does not exist!" % fname)
+	with open(fname, "rb") as f: text = f.read()
+	end = text.find(b"\nENDMDL") # first model only
+	if end >= 0: text = text[:end+1]
+	records = re.findall(rb"^(?:ATOM  |HETATM).*", text, re.M)
+	if len(records) == 0: sys.exit("ERROR: %s contains no ATOM/HETATM records!" % fname)
+	lines = np.array(records, dtype="S80").view(np.uint8).reshape(len(records), 80) # padded with zeros
+	
+	def field(start, stop):
+		# fixed columns [start, stop) of all records as stripped strings (n,)
+		values = np.char.strip(np.ascontiguousarray(lines[:,start:stop]).view("S%d" % (stop-start))[:,0])
+		return values.view(np.uint8).astype(np.uint32).view("U%d" % (stop-start)) # latin-1, faster than astype("U")
+	
+	def number(start, stop, default):
+		# fixed columns [start, stop) of all records as numbers, empty fields = default
+		values = np.ascontiguousarray(lines[:,start:stop]).view("S%d" % (stop-start))[:,0]
+		empty = np.all((lines[:,start:stop] == 32) | (lines[:,start:stop] == 0), axis=1)
+		if np.any(empty): values = np.where(empty, str(default).encode(), values)
+		return values.astype(type(default))
+	
+	atoms = np.empty(len(records), dtype=atom_dtype)
+	atoms["record"] = field(0, 6)
+	atoms["name"] = field(12, 16)
+	atoms["altloc"] = field(16, 17)
+	atoms["resname"] = field(17, 21)
+	atoms["chain"] = field(21, 22)
+	atoms["icode"] = field(26, 27)
+	atoms["element"] = field(76, 78)
+	try:
+		atoms["resseq"] = number(22, 26, 0)
+		atoms["xyz"] = np.ascontiguousarray(lines[:,30:54]).view("S8").astype(np.float64) # x, y, z (8 columns each)
+		atoms["occupancy"] = number(54, 60, 1.0)
+		atoms["bfactor"] = number(60, 66, 0.0)
+	except ValueError as e: sys.exit("ERROR: %s contains invalid ATOM/HETATM records! (%s)" % (fname, e))
+	return atoms
+
+
+
+def read_mmcif_atoms(fname):
+	# reads the _atom_site loop of a mmCIF file (see atom_dtype), author numbering (auth_*) if present
+	# mmCIF loops are STAR loops and are parsed like the data blocks of star files: all required columns with one call 
+	# of the C tokenizer of np.loadtxt (numpy >= 1.23), otherwise like lazy data blocks (raw_rows).
+	# Quoted values are supported, except for values in single quotes (or any quotes for numpy < 1.23) that contain spaces.
+	if not os.path.isfile(fname): sys.exit("ERROR: %s does not exist!" % fname)
+	with open(fname) as f: text = f.read()
+	loop = re.search(r"^loop_[ \t]*\n((?:_atom_site\.\S+[ \t]*\n)+)", text, re.M)
+	if loop is None: sys.exit("ERROR: %s contains no _atom_site loop!" % fname)
+	labels = [ label.split(".", 1)[1] for label in loop.group(1).split() ]
+	end = len(text)
+	for tag in ("\n#", "\nloop_", "\n_", "\ndata_"): # end of the loop
+		found = text.find(tag, loop.end()-1, end)
+		if found >= 0: end = found
+	
+	# atom_dtype field : (mmCIF columns in order of preference, default for missing values)
+	fields = {	"record" : (["group_PDB"], "ATOM"), "name" : (["auth_atom_id", "label_atom_id"], None), 
+				"altloc" : (["label_alt_id"], ""), "resname" : (["auth_comp_id", "label_comp_id"], ""),
+				"chain" : (["auth_asym_id", "label_asym_id"], None), "resseq" : (["auth_seq_id", "label_seq_id"], "0"),
+				"icode" : (["pdbx_PDB_ins_code"], ""), "occupancy" : (["occupancy"], "1.0"), 
+				"bfactor" : (["B_iso_or_equiv"], "0.0"), "element" : (["type_symbol"], ""), "model" : (["pdbx_PDB_model_num"], "1"),
+				"x" : (["Cartn_x"], None), "y" : (["Cartn_y"], None), "z" : (["Cartn_z"], None) }
+	columns = {}
+	for field, (names, default) in fields.items():
+		available = [ name for name in names if name in labels ]
+		if len(available) > 0: columns[field] = available[0]
+		elif default is None: sys.exit("ERROR: The _atom_site loop of %s has no %s column!" % (fname, " or ".join(names)))
+	
+	lines = text[loop.end():end].splitlines()
+	try:
+		if has_c_loadtxt:
+			def load(numeric):
+				# numeric: fields converted by np.loadtxt, all others as strings (+2 characters for quotes)
+				dtype = [ (field, numeric[field] if field in numeric else "U%d" % (string_dtype_width(atom_dtype.fields[field][0])+2 if field in atom_dtype.names and is_string_dtype(atom_dtype.fields[field][0]) else 16)) for field in columns ]
+				return np.loadtxt(lines, dtype=dtype, usecols=[ labels.index(columns[field]) for field in columns ], comments=None, quotechar='"', ndmin=1)
+			coordinates = { "x" : np.float64, "y" : np.float64, "z" : np.float64 }
+			try: values = load(dict(coordinates, resseq=np.int32, occupancy=np.float32, bfactor=np.float32, model=np.int32))
+			except ValueError: values = load(coordinates) # missing values (. or ?) in numeric columns
+		else: 
+			values = raw_rows(text[loop.end():end], [ (label, np.float64 if label.startswith("Cartn_") else "U") for label in labels ]).parse_columns(list(columns.values()))
+			values = { field : values[name] for field, name in columns.items() }
+	except ValueError as e: sys.exit("ERROR: %s contains invalid _atom_site values! (%s)" % (fname, e))
+	
+	def column(field):
+		# values of a field without quotes, missing values (. and ?) = default
+		default = fields[field][1]
+		if field not in columns: return np.full(len(values["x"]), default)
+		column = values[field]
+		if not is_string_dtype(column.dtype): return column
+		first_char = np.ascontiguousarray(column).view(np.uint32).reshape(len(column), -1)[:,0] if column.size > 0 else np.zeros(0)
+		if np.any((first_char == 39) | (first_char == 34)): column = np.array([ v[1:-1] if v[:1] in "'\"" else v for v in column ])
+		if default is not None: column = np.where(np.isin(column, [".", "?"]), default, column)
+		return column
+	
+	model = column("model")
+	first_model = model == model[0] # first model only
+	atoms = np.empty(np.count_nonzero(first_model), dtype=atom_dtype)
+	try:
+		for field in atom_dtype.names:
+			if field != "xyz": atoms[field] = column(field)[first_model]
+		for idx, axis in enumerate("xyz"): atoms["xyz"][:,idx] = column(axis)[first_model]
+	except ValueError as e: sys.exit("ERROR: %s contains invalid _atom_site values! (%s)" % (fname, e))
+	return atoms
+
+
+
+def atom_mask(atoms, chains=None, residues=None, names=None, records=None):
+	# boolean mask (n,) of the atoms (see read_model_atoms) matching all given criteria:
+	#	chains		chain ID or list of chain IDs, e.g. "A" or ["A", "B"]
+	#	residues	residue range (first, last) (inclusive) or list of ranges, e.g. (10, 150) or [(10, 150), (200, 210)]
+	#	names		atom name or list of atom names, e.g. "CA"
+	#	records		"ATOM" or "HETATM"
+	mask = np.ones(len(atoms), dtype=bool)
+	if chains is not None: mask &= np.isin(atoms["chain"], np.atleast_1d(chains))
+	if names is not None: mask &= np.isin(atoms["name"], np.atleast_1d(names))
+	if records is not None: mask &= np.isin(atoms["record"], np.atleast_1d(records))
+	if residues is not None:
+		ranges = np.array(residues, dtype=np.int64).reshape(-1, 2)
+		resseq = atoms["resseq"][:,None]
+		mask &= np.any((resseq >= ranges[:,0]) & (resseq <= ranges[:,1]), axis=1)
+	return mask
+
+
+
+def atom_masses(atoms):
+	# atomic masses (n,) in Da from the element symbols, one dictionary lookup per element
+	elements, inverse = np.unique(np.char.upper(atoms["element"]), return_inverse=True)
+	return np.array([ atomic_masses.get(e, 12.011) for e in elements ])[inverse]
+
+
+
+def center_of_mass(atoms, mask=None, mass_weighted=True):
+	# center of mass (3,) in Angstrom of the atoms (see read_model_atoms) selected by mask (see atom_mask), e.g. of a domain
+	# mass_weighted	False: geometric center
+	if mask is not None: atoms = atoms[mask]
+	if len(atoms) == 0: sys.exit("ERROR: No atoms selected for the center of mass!")
+	if not mass_weighted: return atoms["xyz"].mean(axis=0)
+	masses = atom_masses(atoms)
+	return np.dot(masses, atoms["xyz"]) / masses.sum()
+
+
+########################### MODEL SUPERPOSITION ###########################
+# Least-squares superposition (Kabsch / SVD) of a moving model on a reference model: ref ~ R*mov + t.
+# Superposing original.pdb (moving) on transformed.pdb (reference) returns the coordinate transformation 
+# (CCP4 Euler angles and translation in Angstrom, as shown by coot) that is applied to the particles 
+# with apply_3D_coord_transform_to_ptcl_aln_params (and box_center).
+# Atoms (see read_model_atoms) are matched by chain, residue number, insertion code and atom name (alternative locations 
+# other than A are ignored).
+
+def match_atoms(ref_atoms, mov_atoms, ref_chain=None, mov_chain=None):
+	# coordinates (n,3) of the atoms present in both models (see read_model_atoms), in the order of the reference
+	# ref_chain, mov_chain: only use the atoms of these chains (which can have different chain IDs). Default: all chains
+	def keys(atoms, chain):
+		atoms = atoms[np.isin(atoms["altloc"], ["", "A"])]
+		if chain is not None: atoms = atoms[atoms["chain"] == chain]
+		key = np.char.add(np.char.add(np.char.add(atoms["resseq"].astype("U"), atoms["icode"]), ":"), atoms["name"])
+		if chain is None: key = np.char.add(np.char.add(atoms["chain"], ":"), key)
+		return key, atoms["xyz"]
+	ref_keys, ref_xyz = keys(ref_atoms, ref_chain)
+	mov_keys, mov_xyz = keys(mov_atoms, mov_chain)
+	common, ref_idx, mov_idx = np.intersect1d(ref_keys, mov_keys, assume_unique=False, return_indices=True)
+	order = np.argsort(ref_idx)
+	return ref_xyz[ref_idx[order]], mov_xyz[mov_idx[order]]
+
+
+
+def kabsch(ref, mov, weights=None):
+	# least-squares superposition of mov on ref: ref ~ R*mov + t
+	# ref, mov	(nd-array, shape = (n,3) or (m,n,3)) matched coordinates, a stack superposes m pairs at once
+	# weights	(nd-array, shape = (n,) or (m,n)) atom weights, e.g. 0 for the padding of shorter pairs. Default: 1
+	# returns R (3,3), t (3,) and the rmsd, or for a stack R (m,3,3), t (m,3) and rmsd (m,)
+	ref = np.asarray(ref, dtype=np.float64)
+	mov = np.asarray(mov, dtype=np.float64)
+	single = ref.ndim == 2
+	if single: ref, mov = ref[None], mov[None]
+	if ref.shape != mov.shape: raise ValueError("ref and mov must have the same shape!")
+	if weights is None: weights = np.ones(ref.shape[:2])
+	weights = np.asarray(weights, dtype=np.float64).reshape(ref.shape[:2])
+	w = weights / weights.sum(axis=1, keepdims=True)
+	
+	ref_center = np.einsum("mn,mnk->mk", w, ref)
+	mov_center = np.einsum("mn,mnk->mk", w, mov)
+	H = np.einsum("mn,mni,mnj->mij", w, mov - mov_center[:,None], ref - ref_center[:,None]) # covariance (m,3,3)
+	U, S, Vt = np.linalg.svd(H)
+	d = np.where(np.linalg.det(np.matmul(U, Vt)) < 0, -1.0, 1.0) # no reflections
+	Vt[:,2,:] *= d[:,None]
+	R = np.matmul(np.transpose(Vt, (0,2,1)), np.transpose(U, (0,2,1)))
+	t = ref_center - np.einsum("mij,mj->mi", R, mov_center)
+	rmsd = np.sqrt(np.einsum("mn,mn->m", w, ((np.matmul(mov, np.transpose(R, (0,2,1))) + t[:,None] - ref)**2).sum(axis=-1)))
+	
+	if single: return R[0], t[0], rmsd[0]
+	return R, t, rmsd
+
+
+
+def superpose_models(ref_atoms, mov_atoms, chain_pairs=None, verbosity=True):
+	# superposes the moving model on the reference model (see read_model_atoms), for every chain pair (ref_chain, mov_chain) 
+	# with one kabsch call. Default: one superposition of all matched atoms.
+	# returns the Euler angles (m,3) in deg (CCP4 convention, see euler2rot_ccp4), the translations (m,3) in Angstrom and the rmsd (m,)
+	if chain_pairs is None: chain_pairs = [ (None, None) ]
+	matched = [ match_atoms(ref_atoms, mov_atoms, ref_chain, mov_chain) for ref_chain, mov_chain in chain_pairs ]
+	n_atoms = np.array([ len(ref) for ref, mov in matched ])
+	for (ref_chain, mov_chain), n in zip(chain_pairs, n_atoms):
+		if n < 3: sys.exit("ERROR: %d matching atoms for chain %s (reference) and chain %s (moving)! At least 3 atoms are required." % (n, ref_chain, mov_chain))
+	
+	# pad the pairs to the same number of atoms (weight 0)
+	ref = np.zeros((len(matched), n_atoms.max(), 3))
+	mov = np.zeros_like(ref)
+	weights = np.zeros(ref.shape[:2])
+	for idx, (ref_xyz, mov_xyz) in enumerate(matched):
+		ref[idx,:n_atoms[idx]] = ref_xyz
+		mov[idx,:n_atoms[idx]] = mov_xyz
+		weights[idx,:n_atoms[idx]] = 1
+	R, t, rmsd = kabsch(ref, mov, weights)
+	euler = np.degrees(np.stack(rot2euler_ccp4(R), axis=-1))
+	
+	if verbosity:
+		for idx, (ref_chain, mov_chain) in enumerate(chain_pairs):
+			chains = "all chains" if ref_chain is None else "chain %s on chain %s" % (mov_chain, ref_chain)
+			print("Superposition of %s (%d atoms): rmsd = %0.3f A, euler = %0.3f, %0.3f, %0.3f, t = %0.3f, %0.3f, %0.3f" % ((chains, n_atoms[idx], rmsd[idx]) + tuple(euler[idx]) + tuple(t[idx])))
+	return euler, t, rmsd
+
+
+
+
+########################### POSE DISTRIBUTION ###########################
+# Histogram of the view directions (_rlnAngleRot, _rlnAngleTilt) on the HEALPix grid (ring scheme, as used by relion
+# for the angular sampling): 12 * nside**2 bins of equal area with nside = 2**order (order 2: 192 bins of ~15 deg, 
+# order 3: 768 bins of ~7.5 deg). The view direction is (cos(rot) sin(tilt), sin(rot) sin(tilt), cos(tilt)), 
+# i.e. theta = tilt and phi = rot. The psi angle does not change the view direction.
+
+def healpix_ang2pix(nside, theta, phi):
+	# HEALPix ring index (int64) of the directions theta (colatitude, 0..pi) and phi (longitude) in radians
+	return healpix_ring_index(nside, np.cos(theta), phi * (2/np.pi))
+
+
+def healpix_ring_index(nside, z, tt):
+	# HEALPix ring index (int64) of the directions z = cos(theta) and tt = phi / 90 deg (any range, wrapped to 0..4)
+	# computed in the precision of z and tt
+	tt = tt - 4 * np.floor(tt * 0.25)
+	tt[tt >= 4] = 0 # phi = -tiny
+	za = np.abs(z)
+	# equatorial belt (|z| <= 2/3)
+	temp1, temp2 = nside * (0.5 + tt), (nside * 0.75) * z
+	jp, jm = (temp1 - temp2).astype(np.int64), (temp1 + temp2).astype(np.int64)
+	ir = nside + 1 + jp - jm # ring number counted from z = 2/3, 1..2*nside+1
+	ip = ((jp + jm - nside + (1 - (ir & 1)) + 1) >> 1) & (4*nside - 1) # mod 4*nside (power of 2)
+	pix = 2*nside*(nside - 1) + (ir - 1) * 4*nside + ip
+	# polar caps
+	polar = np.flatnonzero(za > 2/3)
+	if len(polar) > 0:
+		tt, za, z = tt[polar], za[polar], z[polar]
+		tp = tt - np.floor(tt)
+		tmp = nside * np.sqrt(3 * (1 - za))
+		jp, jm = (tp * tmp).astype(np.int64), ((1 - tp) * tmp).astype(np.int64)
+		ir = jp + jm + 1 # ring number counted from the closest pole
+		ip = np.minimum((tt * ir).astype(np.int64), 4*ir - 1)
+		pix[polar] = np.where(z > 0, 2*ir*(ir - 1) + ip, 12*nside**2 - 2*ir*(ir + 1) + ip)
+	return pix
+
+
+def healpix_pix2ang(nside, pix):
+	# centers theta, phi (radians) of the HEALPix ring pixels pix
+	pix = np.asarray(pix, dtype=np.int64)
+	npix, ncap = 12*nside**2, 2*nside*(nside - 1)
+	theta, phi = np.zeros(pix.shape), np.zeros(pix.shape)
+	north, south = pix < ncap, pix >= npix - ncap
+	belt = ~(north | south)
+	# north polar cap
+	iring = (1 + np.sqrt(1 + 2*pix[north]).astype(np.int64)) >> 1
+	iphi = pix[north] + 1 - 2*iring*(iring - 1)
+	theta[north], phi[north] = np.arccos(1 - iring**2 * 4/npix), (iphi - 0.5) * np.pi / (2*iring)
+	# equatorial belt
+	ip = pix[belt] - ncap
+	iring = ip // (4*nside) + nside
+	iphi = ip % (4*nside) + 1
+	fodd = np.where((iring + nside) & 1, 1.0, 0.5)
+	theta[belt], phi[belt] = np.arccos((2*nside - iring) * 2/(3*nside)), (iphi - fodd) * np.pi / (2*nside)
+	# south polar cap
+	ip = npix - pix[south]
+	iring = (1 + np.sqrt(2*ip - 1).astype(np.int64)) >> 1
+	iphi = 4*iring + 1 - (ip - 2*iring*(iring - 1))
+	theta[south], phi[south] = np.arccos(-1 + iring**2 * 4/npix), (iphi - 0.5) * np.pi / (2*iring)
+	return theta, phi
+
+
+def pose_distribution(AngleRot, AngleTilt, order=3, weights=None, dtype=None, chunk_size=2**16):
+	# histogram of the view directions (angles in deg) on the HEALPix grid of the given order (see above)
+	# weights		optional weight per particle (e.g. _rlnMaxValueProbDistribution)
+	# dtype			precision of the bin computation. Default: the precision of the angles, at least float32 (float32 STAR 
+	#				columns are binned in float32, which is accurate enough for the bin index up to order ~10)
+	# returns the counts per bin (12 * 4**order) and a dictionary with summary metrics:
+	#	coverage		fraction of bins with at least one particle
+	#	max_over_mean	most populated bin / mean bin (1 for a uniform distribution)
+	#	cv				standard deviation / mean of the bin counts
+	#	entropy			Shannon entropy of the bin counts / log(number of bins) (1 for a uniform distribution)
+	#	gini			Gini coefficient of the bin counts (0: uniform, 1: all particles in one bin)
+	AngleRot, AngleTilt = np.asarray(AngleRot), np.asarray(AngleTilt)
+	nside = 2**int(order)
+	npix = 12*nside**2
+	if dtype is None: dtype = np.result_type(AngleRot, AngleTilt, np.float32)
+	counts = np.zeros(npix)
+	for start in range(0, len(AngleRot), chunk_size):
+		stop = start + chunk_size
+		z = np.cos(np.radians(AngleTilt[start:stop], dtype=dtype))
+		pix = healpix_ring_index(nside, z, np.multiply(AngleRot[start:stop], 1/90, dtype=dtype))
+		counts += np.bincount(pix, weights=None if weights is None else weights[start:stop], minlength=npix)
+	if weights is None: counts = counts.astype(np.int64)
+	
+	total = counts.sum()
+	mean = total / npix
+	p = counts[counts > 0] / total if total > 0 else np.ones(1)
+	sorted_counts = np.sort(counts)
+	metrics = {
+		"poses"			: len(AngleRot),
+		"bins"			: npix,
+		"coverage"		: np.count_nonzero(counts) / npix,
+		"max_over_mean"	: counts.max() / mean if total > 0 else 0.0,
+		"cv"			: counts.std() / mean if total > 0 else 0.0,
+		"entropy"		: max(0.0, -np.sum(p * np.log(p)) / np.log(npix)),
+		"gini"			: 1 - 2 * np.sum(np.cumsum(sorted_counts) / total) / npix + 1/npix if total > 0 else 0.0,
+	}
+	return counts, metrics
+
+
+def pose_distribution_block(counts, block_name="data_pose_distribution"):
+	# data block with the bin centers (_rlnAngleRot, _rlnAngleTilt in deg) and the counts (_rlnGroupNrParticles) of 
+	# a pose distribution (see pose_distribution), e.g. for starfile.add_data_block and savestar
+	theta, phi = healpix_pix2ang(int(round(np.sqrt(len(counts) / 12))), np.arange(len(counts)))
+	phi = np.where(phi > np.pi, phi - 2*np.pi, phi) # relion range -180..180
+	columns = { "_rlnAngleRot" : np.degrees(phi), "_rlnAngleTilt" : np.degrees(theta), "_rlnGroupNrParticles" : counts }
+	names = list(columns.keys())
+	dtype_assignment = [ (n, dtype_to_string_letter(columns[n].dtype.str)) for n in names ]
+	return data_block(column_array(columns, names), { idx+1 : n for idx, n in enumerate(names) }, { n : idx+1 for idx, n in enumerate(names) }, dtype_assignment, objname=block_name)
+
+
 if __name__ == "__main__": print(0)
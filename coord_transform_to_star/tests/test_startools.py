@@ -0,0 +1,493 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import startools
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "example", "original_helix_metadata.star")
+
+
+def read_particles():
+	return startools.starfile(EXAMPLE).data_particles
+
+
+def test_view_methods_use_the_selected_rows():
+	block = read_particles()
+	names, n = list(block.data_array.names), len(block.data_array)
+	tilt = block.data_array["_rlnAngleTilt"].copy()
+	view = block.select("_rlnAngleTilt > 90")
+	assert 0 < len(view) < n
+	
+	rows = view.take([0, 1])
+	assert np.array_equal(rows.query_column("_rlnImageName"), block.query_column("_rlnImageName", view.index[:2]))
+	
+	other = read_particles()
+	other.data_array["_rlnAngleRot"] = other.data_array["_rlnAngleRot"] + 1
+	joined = view.join(other, "_rlnImageName", columns=["_rlnAngleRot"])
+	assert len(joined.data_array) >= len(view)
+	assert np.all(joined.data_array["_rlnAngleTilt"] > 90)
+	assert set(joined.query_column("_rlnImageName")) == set(view.query_column("_rlnImageName"))
+	
+	view.add_column(np.arange(len(view)), "_rlnRow")
+	assert np.array_equal(view.data_array["_rlnRow"], np.arange(len(view)))
+	assert np.array_equal(view.query_column("_rlnRow"), np.arange(len(view)))
+	
+	# the data block is not modified
+	assert list(block.data_array.names) == names
+	assert len(block.data_array) == n
+	assert np.array_equal(block.data_array["_rlnAngleTilt"], tilt)
+
+
+def test_cache_depends_on_the_parse_options(tmp_path):
+	fname = str(tmp_path / "particles.star")
+	with open(EXAMPLE) as f: text = f.read()
+	with open(fname, "w") as f: f.write(text)
+	
+	split = startools.starfile(fname, cache=True).data_particles
+	assert split.image_name_column == "_rlnImageName"
+	
+	unsplit = startools.starfile(fname, cache=True, split_image_name=False).data_particles
+	assert unsplit.image_name_column is None
+	assert startools.is_string_dtype(unsplit.data_array["_rlnImageName"].dtype)
+	assert np.array_equal(unsplit.data_array["_rlnImageName"], split.query_column("_rlnImageName"))
+	
+	# same options: read from the cache
+	cached = startools.starfile(fname, cache=True, split_image_name=False).data_particles
+	assert isinstance(cached.data_array["_rlnImageName"], np.memmap)
+	assert np.array_equal(cached.data_array["_rlnImageName"], unsplit.data_array["_rlnImageName"])
+
+
+def test_bool_columns_are_written_as_integers(tmp_path):
+	star = startools.starfile(EXAMPLE)
+	flipped = np.arange(len(star.data_particles.data_array)) % 2 == 0
+	star.data_particles.add_column(flipped, "_rlnCtfDataArePhaseFlipped")
+	star.data_particles.add_column(True, "_rlnCtfDataAreCtfPremultiplied")
+	fname = str(tmp_path / "bool.star")
+	star.savestar(fname)
+	
+	particles = startools.starfile(fname).data_particles
+	assert np.array_equal(particles.data_array["_rlnCtfDataArePhaseFlipped"], flipped.astype(int))
+	assert np.all(particles.data_array["_rlnCtfDataAreCtfPremultiplied"] == 1)
+
+
+def test_parquet_column_subset_is_written(tmp_path):
+	pytest.importorskip("pyarrow")
+	star = startools.starfile(EXAMPLE)
+	star.save_parquet(str(tmp_path / "parquet"))
+	columns = ["_rlnImageName", "_rlnAngleRot"]
+	subset = startools.starfile(None)
+	subset.read_parquet(str(tmp_path / "parquet"), columns={ "data_particles" : columns })
+	assert list(subset.data_particles.data_array.names) == columns
+	
+	fname = str(tmp_path / "subset.star")
+	subset.savestar(fname, ["data_particles"])
+	particles = startools.starfile(fname).data_particles
+	assert list(particles.data_array.names) == columns
+	assert np.array_equal(particles.query_column("_rlnImageName"), star.data_particles.query_column("_rlnImageName"))
+	assert np.allclose(particles.data_array["_rlnAngleRot"], star.data_particles.data_array["_rlnAngleRot"], atol=1e-6)
+
+
+# generator axes (fold, axis) of relion (src/symmetries.cpp)
+RELION_GENERATORS = {
+	"D3" : [ (3, (0, 0, 1)), (2, (1, 0, 0)) ],
+	"T" : [ (3, (0, 0, 1)), (2, (0, 0.816496, 0.577350)) ],
+	"O" : [ (3, (0.5773502, 0.5773502, 0.5773502)), (4, (0, 0, 1)) ],
+	"I" : [ (2, (0, 0, 1)), (5, (0.525731114, 0, 0.850650807)), (3, (0, 0.356822076, 0.934172364)) ],
+	"I2" : [ (2, (0, 0, 1)), (5, (0.525731114, 0, 0.850650807)), (3, (0, 0.356822076, 0.934172364)) ],
+	"I1" : [ (2, (1, 0, 0)), (5, (0.85065080702670, 0, -0.5257311142635)), (3, (0.9341723640, 0.3568220765, 0)) ],
+}
+
+
+@pytest.mark.parametrize("symmetry", sorted(RELION_GENERATORS))
+def test_symmetry_operators_contain_the_relion_generators(symmetry):
+	operators = startools.symmetry_operators(symmetry)
+	assert len(operators) == { "D3" : 6, "T" : 12, "O" : 24 }.get(symmetry, 60)
+	for fold, axis in RELION_GENERATORS[symmetry]:
+		R = startools.axis_angle2rot(axis, 2*np.pi/fold)
+		assert np.abs(operators - R).max(axis=(1,2)).min() < 1e-5, (fold, axis)
+	# group: closed under multiplication
+	products = np.einsum("aij,bjk->abik", operators, operators).reshape(-1, 1, 3, 3)
+	assert np.abs(products - operators[None]).max(axis=(2,3)).min(axis=1).max() < 1e-6
+
+
+STAR_ROWS = """
+data_particles
+
+loop_
+_rlnImageName #1
+_rlnAngleRot #2
+_rlnClassNumber #3
+000001@Particles/a.mrcs 10.5 1
+# comment between the rows
+000002@Particles/a.mrcs -3.25 2
+000003@Particles/a_much_longer_name.mrcs 0.0 1
+"""
+
+
+def write_star(tmp_path, text, newline="\n"):
+	fname = str(tmp_path / "rows.star")
+	with open(fname, "w", newline=newline) as f: f.write(text)
+	return fname
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+@pytest.mark.parametrize("final_eol", [True, False])
+def test_parsers_read_the_same_rows(tmp_path, newline, final_eol):
+	text = STAR_ROWS if final_eol else STAR_ROWS.rstrip("\n")
+	fname = write_star(tmp_path, text, newline)
+	blocks = [ startools.starfile(fname, parser=parser, split_image_name=False).data_particles.data_array for parser in ("columnar", "genfromtxt") ]
+	for arr in blocks:
+		assert list(arr["_rlnImageName"]) == ["000001@Particles/a.mrcs", "000002@Particles/a.mrcs", "000003@Particles/a_much_longer_name.mrcs"]
+		assert np.array_equal(arr["_rlnAngleRot"], [10.5, -3.25, 0.0])
+		assert np.array_equal(arr["_rlnClassNumber"], [1, 2, 1])
+		assert arr["_rlnImageName"].dtype.itemsize // 4 == len("000003@Particles/a_much_longer_name.mrcs")
+	for name in blocks[0].names: assert blocks[0][name].dtype == blocks[1][name].dtype
+
+
+def test_parsers_read_a_loop_without_rows(tmp_path):
+	fname = write_star(tmp_path, STAR_ROWS.split("000001@")[0])
+	for parser in ("columnar", "genfromtxt"):
+		arr = startools.starfile(fname, parser=parser, split_image_name=False).data_particles.data_array
+		assert len(arr) == 0
+		assert np.asarray(arr["_rlnAngleRot"]).dtype.kind == "f"
+
+
+@pytest.mark.parametrize("c_loadtxt", [True, False])
+def test_columnar_string_width_follows_the_longest_value_of_all_chunks(tmp_path, monkeypatch, c_loadtxt):
+	monkeypatch.setattr(startools, "has_c_loadtxt", c_loadtxt and startools.has_c_loadtxt)
+	star = startools.starfile(write_star(tmp_path, STAR_ROWS), split_image_name=False)
+	dtype = [("_rlnImageName", "U1"), ("_rlnAngleRot", "f8")]
+	long_name = "x" * 300
+	chunks = [ "a 1\nbb 2\n", "%s 3\n" % long_name, "ccc 4\n" ]
+	arr = star.parse_rows_columnar(chunks, dtype)
+	assert list(arr["_rlnImageName"]) == ["a", "bb", long_name, "ccc"]
+	assert arr["_rlnImageName"].dtype == np.dtype("U300")
+	assert np.array_equal(arr["_rlnAngleRot"], [1, 2, 3, 4])
+
+
+INDEX_STAR = """# header comment
+data_optics
+
+loop_
+_rlnOpticsGroup #1
+_rlnVoltage #2
+1 300.0
+
+data_particles
+
+loop_
+_rlnImageName #1
+_rlnAngleRot #2
+000001@a.mrcs 1.0
+   000002@a.mrcs 2.0
+# comment between the rows
+
+\tdose@b.mrcs 3.0
+data.mrcs 4.0
+loop.mrcs 5.0
+000006@a.mrcs 6.0"""
+
+INDEX_ROWS = [ line for line in INDEX_STAR.splitlines()[13:] if line.strip() != "" and not line.startswith("#") ]
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_row_index_finds_the_rows_of_each_block(tmp_path, newline):
+	fname = write_star(tmp_path, INDEX_STAR, newline)
+	index = startools.row_index(fname)
+	assert [ (b["name"], b["labels"], b["nrows"]) for b in index.blocks ] == [ ("data_optics", ["_rlnOpticsGroup", "_rlnVoltage"], 1), ("data_particles", ["_rlnImageName", "_rlnAngleRot"], len(INDEX_ROWS)) ]
+	assert index.read_rows(1, slice(None)).splitlines() == INDEX_ROWS
+	assert index.read_rows(1, [4, 0]).splitlines() == [ INDEX_ROWS[4], INDEX_ROWS[0] ]
+	offsets = np.array(index.offsets)
+	for chunk_size in (1, 7, 64): # lines split between the chunks
+		index.build(chunk_size=chunk_size)
+		assert np.array_equal(index.offsets, offsets)
+	
+	full = startools.starfile(fname, split_image_name=False).data_particles.data_array
+	rows = startools.starfile(None, split_image_name=False)
+	rows.read_star_file_rows(fname, [5, 2])
+	for name in full.names: assert np.array_equal(rows.data_particles.data_array[name], full[name][[5, 2]])
+	assert len(rows.data_optics.data_array) == 1
+
+
+def test_row_index_is_reused_until_the_star_file_changes(tmp_path, monkeypatch):
+	fname = write_star(tmp_path, INDEX_STAR)
+	offsets = np.array(startools.row_index(fname).offsets)
+	assert os.path.isfile(fname + ".rowidx.npy") and os.path.isfile(fname + ".rowidx.json")
+	
+	def build(self, chunk_size=None): raise AssertionError("index rebuilt")
+	with monkeypatch.context() as m:
+		m.setattr(startools.row_index, "build", build)
+		index = startools.row_index(fname)
+		assert np.array_equal(index.offsets, offsets)
+		with pytest.raises(AssertionError): startools.row_index(fname, rebuild=True)
+	
+	with open(fname, "a") as f: f.write("\n000007@a.mrcs 7.0\n")
+	index = startools.row_index(fname)
+	assert index.blocks[1]["nrows"] == len(INDEX_ROWS) + 1
+	assert index.read_rows(1, [-1]) == "000007@a.mrcs 7.0\n"
+
+
+def random_rotations(rng, n):
+	q = rng.normal(size=(n, 4))
+	q /= np.linalg.norm(q, axis=1, keepdims=True)
+	w, x, y, z = q.T
+	return np.stack([ np.stack([1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y)], axis=-1), 
+		np.stack([2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x)], axis=-1), 
+		np.stack([2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)], axis=-1) ], axis=1)
+
+
+def test_kabsch_recovers_a_known_superposition():
+	rng = np.random.default_rng(1)
+	R, t = random_rotations(rng, 4), rng.normal(scale=20, size=(4, 3))
+	mov = rng.normal(scale=10, size=(4, 50, 3))
+	ref = np.matmul(mov, np.transpose(R, (0,2,1))) + t[:,None]
+	
+	R_fit, t_fit, rmsd = startools.kabsch(ref[0], mov[0])
+	assert np.allclose(R_fit, R[0], atol=1e-10) and np.allclose(t_fit, t[0], atol=1e-8) and rmsd < 1e-8
+	
+	# stack with padded atoms (weight 0)
+	weights = np.ones(mov.shape[:2])
+	weights[1:,40:] = 0
+	ref[1:,40:] = rng.normal(size=(3, 10, 3))
+	R_fit, t_fit, rmsd = startools.kabsch(ref, mov, weights)
+	assert np.allclose(R_fit, R, atol=1e-10) and np.allclose(t_fit, t, atol=1e-8) and np.all(rmsd < 1e-8)
+
+
+def test_kabsch_returns_a_rotation_for_mirrored_coordinates():
+	rng = np.random.default_rng(2)
+	mov = rng.normal(scale=10, size=(30, 3)) * [3, 2, 1]
+	ref = mov * [1, 1, -1] + [5, -3, 2] # mirror image
+	U, S, Vt = np.linalg.svd(np.matmul((mov - mov.mean(axis=0)).T, ref - ref.mean(axis=0)))
+	assert np.linalg.det(np.matmul(Vt.T, U.T)) < 0 # the best orthogonal fit is a reflection
+	R, t, rmsd = startools.kabsch(ref, mov)
+	assert np.allclose(np.matmul(R, R.T), np.eye(3), atol=1e-12)
+	assert np.isclose(np.linalg.det(R), 1)
+	assert rmsd > 1
+	# no nearby rotation fits better
+	center = mov.mean(axis=0)
+	for axis in rng.normal(size=(100, 3)):
+		R2 = np.matmul(startools.axis_angle2rot(axis, 0.01), R)
+		t2 = ref.mean(axis=0) - np.matmul(R2, center)
+		assert np.sqrt(np.mean(np.sum((np.matmul(mov, R2.T) + t2 - ref)**2, axis=1))) >= rmsd - 1e-9
+
+
+def test_superpose_models_recovers_the_euler_angles():
+	rng = np.random.default_rng(3)
+	atoms = np.zeros(20, dtype=startools.atom_dtype)
+	atoms["record"], atoms["chain"], atoms["name"] = "ATOM", "A", "CA"
+	atoms["resseq"] = np.arange(1, 21)
+	atoms["xyz"] = rng.normal(scale=10, size=(20, 3))
+	euler = np.radians([30, 50, 250])
+	R, t = startools.euler2rot_ccp4(*euler), np.array([1.0, -2.0, 3.0])
+	mov = atoms.copy()
+	mov["xyz"] = np.matmul(atoms["xyz"] - t, R) # ref = R*mov + t
+	mov = mov[rng.permutation(20)] # matched by chain, residue and atom name
+	euler_fit, t_fit, rmsd = startools.superpose_models(atoms, mov, verbosity=False)
+	assert np.allclose(startools.euler2rot_ccp4(*np.radians(euler_fit[0])), R, atol=1e-10)
+	assert np.allclose(t_fit[0], t, atol=1e-8) and rmsd[0] < 1e-8
+
+
+def make_block(tmp_path, fname, columns):
+	# data_particles block of a star file with the given columns {label : values}
+	labels = list(columns)
+	lines = [ "data_particles", "", "loop_" ] + [ "%s #%d" % (label, i+1) for i, label in enumerate(labels) ]
+	lines += [ " ".join([ str(columns[label][row]) for label in labels ]) for row in range(len(columns[labels[0]])) ]
+	with open(str(tmp_path / fname), "w") as f: f.write("\n".join(lines) + "\n")
+	return startools.starfile(str(tmp_path / fname)).data_particles
+
+
+def random_columns(rng, n, row_id):
+	micrographs = np.array([ "MotionCorr/mic_%03d.mrc" % i for i in range(7) ])
+	return { 
+		"_rlnImageName" : [ "%06d@Extract/mic_%d.mrcs" % (i, s) for i, s in zip(rng.integers(1, 6, n), rng.integers(0, 3, n)) ],
+		"_rlnMicrographName" : micrographs[rng.integers(0, len(micrographs), n)],
+		"_rlnCoordinateX" : rng.integers(0, 3, n) * 100.0,
+		"_rlnClassNumber" : rng.integers(1, 5, n),
+		"_rlnGroupNumber" : rng.integers(0, 4, n) * 10**8, # sparse integer codes (no lookup table)
+		"_rlnOpticsGroup" : rng.permutation(n) + 1, # unique keys (lookup table in join_indices)
+		"_rlnDefocusU" : np.round(rng.uniform(5000, 30000, n), 2),
+		"_rlnAngleRot" : np.round(rng.uniform(-180, 180, n), 2),
+		row_id : np.arange(n),
+	}
+
+
+JOIN_KEYS = [ "_rlnOpticsGroup", "_rlnClassNumber", "_rlnGroupNumber", "_rlnMicrographName", "_rlnImageName", ["_rlnMicrographName", "_rlnCoordinateX"], ["_rlnImageName", "_rlnClassNumber"] ]
+
+
+@pytest.mark.parametrize("on", JOIN_KEYS)
+@pytest.mark.parametrize("how", ["inner", "left", "anti"])
+def test_join_matches_a_brute_force_join(tmp_path, on, how):
+	rng = np.random.default_rng(4)
+	left = make_block(tmp_path, "left.star", random_columns(rng, 60, "_rlnHelicalTubeID"))
+	right_columns = random_columns(rng, 40, "_rlnRandomSubset")
+	right_columns["_rlnMicrographName"][:5] = "MotionCorr/only_in_right.mrc"
+	right = make_block(tmp_path, "right.star", right_columns)
+	keys = [on] if isinstance(on, str) else on
+	def key_rows(block): return list(zip(*[ block.query_column(c).tolist() for c in keys ]))
+	left_keys, right_keys = key_rows(left), key_rows(right)
+	
+	expected = []
+	for i, key in enumerate(left_keys):
+		matches = [ j for j, other in enumerate(right_keys) if other == key ]
+		if how == "inner": expected += [ (i, j) for j in matches ]
+		elif how == "left": expected += [ (i, j) for j in matches ] if len(matches) > 0 else [ (i, -1) ]
+		elif len(matches) == 0: expected.append((i, -1))
+	
+	joined = left.join(right, on, how=how, columns=["_rlnRandomSubset", "_rlnDefocusU"])
+	left_ids = joined.query_column("_rlnHelicalTubeID")
+	if how == "anti": 
+		assert left_ids.tolist() == [ i for i, j in expected ]
+		assert "_rlnRandomSubset" not in joined.data_array.names
+		return
+	right_ids = np.where(np.isin(left_ids, [ i for i, j in expected if j < 0 ]), -1, joined.query_column("_rlnRandomSubset"))
+	assert sorted(zip(left_ids.tolist(), right_ids.tolist())) == sorted(expected)
+	assert np.all(np.diff(left_ids) >= 0) # rows of self stay in order
+	# the columns of other overwrite the columns of self, unmatched rows keep their values
+	defocus = joined.query_column("_rlnDefocusU")
+	for i, j, value in zip(left_ids, right_ids, defocus): 
+		assert value == (right.query_column("_rlnDefocusU")[j] if j >= 0 else left.query_column("_rlnDefocusU")[i])
+	assert np.all(joined.query_column("_rlnRandomSubset")[right_ids < 0] == 0)
+
+
+@pytest.mark.parametrize("on", JOIN_KEYS)
+def test_groupby_matches_brute_force_aggregates(tmp_path, on):
+	rng = np.random.default_rng(5)
+	block = make_block(tmp_path, "groups.star", random_columns(rng, 80, "_rlnHelicalTubeID"))
+	keys = [on] if isinstance(on, str) else on
+	row_keys = list(zip(*[ block.query_column(c).tolist() for c in keys ]))
+	defocus, rot = block.query_column("_rlnDefocusU").astype(np.float64), block.query_column("_rlnAngleRot").astype(np.float64)
+	classes = block.query_column("_rlnClassNumber")
+	
+	groups = block.groupby(on)
+	result = groups.agg({ "_rlnDefocusU" : ["sum", "mean", "var", "std", "min", "max", "median", "first", "last"], 
+		"_rlnAngleRot" : ["circmean", "circstd"], "_rlnClassNumber" : ["sum", "median"] })
+	result_keys = list(zip(*[ result.query_column(c).tolist() for c in keys ]))
+	def sort_key(key): # split image names are sorted by stack and slice number
+		return tuple([ (v.split("@")[1], int(v.split("@")[0])) if c == "_rlnImageName" else v for c, v in zip(keys, key) ])
+	assert result_keys == sorted(set(row_keys), key=sort_key) # one row per group in sorted key order
+	assert len(groups) == len(result_keys)
+	
+	for g, key in enumerate(result_keys):
+		rows = np.array([ i for i, other in enumerate(row_keys) if other == key ])
+		assert np.array_equal(groups.group_rows(g), rows)
+		values = defocus[rows]
+		expected = { "sum" : values.sum(), "mean" : values.mean(), "var" : values.var(), "std" : values.std(), "min" : values.min(), 
+			"max" : values.max(), "median" : np.median(values), "first" : values[0], "last" : values[-1] }
+		assert result.query_column("_rlnGroupNrParticles")[g] == len(rows)
+		for func, value in expected.items(): assert np.isclose(result.query_column("_rlnDefocusU_" + func)[g], value, rtol=1e-6, atol=1e-3), func
+		angles = np.radians(rot[rows])
+		R = np.hypot(np.cos(angles).mean(), np.sin(angles).mean())
+		assert np.isclose(result.query_column("_rlnAngleRot_circmean")[g], np.degrees(np.arctan2(np.sin(angles).mean(), np.cos(angles).mean())), atol=1e-6)
+		assert np.isclose(result.query_column("_rlnAngleRot_circstd")[g], np.degrees(np.sqrt(-2*np.log(min(R, 1.0)))), atol=1e-6)
+		assert result.query_column("_rlnClassNumber_sum")[g] == classes[rows].sum()
+		assert result.query_column("_rlnClassNumber_median")[g] == np.median(classes[rows])
+
+
+@pytest.mark.parametrize("order", [0, 1, 3, 6])
+def test_healpix_pixel_centers_round_trip(order):
+	nside = 2**order
+	pix = np.arange(12*nside**2)
+	theta, phi = startools.healpix_pix2ang(nside, pix)
+	assert np.all((theta > 0) & (theta < np.pi)) and np.all((phi >= 0) & (phi < 2*np.pi))
+	assert np.array_equal(startools.healpix_ang2pix(nside, theta, phi), pix)
+	assert np.array_equal(startools.healpix_ang2pix(nside, theta, phi - 2*np.pi), pix) # relion range -180..180
+	if order > 3: return
+	# equal area bins: uniform directions give about the same count per bin
+	rng = np.random.default_rng(order)
+	n = 400 * len(pix)
+	counts = np.bincount(startools.healpix_ang2pix(nside, np.arccos(rng.uniform(-1, 1, n)), rng.uniform(0, 2*np.pi, n)), minlength=len(pix))
+	assert np.abs(counts - 400).max() < 6 * np.sqrt(400)
+
+
+def test_healpix_matches_healpy():
+	healpy = pytest.importorskip("healpy")
+	rng = np.random.default_rng(6)
+	theta, phi = np.arccos(rng.uniform(-1, 1, 10000)), rng.uniform(0, 2*np.pi, 10000)
+	for order in (0, 2, 5, 8):
+		assert np.array_equal(startools.healpix_ang2pix(2**order, theta, phi), healpy.ang2pix(2**order, theta, phi))
+
+
+def test_pose_distribution_counts_known_poses():
+	order, nside = 2, 4
+	theta, phi = startools.healpix_pix2ang(nside, np.arange(192))
+	counts = np.arange(192) % 5 # 0..4 poses per bin
+	tilt = np.repeat(np.degrees(theta), counts).astype(np.float32)
+	rot = np.repeat(np.degrees(np.where(phi > np.pi, phi - 2*np.pi, phi)), counts).astype(np.float32)
+	result, metrics = startools.pose_distribution(rot, tilt, order=order, chunk_size=50)
+	assert np.array_equal(result, counts)
+	assert metrics["poses"] == counts.sum() and metrics["bins"] == 192
+	assert np.isclose(metrics["coverage"], np.count_nonzero(counts) / 192)
+	assert np.isclose(metrics["max_over_mean"], 4 / counts.mean())
+	
+	# the poles: first and last ring, any rot
+	result, metrics = startools.pose_distribution(np.array([0.0, 100.0, -100.0, 0.0]), np.array([0.0, 0.0, 0.0, 180.0]), order=order)
+	assert result[0] == 1 and result[1] == 1 and result[2] == 1 and result[-4] == 1 and result.sum() == 4
+	
+	# one pose per bin: uniform distribution
+	result, metrics = startools.pose_distribution(np.degrees(phi), np.degrees(theta), order=order)
+	assert np.all(result == 1)
+	assert np.isclose(metrics["coverage"], 1) and np.isclose(metrics["max_over_mean"], 1) and np.isclose(metrics["cv"], 0)
+	assert np.isclose(metrics["entropy"], 1) and np.isclose(metrics["gini"], 0)
+	
+	block = startools.pose_distribution_block(result)
+	assert np.allclose(block.data_array["_rlnAngleTilt"], np.degrees(theta))
+	assert np.all(np.abs(block.data_array["_rlnAngleRot"]) <= 180)
+
+
+def transformed_poses(poses, engine, dtype, **kwargs):
+	rot, tilt, psi, x, y = [ p.astype(dtype) for p in poses ]
+	result = startools.apply_3D_coord_transform_to_ptcl_aln_params(rot, tilt, psi, x, y, t_shift=np.array([12.0, -30.0, 7.5]), 
+		eul=np.array([33.0, 71.0, -120.0]), dtype=dtype, engine=engine, verbosity=False, **kwargs)
+	# compared as rotation matrices: Euler angles are not unique (e.g. tilt 0 or 180)
+	R = startools.dynamo4ccp4_euler2rot_batch(*np.radians(result[:,:3].T.astype(np.float64)))
+	return R, result[:,3:].astype(np.float64)
+
+
+@pytest.mark.parametrize("optics_groups", [False, True])
+def test_quaternion_and_matrix_engines_give_the_same_poses(optics_groups):
+	rng = np.random.default_rng(7)
+	n = 5000
+	poses = [ rng.uniform(-180, 180, n), np.degrees(np.arccos(rng.uniform(-1, 1, n))), rng.uniform(-180, 180, n), rng.normal(scale=20, size=n), rng.normal(scale=20, size=n) ]
+	poses[1][:10] = [0, 180, 0, 180, 1e-4, 179.9999, 90, 90, 0, 180] # gimbal lock
+	if optics_groups: kwargs = { "apix" : np.array([1.1, 0.85]), "box_center" : np.array([[128.0]*3, [200.0]*3]), "groups" : rng.integers(0, 2, n) }
+	else: kwargs = { "apix" : 1.1, "box_center" : np.array([128.0]*3) }
+	
+	R_ref, t_ref = transformed_poses(poses, "matrix", np.float64, **kwargs)
+	for dtype, R_tol, t_tol in ((np.float64, 1e-12, 1e-10), (np.float32, 2e-5, 2e-3)): # shifts up to ~400 A
+		for engine in ("matrix", "quaternion"):
+			R, t = transformed_poses(poses, engine, dtype, **kwargs)
+			assert np.abs(R - R_ref).max() < R_tol, (engine, dtype)
+			assert np.abs(t - t_ref).max() < t_tol, (engine, dtype)
+
+
+IMAGE_NAMES = [
+	[ "000001@Extract/job007/mic_1.mrcs", "000012@Extract/job007/mic_1.mrcs", "000003@Extract/job007/mic_2.mrcs", "000001@Extract/job007/mic_10.mrcs" ], 
+	[ "1@stack.mrcs", "12@stack.mrcs", "123456@other.mrcs" ], # no zero padding
+	[ "01@stack.mrcs", "1@stack.mrcs" ], # mixed padding: kept as strings
+	[ "stack.mrcs", "000001@stack.mrcs" ], # no slice number: kept as strings
+]
+
+
+@pytest.mark.parametrize("names", IMAGE_NAMES)
+def test_written_image_names_are_the_original_text(tmp_path, names):
+	block = make_block(tmp_path, "names.star", { "_rlnImageName" : names, "_rlnAngleRot" : np.arange(len(names)) + 0.5 })
+	split = block.image_name_column == "_rlnImageName"
+	assert split == (names in IMAGE_NAMES[:2])
+	if split: 
+		column = block.data_array["_rlnImageName"]
+		assert column.dtype.names == ("index", "stack")
+		assert column["index"].tolist() == [ int(name.split("@")[0]) for name in names ]
+		assert [ block.image_stacks[s] for s in column["stack"] ] == [ name.split("@")[1] for name in names ]
+	assert block.query_column("_rlnImageName").tolist() == names
+	
+	star = startools.starfile(str(tmp_path / "names.star"))
+	star.savestar(str(tmp_path / "out.star"))
+	with open(str(tmp_path / "out.star")) as f: rows = [ line.split() for line in f if "@" in line or line.startswith("stack") ]
+	assert [ row[0] for row in rows ] == names
+	
+	# selections return the same text
+	view = star.data_particles.select("_rlnAngleRot > 1")
+	assert view.query_column("_rlnImageName").tolist() == names[1:]